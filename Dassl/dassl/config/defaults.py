@@ -38,6 +38,9 @@ _C.INPUT.PIXEL_STD = [0.229, 0.224, 0.225]
 _C.INPUT.CROP_PADDING = 4
 # Random resized crop
 _C.INPUT.RRCROP_SCALE = (0.08, 1.0)
+# Decode JPEGs at a reduced scale (1/2, 1/4 or 1/8) that is still at
+# least as large as the transforms sample, see DatasetWrapper
+_C.INPUT.DRAFT_DECODE = False
 # Cutout
 _C.INPUT.CUTOUT_N = 1
 _C.INPUT.CUTOUT_LEN = 16
@@ -86,6 +89,9 @@ _C.DATASET.CIFAR_C_TYPE = ""
 _C.DATASET.CIFAR_C_LEVEL = 1
 # Use all data in the unlabeled data set (e.g. FixMatch)
 _C.DATASET.ALL_AS_UNLABELED = False
+# Image shard store written by pack_shards.py, images that are not
+# in the store are read from their files
+_C.DATASET.IMAGE_SHARDS = ""
 
 ###########################
 # Dataloader
@@ -97,6 +103,15 @@ _C.DATALOADER.K_TRANSFORMS = 1
 # img0 denotes image tensor without augmentation
 # Useful for consistency learning
 _C.DATALOADER.RETURN_IMG0 = False
+# Number of augmented views (img1, img2, ...) of each training image
+_C.DATALOADER.NUM_VIEWS = 16
+# Generate all views of an image in one batched crop/resize on tensors
+# instead of one PIL transform per view (only for random_resized_crop,
+# random_flip and normalize)
+_C.DATALOADER.BATCHED_VIEWS = False
+# Return the views of a sample as one "views" tensor instead of img1,
+# img2, ... keys, batches hold a single [views, batch, 3, H, W] tensor
+_C.DATALOADER.STACK_VIEWS = False
 # Setting for the train_x data-loader
 _C.DATALOADER.TRAIN_X = CN()
 _C.DATALOADER.TRAIN_X.SAMPLER = "RandomSampler"
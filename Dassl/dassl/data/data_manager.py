@@ -1,13 +1,20 @@
+import math
 import torch
 import torchvision.transforms as T
 from tabulate import tabulate
 from torch.utils.data import Dataset as TorchDataset
+from torch.utils.data import get_worker_info
+from torch.utils.data.dataloader import default_collate
 
 from dassl.utils import read_image
 
 from .datasets import build_dataset
+from .image_shards import ImageShards
 from .samplers import build_sampler
-from .transforms import INTERPOLATION_MODES, build_transform
+from .transforms import (
+    INTERPOLATION_MODES, MultiViewTransform, build_transform,
+    build_multi_view_transform
+)
 
 
 def build_train_data_loader(
@@ -41,7 +48,8 @@ def build_train_data_loader(
     sampler=sampler,
     num_workers=cfg.DATALOADER.NUM_WORKERS,
     drop_last=is_train and len(data_source) >= batch_size,
-    pin_memory=(torch.cuda.is_available() and cfg.USE_CUDA))
+    pin_memory=(torch.cuda.is_available() and cfg.USE_CUDA),
+    collate_fn=multi_view_collate)
     
     assert len(data_loader) > 0
     
@@ -78,7 +86,8 @@ def build_data_loader(
         sampler=sampler,
         num_workers=cfg.DATALOADER.NUM_WORKERS,
         drop_last=is_train and len(data_source) >= batch_size,
-        pin_memory=(torch.cuda.is_available() and cfg.USE_CUDA)
+        pin_memory=(torch.cuda.is_available() and cfg.USE_CUDA),
+        collate_fn=multi_view_collate
     )
 
     assert len(data_loader) > 0
@@ -86,6 +95,34 @@ def build_data_loader(
     return data_loader
 
 
+def multi_view_collate(batch):
+    """Collate samples like default_collate, except for the "views" of
+    DatasetWrapper with STACK_VIEWS: the [K, 3, H, W] views of all
+    samples are written into one [K, B, 3, H, W] tensor, which is
+    allocated in shared memory in a worker process, so the batch is sent
+    to the main process without a copy.
+    """
+    if "views" not in batch[0]:
+        return default_collate(batch)
+
+    views = [sample["views"] for sample in batch]
+    elem = views[0]
+    out = None
+    if get_worker_info() is not None:
+        numel = elem.numel() * len(views)
+        if hasattr(elem, "_typed_storage"):
+            storage = elem._typed_storage()._new_shared(numel, device=elem.device)
+        else:
+            storage = elem.storage()._new_shared(numel)
+        out = elem.new(storage).resize_(elem.shape[0], len(views), *elem.shape[1:])
+    output = default_collate([
+        {key: value for key, value in sample.items() if key != "views"}
+        for sample in batch
+    ])
+    output["views"] = torch.stack(views, dim=1, out=out)
+    return output
+
+
 class DataManager:
 
     def __init__(
@@ -100,7 +137,13 @@ class DataManager:
 
         # Build transform
         if custom_tfm_train is None:
-            tfm_train = build_transform(cfg, is_train=True)
+            tfm_train = None
+            if cfg.DATALOADER.BATCHED_VIEWS:
+                tfm_train = build_multi_view_transform(cfg)
+                if tfm_train is None:
+                    print("* Batched views are not supported by the transforms or the interpolation, using PIL transforms")
+            if tfm_train is None:
+                tfm_train = build_transform(cfg, is_train=True)
         else:
             print("* Using custom transform for training")
             tfm_train = custom_tfm_train
@@ -223,9 +266,38 @@ class DataManager:
         print(tabulate(table))
 
 
+def get_draft_size(cfg, augment):
+    """Shorter side JPEGs are decoded at with INPUT.DRAFT_DECODE.
+
+    Args:
+        cfg (CfgNode): config.
+        augment (bool): the images go through the training transform.
+
+    Returns:
+        int: draft size, 0 for full resolution.
+    """
+    if not cfg.INPUT.DRAFT_DECODE:
+        return 0
+    draft_size = max(cfg.INPUT.SIZE)
+    if augment and "random_resized_crop" in cfg.INPUT.TRANSFORMS:
+        # crops of the smallest area keep about the output size
+        draft_size = math.ceil(
+            draft_size / math.sqrt(cfg.INPUT.RRCROP_SCALE[0])
+        )
+    return draft_size
+
+
 class DatasetWrapper(TorchDataset):
 
-    def __init__(self, cfg, data_source, transform=None, is_train=False):
+    def __init__(
+        self,
+        cfg,
+        data_source,
+        transform=None,
+        is_train=False,
+        num_views=None,
+        draft_size=None
+    ):
         self.cfg = cfg
         self.data_source = data_source
         self.transform = transform  # accept list (tuple) as input
@@ -233,6 +305,19 @@ class DatasetWrapper(TorchDataset):
         # Augmenting an image K>1 times is only allowed during training
         self.k_tfm = cfg.DATALOADER.K_TRANSFORMS if is_train else 1
         self.return_img0 = cfg.DATALOADER.RETURN_IMG0
+        # Views of a single transform: NUM_VIEWS for training, one for testing
+        if num_views is None:
+            num_views = cfg.DATALOADER.NUM_VIEWS if is_train else 1
+        self.num_views = num_views
+        # a single "views" tensor instead of img1, img2, ...
+        self.stack_views = (
+            cfg.DATALOADER.STACK_VIEWS and num_views > 1 and self.k_tfm == 1
+        )
+
+        if isinstance(transform, MultiViewTransform) and self.k_tfm > 1:
+            raise ValueError(
+                "K_TRANSFORMS > 1 is not supported with batched views"
+            )
 
         if self.k_tfm > 1 and transform is None:
             raise ValueError(
@@ -252,6 +337,15 @@ class DatasetWrapper(TorchDataset):
             to_tensor += [normalize]
         self.to_tensor = T.Compose(to_tensor)
 
+        # Shorter side JPEGs are decoded at, 0 for full resolution
+        if draft_size is None:
+            draft_size = get_draft_size(cfg, is_train)
+        self.draft_size = draft_size
+
+        self.image_shards = None
+        if cfg.DATASET.IMAGE_SHARDS:
+            self.image_shards = ImageShards(cfg.DATASET.IMAGE_SHARDS)
+
     def __len__(self):
         return len(self.data_source)
 
@@ -265,7 +359,10 @@ class DatasetWrapper(TorchDataset):
             "index": idx
         }
 
-        img0 = read_image(item.impath)
+        if self.image_shards is not None:
+            img0 = self.image_shards.read_image(item.impath, self.draft_size)
+        else:
+            img0 = read_image(item.impath, self.draft_size)
 
         if self.transform is not None:
             if isinstance(self.transform, (list, tuple)):
@@ -275,8 +372,20 @@ class DatasetWrapper(TorchDataset):
                     if (i + 1) > 1:
                         keyname += str(i + 1)
                     output[keyname] = img
+            elif isinstance(self.transform, MultiViewTransform):
+                views = self.transform(img0, self.num_views)
+                if self.stack_views:
+                    output["views"] = views
+                else:
+                    for i in range(self.num_views):
+                        output["img" + str(i + 1)] = views[i]
+            elif self.stack_views:
+                output["views"] = torch.stack([
+                    self._transform_image(self.transform, img0)
+                    for _ in range(self.num_views)
+                ])
             else:
-                for i in range(16):
+                for i in range(self.num_views):
                     img = self._transform_image(self.transform, img0)
                     keyname = "img"
                     # if (i + 1) > 1:
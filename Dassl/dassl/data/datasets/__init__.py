@@ -1,6 +1,19 @@
 from .build import DATASET_REGISTRY, build_dataset  # isort:skip
-from .base_dataset import Datum, DatasetBase  # isort:skip
+from .base_dataset import Datum, DatumIndex, DatasetBase  # isort:skip
 
-from .da import *
-from .dg import *
-from .ssl import *
+# the built-in datasets are imported when they are first requested
+DATASET_REGISTRY.register_lazy("dassl.data.datasets.da", [
+    "Digit5", "VisDA17", "CIFARSTL", "Office31", "DomainNet", "OfficeHome",
+    "miniDomainNet"
+])
+DATASET_REGISTRY.register_lazy("dassl.data.datasets.dg", [
+    "PACS", "VLCS", "FMoW", "IWildCam", "Camelyon17", "CIFAR10C", "CIFAR100C",
+    "DigitsDG", "DigitSingle", "OfficeHomeDG"
+])
+DATASET_REGISTRY.register_lazy("dassl.data.datasets.ssl", [
+    "SVHN", "CIFAR10", "CIFAR100", "STL10"
+])
+
+
+def __getattr__(name):
+    return DATASET_REGISTRY.get_attr(name, __name__)
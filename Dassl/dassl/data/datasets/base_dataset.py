@@ -1,12 +1,14 @@
 import os
+import json
 import random
 import os.path as osp
 import tarfile
 import zipfile
 from collections import defaultdict
-import gdown
 
-from dassl.utils import check_isfile
+import numpy as np
+
+from dassl.utils import check_isfile, mkdir_if_missing
 
 
 class Datum:
@@ -17,11 +19,12 @@ class Datum:
         label (int): class label.
         domain (int): domain label.
         classname (str): class name.
+        verify (bool): check that impath is a file (default: True).
     """
 
-    def __init__(self, impath="", label=0, domain=0, classname=""):
+    def __init__(self, impath="", label=0, domain=0, classname="", verify=True):
         assert isinstance(impath, str)
-        assert check_isfile(impath)
+        assert not verify or check_isfile(impath)
 
         self._impath = impath
         self._label = label
@@ -45,6 +48,173 @@ class Datum:
         return self._classname
 
 
+class DatumIndex:
+    """Columnar, array-backed list of Datum objects.
+
+    Image paths are packed into one byte array with offsets, labels and
+    domains are int32 arrays and class names are stored once per label.
+    An index saved with save() is memory-mapped by load(), so reading it
+    does not depend on the number of images, and Datum objects are only
+    created when items are accessed.
+
+    Args:
+        paths (np.ndarray): uint8 array of the concatenated utf-8 paths.
+        offsets (np.ndarray): int64 array, path i is paths[offsets[i]:offsets[i + 1]].
+        labels (np.ndarray): int32 class labels.
+        domains (np.ndarray): int32 domain labels.
+        classnames (list): class name of each label.
+        root (str): directory the index was loaded from (optional).
+    """
+
+    def __init__(self, paths, offsets, labels, domains, classnames, root=None):
+        assert len(offsets) == len(labels) + 1 and len(labels) == len(domains)
+        self.paths = paths
+        self.offsets = offsets
+        self.labels = labels
+        self.domains = domains
+        self.classnames = list(classnames)
+        self.root = root
+
+    @classmethod
+    def from_datums(cls, data_source):
+        """Build an index from a list of Datum objects.
+
+        Args:
+            data_source (list): a list of Datum objects.
+        """
+        classnames = {}
+        for item in data_source:
+            classnames[item.label] = item.classname
+        impaths = [item.impath.encode() for item in data_source]
+        return cls.from_arrays(
+            impaths,
+            [item.label for item in data_source],
+            [item.domain for item in data_source],
+            [classnames.get(label, "") for label in range(max(classnames, default=-1) + 1)],
+        )
+
+    @classmethod
+    def from_arrays(cls, impaths, labels, domains, classnames):
+        """Build an index from per-item paths (str or bytes), labels and domains.
+
+        Args:
+            impaths (list): image paths.
+            labels (list): class labels.
+            domains (list): domain labels.
+            classnames (list): class name of each label.
+        """
+        impaths = [p.encode() if isinstance(p, str) else p for p in impaths]
+        offsets = np.zeros(len(impaths) + 1, dtype=np.int64)
+        np.cumsum([len(p) for p in impaths], out=offsets[1:])
+        paths = np.frombuffer(b"".join(impaths), dtype=np.uint8)
+        return cls(
+            paths, offsets,
+            np.asarray(labels, dtype=np.int32).reshape(-1),
+            np.asarray(domains, dtype=np.int32).reshape(-1),
+            classnames,
+        )
+
+    @classmethod
+    def load(cls, root):
+        """Memory-map an index written by save().
+
+        Args:
+            root (str): index directory.
+        """
+        with open(osp.join(root, "classnames.json"), "r") as f:
+            classnames = json.load(f)
+        arrays = [
+            np.load(osp.join(root, name + ".npy"), mmap_mode="r")
+            for name in ["paths", "offsets", "labels", "domains"]
+        ]
+        return cls(*arrays, classnames, root=root)
+
+    @staticmethod
+    def exists(root):
+        return osp.isfile(osp.join(root, "classnames.json"))
+
+    def save(self, root):
+        """Write the index to a directory, classnames.json is written last
+        and marks a complete index.
+
+        Args:
+            root (str): index directory.
+        """
+        mkdir_if_missing(root)
+        for name in ["paths", "offsets", "labels", "domains"]:
+            np.save(osp.join(root, name + ".npy"), np.ascontiguousarray(getattr(self, name)))
+        tmp = osp.join(root, "classnames.json.{}.tmp".format(os.getpid()))
+        with open(tmp, "w") as f:
+            json.dump(self.classnames, f)
+        os.replace(tmp, osp.join(root, "classnames.json"))
+
+    def impath(self, idx):
+        start, end = self.offsets[idx], self.offsets[idx + 1]
+        return self.paths[start:end].tobytes().decode()
+
+    def subset(self, indices, relabel=None, classnames=None):
+        """Select items by index, in the given order.
+
+        Args:
+            indices (np.ndarray): indices of the selected items.
+            relabel (np.ndarray): new label of each old label (optional).
+            classnames (list): class names of the new labels (optional).
+        """
+        indices = np.asarray(indices, dtype=np.int64)
+        starts, ends = self.offsets[indices], self.offsets[indices + 1]
+        lengths = ends - starts
+        offsets = np.zeros(len(indices) + 1, dtype=np.int64)
+        np.cumsum(lengths, out=offsets[1:])
+        paths = np.empty(offsets[-1], dtype=np.uint8)
+        chunk = 1 << 16
+        for i in range(0, len(indices), chunk):
+            j = min(i + chunk, len(indices))
+            # byte positions of the selected paths i..j
+            positions = np.repeat(starts[i:j] - offsets[i:j], lengths[i:j])
+            positions += np.arange(offsets[i], offsets[j])
+            paths[offsets[i]:offsets[j]] = self.paths[positions]
+        labels = np.asarray(self.labels[indices])
+        if relabel is not None:
+            labels = np.asarray(relabel, dtype=np.int32)[labels]
+        return DatumIndex(
+            paths, offsets, labels,
+            np.asarray(self.domains[indices]),
+            self.classnames if classnames is None else classnames,
+        )
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("index {} is out of range".format(idx))
+        label = int(self.labels[idx])
+        return Datum(
+            impath=self.impath(idx),
+            label=label,
+            domain=int(self.domains[idx]),
+            classname=self.classnames[label],
+            verify=False
+        )
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def __getstate__(self):
+        # data loader workers map a saved index themselves instead of receiving a copy
+        if self.root is not None:
+            return {"root": self.root}
+        return self.__dict__
+
+    def __setstate__(self, state):
+        if "paths" not in state:
+            state = DatumIndex.load(state["root"]).__dict__
+        self.__dict__.update(state)
+
+
 class DatasetBase:
     """A unified dataset class for
     1) domain adaptation
@@ -96,8 +266,10 @@ class DatasetBase:
         """Count number of classes.
 
         Args:
-            data_source (list): a list of Datum objects.
+            data_source (list): a list of Datum objects or a DatumIndex.
         """
+        if isinstance(data_source, DatumIndex):
+            return int(np.max(data_source.labels)) + 1
         label_set = set()
         for item in data_source:
             label_set.add(item.label)
@@ -108,8 +280,12 @@ class DatasetBase:
         """Get a label-to-classname mapping (dict).
 
         Args:
-            data_source (list): a list of Datum objects.
+            data_source (list): a list of Datum objects or a DatumIndex.
         """
+        if isinstance(data_source, DatumIndex):
+            labels = np.unique(data_source.labels).tolist()
+            mapping = {label: data_source.classnames[label] for label in labels}
+            return mapping, [mapping[label] for label in labels]
         container = set()
         for item in data_source:
             container.add((item.label, item.classname))
@@ -138,6 +314,7 @@ class DatasetBase:
             os.makedirs(osp.dirname(dst))
 
         if from_gdrive:
+            import gdown
             gdown.download(url, dst, quiet=False)
         else:
             raise NotImplementedError
@@ -188,6 +365,12 @@ class DatasetBase:
         output = []
 
         for data_source in data_sources:
+            if isinstance(data_source, DatumIndex):
+                output.append(
+                    self.generate_fewshot_index(data_source, num_shots, repeat)
+                )
+                continue
+
             tracker = self.split_dataset_by_label(data_source)
             dataset = []
 
@@ -208,6 +391,37 @@ class DatasetBase:
 
         return output
 
+    @staticmethod
+    def generate_fewshot_index(data_source, num_shots, repeat=False):
+        """Few-shot sampling on the label array of a DatumIndex.
+
+        Draws the same items as for the equivalent list of Datum
+        objects: labels in order of first appearance, items of a label
+        in dataset order.
+
+        Args:
+            data_source (DatumIndex): an index.
+            num_shots (int): number of instances per class to sample.
+            repeat (bool): repeat images if needed (default: False).
+        """
+        labels = np.asarray(data_source.labels)
+        order = np.argsort(labels, kind="stable")
+        _, starts, counts = np.unique(
+            labels[order], return_index=True, return_counts=True
+        )
+        # first appearance of each label
+        first = order[starts]
+        selected = []
+        for i in np.argsort(first, kind="stable"):
+            items = order[starts[i]:starts[i] + counts[i]].tolist()
+            if len(items) >= num_shots:
+                selected.extend(random.sample(items, num_shots))
+            elif repeat:
+                selected.extend(random.choices(items, k=num_shots))
+            else:
+                selected.extend(items)
+        return data_source.subset(selected)
+
     def split_dataset_by_label(self, data_source):
         """Split a dataset, i.e. a list of Datum objects,
         into class-specific groups stored in a dictionary.
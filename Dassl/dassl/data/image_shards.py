@@ -0,0 +1,212 @@
+import io
+import os
+import json
+import hashlib
+import os.path as osp
+from multiprocessing import Pool
+
+import numpy as np
+from PIL import Image
+
+from dassl.utils import read_image, mkdir_if_missing
+
+SHARDS_VERSION = 1
+IMAGE_EXTENSIONS = (
+    ".jpg", ".jpeg", ".png", ".ppm", ".bmp", ".pgm", ".tif", ".tiff", ".webp"
+)
+
+
+def path_key(relpath):
+    """64-bit key of a path relative to the store root."""
+    relpath = relpath.replace(os.sep, "/")
+    digest = hashlib.blake2b(relpath.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little")
+
+
+class ImageShards:
+    """Reader of images packed by pack_image_shards().
+
+    Images are stored back to back in a few large shard files, with an
+    index of (key, shard, offset, length) sorted by the key of their path
+    relative to the store root. read_image() returns an image of the
+    store, or reads the original file if the image was not packed, so a
+    store can be used in place of the original files.
+
+    Args:
+        root (str): store directory.
+    """
+
+    def __init__(self, root):
+        self.root = osp.expanduser(root)
+        with open(osp.join(self.root, "meta.json"), "r") as f:
+            self.meta = json.load(f)
+        if self.meta["version"] != SHARDS_VERSION:
+            raise ValueError(
+                "Unsupported image shards version {}".format(self.meta["version"])
+            )
+        self.image_root = self.meta["image_root"]
+        self.keys = np.load(osp.join(self.root, "keys.npy"), mmap_mode="r")
+        self.locations = np.load(osp.join(self.root, "locations.npy"), mmap_mode="r")
+        self._files = {}  # shard file descriptors, opened per process
+
+    def __len__(self):
+        return len(self.keys)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_files"] = {}
+        return state
+
+    def __del__(self):
+        for fd in self._files.values():
+            os.close(fd)
+
+    def locate(self, path):
+        """Row of path in the index, or -1."""
+        relpath = osp.relpath(osp.abspath(path), self.image_root)
+        if relpath.startswith(".."):
+            return -1
+        key = np.uint64(path_key(relpath))
+        row = int(np.searchsorted(self.keys, key))
+        if row < len(self.keys) and self.keys[row] == key:
+            return row
+        return -1
+
+    def __contains__(self, path):
+        return self.locate(path) >= 0
+
+    def read_bytes(self, path):
+        """Encoded image of path, or None if it is not in the store."""
+        row = self.locate(path)
+        if row < 0:
+            return None
+        shard, offset, length = (int(v) for v in self.locations[row])
+        fd = self._files.get(shard)
+        if fd is None:
+            fd = os.open(
+                osp.join(self.root, "shard-{:05d}.bin".format(shard)), os.O_RDONLY
+            )
+            self._files[shard] = fd
+        return os.pread(fd, length, offset)
+
+    def read_image(self, path, draft_size=0):
+        """RGB image of path, from the store if it was packed.
+
+        Args:
+            path (str): path of the original image.
+            draft_size (int, optional): see dassl.utils.read_image().
+        """
+        data = self.read_bytes(path)
+        if data is None:
+            return read_image(path, draft_size)
+        return read_image(io.BytesIO(data), draft_size)
+
+
+def _encode_image(args):
+    path, short_side, quality = args
+    with open(path, "rb") as f:
+        data = f.read()
+    img = Image.open(io.BytesIO(data))
+    if min(img.size) <= short_side and img.format == "JPEG" and img.mode == "RGB":
+        # small enough, keep the original encoding
+        return data
+    img = img.convert("RGB")
+    if min(img.size) > short_side:
+        scale = short_side / min(img.size)
+        size = (max(1, round(img.width * scale)), max(1, round(img.height * scale)))
+        img = img.resize(size, Image.BICUBIC)
+    buffer = io.BytesIO()
+    img.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def list_images(directory):
+    """All image files under directory, in sorted order."""
+    paths = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                paths.append(osp.join(dirpath, filename))
+    return paths
+
+
+def pack_image_shards(
+    image_root,
+    directories,
+    output,
+    short_side=256,
+    quality=90,
+    shard_size=1 << 30,
+    num_workers=8
+):
+    """Pack the images under directories of image_root into an image
+    shard store.
+
+    Images are resized to short_side (never upscaled) and re-encoded as
+    JPEG, JPEGs that are already small enough are stored as they are.
+    Images are written in the sorted order of their paths, so reading a
+    directory in that order is sequential.
+
+    Args:
+        image_root (str): root that the keys of the store are relative to.
+        directories (list): directories to pack, relative to image_root.
+        output (str): store directory.
+        short_side (int): maximum length of the shorter image side.
+        quality (int): JPEG quality of re-encoded images.
+        shard_size (int): shard file size in bytes before a new one is started.
+        num_workers (int): processes that decode and encode images.
+    """
+    image_root = osp.abspath(osp.expanduser(image_root))
+    output = osp.expanduser(output)
+    paths = []
+    for directory in directories:
+        paths.extend(list_images(osp.join(image_root, directory)))
+    if not paths:
+        raise ValueError("No images found under {}".format(directories))
+
+    keys = np.array(
+        [path_key(osp.relpath(path, image_root)) for path in paths], dtype=np.uint64
+    )
+    if len(np.unique(keys)) != len(keys):
+        raise RuntimeError("Path keys collide, the store cannot be indexed")
+
+    mkdir_if_missing(output)
+    if osp.exists(osp.join(output, "meta.json")):
+        os.remove(osp.join(output, "meta.json"))
+
+    locations = np.zeros((len(paths), 3), dtype=np.int64)
+    shard, offset, f = 0, 0, None
+    tasks = ((path, short_side, quality) for path in paths)
+    with Pool(num_workers) as pool:
+        for i, data in enumerate(pool.imap(_encode_image, tasks, chunksize=16)):
+            if f is None or offset >= shard_size:
+                if f is not None:
+                    f.close()
+                    shard += 1
+                f = open(osp.join(output, "shard-{:05d}.bin".format(shard)), "wb")
+                offset = 0
+            f.write(data)
+            locations[i] = (shard, offset, len(data))
+            offset += len(data)
+            if (i + 1) % 10000 == 0:
+                print("Packed {}/{} images".format(i + 1, len(paths)))
+    f.close()
+
+    order = np.argsort(keys)
+    np.save(osp.join(output, "keys.npy"), keys[order])
+    np.save(osp.join(output, "locations.npy"), locations[order])
+    # written last, marks a complete store
+    meta = {
+        "version": SHARDS_VERSION,
+        "image_root": image_root,
+        "directories": list(directories),
+        "num_images": len(paths),
+        "num_shards": shard + 1,
+        "short_side": short_side,
+        "quality": quality,
+    }
+    with open(osp.join(output, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=4)
+    print("Packed {} images into {} shards at {}".format(len(paths), shard + 1, output))
+    return meta
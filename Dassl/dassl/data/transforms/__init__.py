@@ -1 +1,2 @@
 from .transforms import INTERPOLATION_MODES, build_transform
+from .multi_view import MultiViewTransform, build_multi_view_transform
@@ -0,0 +1,148 @@
+import numpy as np
+import torch
+import torch.nn.functional as F
+from torchvision.transforms import RandomResizedCrop
+
+# transforms that MultiViewTransform can apply to all views at once
+MULTI_VIEW_CHOICES = ["random_resized_crop", "random_flip", "normalize"]
+
+
+class MultiViewTransform:
+    """Random resized crop, flip and normalization of several views of an
+    image in a batch.
+
+    The image is converted to a normalized tensor once (normalization
+    commutes with resampling), crop boxes are drawn like
+    ``RandomResizedCrop`` does and all crops, flipped or not, are
+    resampled by one bilinear ``grid_sample`` call. Crops that are
+    downscaled by 2x or more are sampled from an average-pooled copy of
+    the image to avoid aliasing, one call per pooling level.
+
+    Args:
+        size (tuple): output size (height, width).
+        scale (tuple): range of the crop area relative to the image.
+        ratio (tuple): range of the crop aspect ratio.
+        flip (bool): random horizontal flip.
+        mean (list): normalization mean, None for no normalization.
+        std (list): normalization std.
+    """
+
+    def __init__(
+        self,
+        size,
+        scale=(0.08, 1.0),
+        ratio=(3.0 / 4.0, 4.0 / 3.0),
+        flip=True,
+        mean=None,
+        std=None
+    ):
+        self.size = tuple(size)
+        self.scale = scale
+        self.ratio = ratio
+        self.flip = flip
+        # output pixel centers in [-1, 1]
+        self.base_y = (torch.arange(self.size[0]) + 0.5) / self.size[0] * 2 - 1
+        self.base_x = (torch.arange(self.size[1]) + 0.5) / self.size[1] * 2 - 1
+        if mean is not None:
+            self.mean = torch.tensor(mean).view(3, 1, 1) * 255
+            self.std = torch.tensor(std).view(3, 1, 1) * 255
+        else:
+            self.mean = torch.zeros(3, 1, 1)
+            self.std = torch.full((3, 1, 1), 255.0)
+
+    def __call__(self, img, num_views):
+        """Return a [num_views, 3, height, width] float tensor.
+
+        Args:
+            img (PIL.Image): RGB image.
+            num_views (int): number of views.
+        """
+        image = torch.from_numpy(np.asarray(img, dtype=np.uint8).copy())
+        image = image.permute(2, 0, 1).contiguous().float()
+        image.sub_(self.mean).div_(self.std)
+
+        boxes = torch.empty(num_views, 4)
+        for k in range(num_views):
+            top, left, height, width = RandomResizedCrop.get_params(
+                image, self.scale, self.ratio
+            )
+            boxes[k] = torch.tensor([left, top, width, height], dtype=torch.float)
+
+        # x scale of the affine grid, negative for flipped views
+        sign = torch.ones(num_views)
+        if self.flip:
+            sign[torch.rand(num_views) < 0.5] = -1
+
+        out_h, out_w = self.size
+        downscale = torch.min(boxes[:, 2] / out_w, boxes[:, 3] / out_h)
+        levels = torch.floor(torch.log2(downscale.clamp(min=1))).long()
+
+        views = []
+        level_image, level = image, 0
+        targets = sorted(set(levels.tolist()))
+        for target in targets:
+            while level < target and min(level_image.shape[-2:]) >= 2:
+                level_image = _downscale2x(level_image)
+                level += 1
+            idx = torch.nonzero(levels == target).flatten()
+            # the pooled image covers the first (size // 2 ** level) * 2 ** level pixels
+            span_h = level_image.shape[-2] * 2 ** level
+            span_w = level_image.shape[-1] * 2 ** level
+            x, y, w, h = boxes[idx, :, None].unbind(1)
+            # crops are axis-aligned: sampling positions are a column and a row per view
+            grid_x = ((2 * x + w) + sign[idx, None] * w * self.base_x) / span_w - 1
+            grid_y = ((2 * y + h) + h * self.base_y) / span_h - 1
+            grid = torch.stack(torch.broadcast_tensors(grid_x[:, None, :], grid_y[:, :, None]), dim=-1)
+            views.append(F.grid_sample(
+                level_image[None].expand(len(idx), -1, -1, -1),
+                grid,
+                mode="bilinear",
+                padding_mode="border",
+                align_corners=False
+            ))
+
+        if len(views) == 1:
+            return views[0]
+        # back to the order of the boxes
+        order = torch.argsort(torch.cat([torch.nonzero(levels == t).flatten() for t in targets]))
+        return torch.cat(views)[order]
+
+
+def _downscale2x(image):
+    """Average 2x2 blocks of a [C, H, W] tensor, dropping an odd last row
+    or column.
+    """
+    h, w = image.shape[-2] // 2 * 2, image.shape[-1] // 2 * 2
+    image = image[:, :h, :w]
+    return (image[:, 0::2, 0::2] + image[:, 0::2, 1::2] + image[:, 1::2, 0::2] + image[:, 1::2, 1::2]) * 0.25
+
+
+def build_multi_view_transform(cfg, choices=None):
+    """Build a MultiViewTransform equivalent to the training transform of
+    cfg, or return None if it uses transforms other than
+    MULTI_VIEW_CHOICES or an interpolation other than bilinear.
+
+    Args:
+        cfg (CfgNode): config.
+        choices (list, optional): list of strings which will overwrite
+            cfg.INPUT.TRANSFORMS if given. Default is None.
+    """
+    if choices is None:
+        choices = cfg.INPUT.TRANSFORMS
+
+    if cfg.INPUT.NO_TRANSFORM or "random_resized_crop" not in choices:
+        return None
+    if any(choice not in MULTI_VIEW_CHOICES for choice in choices):
+        return None
+    # views are resampled bilinearly by grid_sample
+    if cfg.INPUT.INTERPOLATION != "bilinear":
+        return None
+
+    normalize = "normalize" in choices
+    return MultiViewTransform(
+        cfg.INPUT.SIZE,
+        scale=cfg.INPUT.RRCROP_SCALE,
+        flip="random_flip" in choices,
+        mean=cfg.INPUT.PIXEL_MEAN if normalize else None,
+        std=cfg.INPUT.PIXEL_STD if normalize else None
+    )
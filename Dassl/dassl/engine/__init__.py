@@ -1,6 +1,18 @@
 from .build import TRAINER_REGISTRY, build_trainer  # isort:skip
 from .trainer import TrainerX, TrainerXU, TrainerBase, SimpleTrainer, SimpleNet  # isort:skip
 
-from .da import *
-from .dg import *
-from .ssl import *
+# the built-in trainers are imported when they are first requested
+TRAINER_REGISTRY.register_lazy("dassl.engine.da", [
+    "SE", "MCD", "MME", "ADDA", "CDAC", "DAEL", "DANN", "AdaBN", "M3SDA",
+    "SourceOnly"
+])
+TRAINER_REGISTRY.register_lazy("dassl.engine.dg", [
+    "DDAIG", "DAELDG", "Vanilla", "CrossGrad", "DomainMix"
+])
+TRAINER_REGISTRY.register_lazy("dassl.engine.ssl", [
+    "EntMin", "FixMatch", "MixMatch", "MeanTeacher", "SupBaseline"
+])
+
+
+def __getattr__(name):
+    return TRAINER_REGISTRY.get_attr(name, __name__)
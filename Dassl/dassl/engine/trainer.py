@@ -6,7 +6,6 @@ from collections import OrderedDict
 import torch
 import torch.nn as nn
 from tqdm import tqdm
-from torch.utils.tensorboard import SummaryWriter
 
 from dassl.data import DataManager
 from dassl.optim import build_optimizer, build_lr_scheduler
@@ -225,6 +224,8 @@ class TrainerBase:
     def init_writer(self, log_dir):
         if self.__dict__.get("_writer") is None or self._writer is None:
             print(f"Initialize tensorboard (log_dir={log_dir})")
+            # tensorboard is slow to import and not needed for evaluation
+            from torch.utils.tensorboard import SummaryWriter
             self._writer = SummaryWriter(log_dir=log_dir)
 
     def close_writer(self):
@@ -2,7 +2,6 @@ import numpy as np
 import os.path as osp
 from collections import OrderedDict, defaultdict
 import torch
-from sklearn.metrics import f1_score, confusion_matrix
 
 from .build import EVALUATOR_REGISTRY
 
@@ -68,6 +67,8 @@ class Classification(EvaluatorBase):
         results = OrderedDict()
         acc = 100.0 * self._correct / self._total
         err = 100.0 - acc
+        # sklearn is slow to import, only load it when results are computed
+        from sklearn.metrics import f1_score, confusion_matrix
         macro_f1 = 100.0 * f1_score(
             self._y_true,
             self._y_pred,
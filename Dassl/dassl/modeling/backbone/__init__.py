@@ -1,23 +1,47 @@
 from .build import build_backbone, BACKBONE_REGISTRY  # isort:skip
 from .backbone import Backbone  # isort:skip
 
-from .vgg import vgg16
-from .resnet import (
-    resnet18, resnet34, resnet50, resnet101, resnet152, resnet18_ms_l1,
-    resnet50_ms_l1, resnet18_ms_l12, resnet50_ms_l12, resnet101_ms_l1,
-    resnet18_ms_l123, resnet50_ms_l123, resnet101_ms_l12, resnet101_ms_l123,
-    resnet18_efdmix_l1, resnet50_efdmix_l1, resnet18_efdmix_l12,
-    resnet50_efdmix_l12, resnet101_efdmix_l1, resnet18_efdmix_l123,
-    resnet50_efdmix_l123, resnet101_efdmix_l12, resnet101_efdmix_l123
+# the built-in backbones are imported when they are first requested
+BACKBONE_REGISTRY.register_lazy("dassl.modeling.backbone.vgg", ["vgg16"])
+BACKBONE_REGISTRY.register_lazy("dassl.modeling.backbone.resnet", [
+    "resnet18", "resnet34", "resnet50", "resnet101", "resnet152",
+    "resnet18_ms_l1", "resnet50_ms_l1", "resnet18_ms_l12", "resnet50_ms_l12",
+    "resnet101_ms_l1", "resnet18_ms_l123", "resnet50_ms_l123",
+    "resnet101_ms_l12", "resnet101_ms_l123", "resnet18_efdmix_l1",
+    "resnet50_efdmix_l1", "resnet18_efdmix_l12", "resnet50_efdmix_l12",
+    "resnet101_efdmix_l1", "resnet18_efdmix_l123", "resnet50_efdmix_l123",
+    "resnet101_efdmix_l12", "resnet101_efdmix_l123"
+])
+BACKBONE_REGISTRY.register_lazy("dassl.modeling.backbone.alexnet", ["alexnet"])
+BACKBONE_REGISTRY.register_lazy(
+    "dassl.modeling.backbone.wide_resnet",
+    ["wide_resnet_16_4", "wide_resnet_28_2"]
 )
-from .alexnet import alexnet
-from .wide_resnet import wide_resnet_16_4, wide_resnet_28_2
-from .cnn_digitsdg import cnn_digitsdg
-from .efficientnet import (
-    efficientnet_b0, efficientnet_b1, efficientnet_b2, efficientnet_b3,
-    efficientnet_b4, efficientnet_b5, efficientnet_b6, efficientnet_b7
+BACKBONE_REGISTRY.register_lazy(
+    "dassl.modeling.backbone.cnn_digitsdg", ["cnn_digitsdg"]
 )
-from .resnet_dynamic import *
-from .cnn_digitsingle import cnn_digitsingle
-from .preact_resnet18 import preact_resnet18
-from .cnn_digit5_m3sda import cnn_digit5_m3sda
+BACKBONE_REGISTRY.register_lazy("dassl.modeling.backbone.efficientnet", [
+    "efficientnet_b0", "efficientnet_b1", "efficientnet_b2", "efficientnet_b3",
+    "efficientnet_b4", "efficientnet_b5", "efficientnet_b6", "efficientnet_b7"
+])
+BACKBONE_REGISTRY.register_lazy("dassl.modeling.backbone.resnet_dynamic", [
+    "resnet18_dynamic", "resnet50_dynamic", "resnet101_dynamic",
+    "resnet18_dynamic_ms_l123", "resnet18_dynamic_ms_l12",
+    "resnet18_dynamic_ms_l1", "resnet50_dynamic_ms_l123",
+    "resnet50_dynamic_ms_l12", "resnet50_dynamic_ms_l1",
+    "resnet101_dynamic_ms_l123", "resnet101_dynamic_ms_l12",
+    "resnet101_dynamic_ms_l1"
+])
+BACKBONE_REGISTRY.register_lazy(
+    "dassl.modeling.backbone.cnn_digitsingle", ["cnn_digitsingle"]
+)
+BACKBONE_REGISTRY.register_lazy(
+    "dassl.modeling.backbone.preact_resnet18", ["preact_resnet18"]
+)
+BACKBONE_REGISTRY.register_lazy(
+    "dassl.modeling.backbone.cnn_digit5_m3sda", ["cnn_digit5_m3sda"]
+)
+
+
+def __getattr__(name):
+    return BACKBONE_REGISTRY.get_attr(name, __name__)
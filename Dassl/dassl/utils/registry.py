@@ -1,6 +1,8 @@
 """
 Modified from https://github.com/facebookresearch/fvcore
 """
+import importlib
+
 __all__ = ["Registry"]
 
 
@@ -27,11 +29,19 @@ class Registry:
     .. code-block:: python
 
         BACKBONE_REGISTRY.register(MyBackbone)
+
+    Objects can also be registered lazily, the module defining them is then
+    only imported when one of them is requested:
+
+    .. code-block:: python
+
+        BACKBONE_REGISTRY.register_lazy('my_package.backbones', ['MyBackbone'])
     """
 
     def __init__(self, name):
         self._name = name
         self._obj_map = dict()
+        self._lazy_map = dict()
 
     def _do_register(self, name, obj, force=False):
         if name in self._obj_map and not force:
@@ -56,7 +66,16 @@ class Registry:
         name = obj.__name__
         self._do_register(name, obj, force=force)
 
+    def register_lazy(self, module, names):
+        """Register names of objects that module registers when it is imported."""
+        for name in names:
+            if name not in self._obj_map:
+                self._lazy_map[name] = module
+
     def get(self, name):
+        if name not in self._obj_map and name in self._lazy_map:
+            importlib.import_module(self._lazy_map[name])
+
         if name not in self._obj_map:
             raise KeyError(
                 'Object name "{}" does not exist '
@@ -65,5 +84,15 @@ class Registry:
 
         return self._obj_map[name]
 
+    def get_attr(self, name, package):
+        """Module-level __getattr__ of a package whose objects are registered lazily."""
+        if name in self._lazy_map or name in self._obj_map:
+            return self.get(name)
+        raise AttributeError(
+            "module '{}' has no attribute '{}'".format(package, name)
+        )
+
     def registered_names(self):
-        return list(self._obj_map.keys())
+        return list(self._obj_map.keys()) + [
+            name for name in self._lazy_map if name not in self._obj_map
+        ]
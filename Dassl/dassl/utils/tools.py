@@ -4,6 +4,7 @@ Modified from https://github.com/KaiyangZhou/deep-person-reid
 import os
 import sys
 import json
+import math
 import time
 import errno
 import numpy as np
@@ -108,16 +109,25 @@ def download_url(url, dst):
     sys.stdout.write("\n")
 
 
-def read_image(path):
+def read_image(path, draft_size=0):
     """Read image from path using ``PIL.Image``.
 
     Args:
-        path (str): path to an image.
+        path (str or file): path to an image, or a file object.
+        draft_size (int, optional): if positive, JPEGs are decoded at the
+            smallest reduced scale (1/2, 1/4 or 1/8) whose shorter side is
+            still at least draft_size. Default is 0 (full resolution).
 
     Returns:
         PIL image
     """
-    return Image.open(path).convert("RGB")
+    img = Image.open(path)
+    if draft_size > 0 and img.format == "JPEG":
+        scale = draft_size / min(img.size)
+        img.draft(
+            "RGB", (math.ceil(img.width * scale), math.ceil(img.height * scale))
+        )
+    return img.convert("RGB")
 
 
 def collect_env_info():
@@ -0,0 +1,156 @@
+"""Benchmark the attention backends of ResidualAttentionBlock
+(TRAINER.LOCALPROMPT.ATTN_BACKEND).
+
+Runs the CLIP VisionTransformer on a batch of images and the LOCALPROMPT
+TextEncoder on a set of prompts, with nn.MultiheadAttention ('mha') and
+with F.scaled_dot_product_attention ('sdpa', is_causal for text), in fp32
+and bf16. Outputs of the two backends are checked to match before they
+are timed: both outputs of the VisionTransformer (global features and the
+value-path local features), and the text features of mixed-length prompts.
+Weights are random, with ViT-B/16 dimensions by default.
+
+With --check, only the outputs are compared, on a small model: sdpa against
+mha for both vision outputs, and the text encoder with and without
+TEXT_CHUNK_SIZE (length-bucketed, trimmed chunks of mixed-length prompts)
+against unchunked mha. Nothing is timed.
+
+    python benchmarks/bench_attention.py --batch-size 32 --num-prompts 1000
+    python benchmarks/bench_attention.py --check
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+from clip_w_local.model import CLIP, set_attention_backend  # noqa: E402
+from trainers.localprompt import TextEncoder  # noqa: E402
+
+# maximum difference relative to the largest output value
+TOLERANCE = {torch.float32: 1e-4, torch.bfloat16: 5e-2}
+
+
+def build_inputs(args, model, dtype):
+    generator = torch.Generator().manual_seed(args.seed)
+    images = torch.randn(args.batch_size, 3, 224, 224, generator=generator, dtype=dtype)
+    width = model.ln_final.weight.shape[0]
+    prompts = torch.randn(args.num_prompts, 77, width, generator=generator, dtype=dtype) * 0.02
+    # prompt lengths of CLIP class names, the eot token has the highest id
+    tokenized_prompts = torch.zeros(args.num_prompts, 77, dtype=torch.long)
+    lengths = torch.randint(args.min_length, args.max_length + 1, (args.num_prompts,), generator=generator)
+    tokenized_prompts[torch.arange(args.num_prompts), lengths - 1] = 49407
+    return images, (prompts, tokenized_prompts)
+
+
+def max_error(reference, output):
+    '''
+    maximum difference relative to the largest reference value, over every output of a tuple.
+    '''
+    if not isinstance(reference, (tuple, list)):
+        reference, output = (reference,), (output,)
+    assert len(reference) == len(output)
+    return max(
+        ((r.float() - o.float()).abs().max() / r.float().abs().max()).item() for r, o in zip(reference, output)
+    )
+
+
+def build_model(args, dtype):
+    torch.manual_seed(args.seed)
+    model = CLIP(
+        512, 224, args.vision_layers, 768, 16,
+        77, 49408, 512, 8, args.text_layers
+    ).eval()
+    model.to(dtype)
+    for module in model.modules():
+        # like convert_weights, layer norms stay in fp32
+        if isinstance(module, torch.nn.LayerNorm):
+            module.float()
+    return model
+
+
+def check(args):
+    '''
+    compare the outputs of the backends and text chunk sizes, without timing.
+    '''
+    chunk_size = args.text_chunk_size or max(1, args.num_prompts // 3)
+    assert chunk_size < args.num_prompts, "--text-chunk-size must be smaller than --num-prompts to chunk"
+    for dtype in [torch.float32, torch.bfloat16]:
+        model = build_model(args, dtype)
+        images, text_inputs = build_inputs(args, model, dtype)
+        outputs = {}
+        with torch.no_grad():
+            for backend in ["mha", "sdpa"]:
+                set_attention_backend(model, backend)
+                outputs[backend, "vision"] = model.visual(images)
+                for size in [0, chunk_size]:
+                    outputs[backend, size] = TextEncoder(model, chunk_size=size)(*text_inputs)
+
+        for (backend, name), output in outputs.items():
+            reference = outputs["mha", "vision" if name == "vision" else 0]
+            if output is reference:
+                continue
+            error = max_error(reference, output)
+            label = "VisionTransformer" if name == "vision" else f"TextEncoder chunk {name}"
+            assert error < TOLERANCE[dtype], f"{label} {backend} {dtype}: output differs by {error:.2e}"
+            print(f"  {str(dtype)[6:]:8s} {label:22s} {backend:4s} max rel. diff {error:.1e}")
+    print("outputs match")
+
+
+def run(fn, inputs, repeats):
+    with torch.no_grad():
+        output = fn(*inputs)  # warmup
+        start = time.perf_counter()
+        for _ in range(repeats):
+            output = fn(*inputs)
+    return (time.perf_counter() - start) / repeats, output
+
+
+def main(args):
+    if args.check:
+        check(args)
+        return
+    print(f"{args.vision_layers}-layer ViT-B/16 on {args.batch_size} images, {args.text_layers}-layer text "
+          f"encoder on {args.num_prompts} prompts, {torch.get_num_threads()} threads")
+    for dtype in [torch.float32, torch.bfloat16]:
+        model = build_model(args, dtype)
+        text_encoder = TextEncoder(model, chunk_size=args.text_chunk_size)
+        images, text_inputs = build_inputs(args, model, dtype)
+        benches = {
+            "VisionTransformer": (model.visual, (images,)),
+            "TextEncoder": (text_encoder, text_inputs),
+        }
+        for name, (fn, inputs) in benches.items():
+            results = {}
+            for backend in ["mha", "sdpa"]:
+                set_attention_backend(model, backend)
+                results[backend] = run(fn, inputs, args.repeats)
+            (mha_time, mha_out), (sdpa_time, sdpa_out) = results["mha"], results["sdpa"]
+            error = max_error(mha_out, sdpa_out)
+            assert error < TOLERANCE[dtype], f"{name} {dtype}: sdpa output differs by {error:.2e}"
+            print(f"  {str(dtype)[6:]:8s} {name:17s} mha {mha_time * 1000:8.1f} ms  sdpa {sdpa_time * 1000:8.1f} ms  "
+                  f"speedup {mha_time / sdpa_time:.2f}x  (max rel. diff {error:.1e})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch-size", type=int, default=None, help="default 16, 4 with --check")
+    parser.add_argument("--num-prompts", type=int, default=None, help="default 200, 20 with --check")
+    parser.add_argument("--min-length", type=int, default=8, help="shortest prompt, in tokens")
+    parser.add_argument("--max-length", type=int, default=24, help="longest prompt, in tokens")
+    parser.add_argument("--vision-layers", type=int, default=None, help="default 12, 2 with --check")
+    parser.add_argument("--text-layers", type=int, default=None, help="default 12, 2 with --check")
+    parser.add_argument("--text-chunk-size", type=int, default=0, help="TEXT_CHUNK_SIZE of the text encoder")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--check", action="store_true",
+                        help="only compare the outputs, on a small model by default")
+    args = parser.parse_args()
+    # a small model for --check
+    defaults = {"batch_size": (16, 4), "num_prompts": (200, 20), "vision_layers": (12, 2), "text_layers": (12, 2)}
+    for name, (default, check_default) in defaults.items():
+        if getattr(args, name) is None:
+            setattr(args, name, check_default if args.check else default)
+    main(args)
@@ -0,0 +1,113 @@
+"""Benchmark CLIP weight loading: the checkpoint path against the memory-mapped weight cache.
+
+'checkpoint' is the previous load_clip_to_cpu: hash the whole checkpoint, load it, build the model with
+fp16 weights and convert them to fp32 for amp. 'cached' maps the fp32 weights written by clip.load_weights
+and builds the model on them without copies. The cache is written once before timing. Every load runs in a
+fresh process to measure its peak RSS, before and after reading all weights once (as a move to the GPU does).
+
+Without --checkpoint a randomly initialized CLIP of the backbone's dimensions is saved as a state dict.
+The released checkpoints are JIT archives, which take longer to load, so their 'checkpoint' times are higher.
+
+    python benchmarks/bench_clip_load.py --backbone RN50 ViT-B/16
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import hashlib
+import resource
+import subprocess
+import tempfile
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from clip_w_local import clip  # noqa: E402
+from clip_w_local.model import CLIP, convert_weights  # noqa: E402
+
+
+# embed_dim, image_resolution, vision_layers, vision_width, vision_patch_size, transformer_width, transformer_heads
+BACKBONES = {
+    "ViT-B/16": (512, 224, 12, 768, 16, 512, 8),
+    "RN50": (1024, 224, (3, 4, 6, 3), 64, None, 512, 8),
+}
+
+
+def peak_rss_mib():
+    # ru_maxrss of a child starts at the peak of the forked parent on Linux, VmHWM is reset on exec
+    if os.path.isfile("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def load(method, checkpoint, cache_dir):
+    start = time.perf_counter()
+    if method == "checkpoint":
+        hashlib.sha256(open(checkpoint, "rb").read()).hexdigest()
+        model = clip.build_model(clip._load_state_dict(checkpoint)).float()
+    else:
+        model = clip.build_model(clip.load_weights(checkpoint, torch.float32, cache_dir=cache_dir), assign=True)
+    load_time = time.perf_counter() - start
+    load_rss = peak_rss_mib()
+
+    with torch.no_grad():
+        checksum = sum(float(p.double().sum()) for p in model.parameters())
+    return {"time": load_time, "rss": load_rss, "rss_read": peak_rss_mib(), "checksum": checksum}
+
+
+def run_worker(method, checkpoint, cache_dir):
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), "--worker", method, checkpoint, cache_dir],
+                            check=True, capture_output=True, text=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def bench(args, backbone, workdir):
+    checkpoint = args.checkpoint
+    if not checkpoint:
+        embed_dim, resolution, vision_layers, vision_width, patch_size, width, heads = BACKBONES[backbone]
+        model = CLIP(embed_dim, resolution, vision_layers, vision_width, patch_size, 77, 49408, width, heads, 12)
+        convert_weights(model)  # as released
+        checkpoint = os.path.join(workdir, backbone.replace("/", "-") + ".pt")
+        torch.save(model.state_dict(), checkpoint)
+        del model
+    cache_dir = os.path.join(workdir, "weights")
+
+    start = time.perf_counter()
+    clip.load_weights(checkpoint, torch.float32, cache_dir=cache_dir)
+    print(f"{backbone}: {os.path.getsize(checkpoint) / 2 ** 20:.0f} MiB checkpoint, "
+          f"cache written in {time.perf_counter() - start:.2f} s")
+
+    results = {}
+    for method in ["checkpoint", "cached"]:
+        runs = [run_worker(method, checkpoint, cache_dir) for _ in range(args.repeats)]
+        best = min(runs, key=lambda r: r["time"])
+        results[method] = best
+        print(f"  {method:10s} {best['time']:6.2f} s  peak RSS {best['rss']:7.0f} MiB, "
+              f"{best['rss_read']:7.0f} MiB after reading all weights")
+    assert abs(results["checkpoint"]["checksum"] - results["cached"]["checksum"]) < 1e-3, "weights differ"
+    print(f"  speedup: {results['checkpoint']['time'] / results['cached']['time']:.1f}x")
+
+
+def main(args):
+    if args.checkpoint and len(args.backbone) > 1:
+        raise ValueError("--checkpoint is for a single backbone")
+    with tempfile.TemporaryDirectory() as workdir:
+        for backbone in args.backbone:
+            bench(args, backbone, workdir)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 5 and sys.argv[1] == "--worker":
+        print(json.dumps(load(*sys.argv[2:])))
+        sys.exit()
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", type=str, nargs="+", default=["RN50", "ViT-B/16"], choices=list(BACKBONES))
+    parser.add_argument("--checkpoint", type=str, default="", help="a released CLIP checkpoint of the backbone")
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+    main(args)
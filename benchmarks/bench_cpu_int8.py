@@ -0,0 +1,162 @@
+"""Benchmark CPU inference of the OOD scores in fp32 and with int8
+dynamic quantization (TRAINER.LOCALPROMPT.INT8).
+
+Scores a fixed sample of ID and OOD images with the MCM and the
+Local-Prompt score, once with the fp32 image encoder and text features
+and once with quantize_int8() and Int8TextFeatures, and reports
+images/s and the AUROC/FPR95 delta of int8 against fp32.
+
+By default the weights are random (ViT-B/16 dimensions), the text
+features are random unit vectors and the ID/OOD images are smooth and
+noisy random JPEGs, so only the speed is representative. With --arch
+and --root, CLIP is loaded and the images are read from the directories
+under --root. The first directory is the ID set, and "a photo of a
+<class>." prompts of its folders stand in for the global and local
+prompts.
+
+    python benchmarks/bench_cpu_int8.py --num-images 64
+    python benchmarks/bench_cpu_int8.py --arch ViT-B/16 --root /data imagenet/val iNaturalist
+"""
+import os
+import io
+import sys
+import time
+import copy
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import datasets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+from clip_w_local import clip  # noqa: E402
+from clip_w_local.model import CLIP, quantize_int8  # noqa: E402
+from utils.ood_score import Int8TextFeatures, mcm_score, local_prompt_local_score, text_logits  # noqa: E402
+from utils.detection_util import get_measures  # noqa: E402
+
+
+def random_images(args, rng, block):
+    # ID: smooth content, OOD: blocky noise
+    images = []
+    for _ in range(args.num_images):
+        small = rng.integers(0, 256, (args.height // block, args.width // block, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((args.width, args.height), Image.BICUBIC if block > 8 else Image.NEAREST)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        images.append(Image.open(io.BytesIO(buffer.getvalue())).convert("RGB"))
+    return images
+
+
+def folder_images(args, directory):
+    samples = datasets.ImageFolder(os.path.join(args.root, directory)).samples
+    step = max(1, len(samples) // args.num_images)
+    return [Image.open(path).convert("RGB") for path, _ in samples[::step][:args.num_images]]
+
+
+def build_text_features(args, model):
+    if args.arch:
+        classnames = datasets.ImageFolder(os.path.join(args.root, args.directories[0])).classes
+        with torch.no_grad():
+            text_features = model.encode_text(clip.tokenize([f"a photo of a {c}." for c in classnames])).float()
+        text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+        global_text_features = local_text_features = text_features
+    else:
+        generator = torch.Generator().manual_seed(args.seed)
+        global_text_features = torch.randn(args.num_classes, model.text_projection.shape[1], generator=generator)
+        global_text_features = global_text_features / global_text_features.norm(dim=-1, keepdim=True)
+        local_text_features = global_text_features
+    generator = torch.Generator().manual_seed(args.seed + 1)
+    neg_text_features = torch.randn(args.num_neg, local_text_features.shape[1], generator=generator)
+    neg_text_features = neg_text_features / neg_text_features.norm(dim=-1, keepdim=True)
+    return global_text_features, local_text_features, neg_text_features
+
+
+@torch.no_grad()
+def score(args, visual, text_features, images, logit_scale):
+    global_text_features, local_text_features, neg_text_features = text_features
+    mcm, local_prompt = [], []
+    for start in range(0, len(images), args.batch_size):
+        image_features, local_image_features = visual(images[start:start + args.batch_size])
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        local_image_features = local_image_features / local_image_features.norm(dim=-1, keepdim=True)
+        # the scoring of LOCALPROMPT.score_ood()
+        output = text_logits(logit_scale * image_features, global_text_features) / 100.0
+        global_score = mcm_score(output, args.T)
+        local_score = local_prompt_local_score(local_image_features, local_text_features, neg_text_features,
+                                               logit_scale, args.top_k, args.T, chunk_size=args.chunk_size)
+        mcm.append(global_score)
+        local_prompt.append(global_score + local_score)
+    return torch.cat(mcm).numpy(), torch.cat(local_prompt).numpy()
+
+
+def evaluate(args, visual, text_features, id_images, ood_sets, logit_scale):
+    start = time.perf_counter()
+    id_scores = score(args, visual, text_features, id_images, logit_scale)
+    ood_scores = {name: score(args, visual, text_features, images, logit_scale) for name, images in ood_sets.items()}
+    rate = (len(id_images) + sum(len(images) for images in ood_sets.values())) / (time.perf_counter() - start)
+    results = {}
+    for name, scores in ood_scores.items():
+        for i, method in enumerate(["MCM", "Local-Prompt"]):
+            # scores are negative, like get_and_print_results()
+            auroc, _, fpr = get_measures(-id_scores[i], -scores[i])
+            results[f"{name} {method}"] = (auroc * 100, fpr * 100)
+    return rate, results
+
+
+def main(args):
+    torch.set_num_threads(args.threads)
+    rng = np.random.default_rng(args.seed)
+    if args.arch:
+        model, preprocess = clip.load(args.arch, device="cpu")
+        model.float().eval()
+        id_images = folder_images(args, args.directories[0])
+        ood_sets = {directory: folder_images(args, directory) for directory in args.directories[1:]}
+    else:
+        torch.manual_seed(args.seed)
+        model = CLIP(512, 224, 12, 768, 16, 77, 49408, 512, 8, 1).eval()
+        preprocess = clip._transform(224)
+        id_images = random_images(args, rng, 16)
+        ood_sets = {"noise": random_images(args, rng, 2)}
+    to_tensor = lambda images: torch.stack([preprocess(image) for image in images])
+    id_images = to_tensor(id_images)
+    ood_sets = {name: to_tensor(images) for name, images in ood_sets.items()}
+
+    logit_scale = model.logit_scale.exp().detach()
+    text_features = build_text_features(args, model)
+    int8_visual = quantize_int8(copy.deepcopy(model.visual))
+    int8_text_features = tuple(Int8TextFeatures(t, args.chunk_size) for t in text_features)
+
+    fp32_rate, fp32_results = evaluate(args, model.visual, text_features, id_images, ood_sets, logit_scale)
+    int8_rate, int8_results = evaluate(args, int8_visual, int8_text_features, id_images, ood_sets, logit_scale)
+
+    print(f"{len(id_images)} ID images, {len(ood_sets)} OOD set(s) of {args.num_images} images, "
+          f"{torch.get_num_threads()} threads")
+    print(f"  fp32  {fp32_rate:7.2f} images/s")
+    print(f"  int8  {int8_rate:7.2f} images/s")
+    print(f"  speedup: {int8_rate / fp32_rate:.2f}x")
+    for name in fp32_results:
+        (auroc, fpr), (int8_auroc, int8_fpr) = fp32_results[name], int8_results[name]
+        print(f"  {name:28s} AUROC {auroc:6.2f} -> {int8_auroc:6.2f} ({int8_auroc - auroc:+.2f})  "
+              f"FPR95 {fpr:6.2f} -> {int8_fpr:6.2f} ({int8_fpr - fpr:+.2f})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--arch", type=str, default="", help="CLIP model, random ViT-B/16 weights if not given")
+    parser.add_argument("--root", type=str, default="", help="image directories for --arch")
+    parser.add_argument("--num-images", type=int, default=64, help="images per set")
+    parser.add_argument("--num-classes", type=int, default=1000, help="classes of the random text features")
+    parser.add_argument("--num-neg", type=int, default=300, help="negative local prompts")
+    parser.add_argument("--width", type=int, default=500)
+    parser.add_argument("--height", type=int, default=375)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--chunk-size", type=int, default=128, help="SCORE_CHUNK_SIZE")
+    parser.add_argument("--top-k", type=int, default=10)
+    parser.add_argument("--T", type=float, default=1.0)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("directories", nargs="*", help="directories under --root, the first is the ID set")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,157 @@
+"""Benchmark reduced-resolution JPEG decoding (--draft-decode,
+INPUT.DRAFT_DECODE) against full-resolution decoding.
+
+Times the OOD evaluation preprocessing (read_image, then CLIP's
+Resize/CenterCrop/ToTensor/Normalize) in one process, like one data loader
+worker, and reports the mean absolute difference of the preprocessed
+tensors. Images are random JPEGs unless --root is given.
+
+With --root and --arch, the held-out subset (--num-eval images per set)
+is also scored zero-shot with CLIP, and the ID accuracy and the MCM AUROC
+of each OOD set are compared between the two decoders.
+
+    python benchmarks/bench_draft_decode.py --width 500 --height 375
+    python benchmarks/bench_draft_decode.py --root /data --arch ViT-B/16 \\
+        --classnames /data/imagenet/classnames.txt imagenet/val iNaturalist SUN Places dtd/images
+"""
+import os
+import io
+import sys
+import time
+import argparse
+import functools
+
+import numpy as np
+import torch
+from PIL import Image
+from torchvision import datasets
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+from dassl.utils import read_image  # noqa: E402
+from clip_w_local import clip  # noqa: E402
+from utils.detection_util import get_measures  # noqa: E402
+
+
+def random_images(args):
+    rng = np.random.default_rng(args.seed)
+    images = []
+    for _ in range(args.num_images):
+        # smooth random content, so the JPEG is not dominated by noise
+        small = rng.integers(0, 256, (args.height // 16, args.width // 16, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((args.width, args.height), Image.BICUBIC)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def folder_images(args):
+    images = []
+    for directory in args.directories:
+        samples = datasets.ImageFolder(os.path.join(args.root, directory)).samples
+        step = max(1, len(samples) // args.num_images)
+        for path, _ in samples[::step][:args.num_images]:
+            with open(path, "rb") as f:
+                images.append(f.read())
+    return images
+
+
+def bench_decode(images, preprocess, draft_size, repeats):
+    start = time.perf_counter()
+    for _ in range(repeats):
+        tensors = [preprocess(read_image(io.BytesIO(data), draft_size)) for data in images]
+    return len(images) * repeats / (time.perf_counter() - start), torch.stack(tensors)
+
+
+def subset(args, directory, preprocess, draft_size):
+    dataset = datasets.ImageFolder(
+        os.path.join(args.root, directory),
+        transform=preprocess,
+        loader=functools.partial(read_image, draft_size=draft_size)
+    )
+    # a fixed, evenly spaced subset of each set
+    step = max(1, len(dataset) // args.num_eval)
+    indices = list(range(0, len(dataset), step))[:args.num_eval]
+    return dataset, torch.utils.data.Subset(dataset, indices)
+
+
+@torch.no_grad()
+def score(model, text_features, dataset, args):
+    loader = torch.utils.data.DataLoader(dataset, batch_size=args.batch_size, num_workers=args.num_workers)
+    probs, labels = [], []
+    for images, targets in loader:
+        image_features = model.encode_image(images)[0].float()
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        probs.append((100.0 * image_features @ text_features.T).softmax(dim=-1))
+        labels.append(targets)
+    return torch.cat(probs), torch.cat(labels)
+
+
+def evaluate(args, model, preprocess, draft_size):
+    # the first directory is the ID set, the others are OOD sets
+    id_dataset, id_subset = subset(args, args.directories[0], preprocess, draft_size)
+    if args.classnames:
+        names = dict(line.strip().split(" ", 1) for line in open(args.classnames) if line.strip())
+        classnames = [names[folder] for folder in id_dataset.classes]
+    else:
+        classnames = id_dataset.classes
+    text = clip.tokenize([f"a photo of a {c}." for c in classnames])
+    with torch.no_grad():
+        text_features = model.encode_text(text).float()
+    text_features = text_features / text_features.norm(dim=-1, keepdim=True)
+
+    id_probs, id_labels = score(model, text_features, id_subset, args)
+    results = {"accuracy": (id_probs.argmax(dim=-1) == id_labels).float().mean().item() * 100}
+    for directory in args.directories[1:]:
+        ood_probs, _ = score(model, text_features, subset(args, directory, preprocess, draft_size)[1], args)
+        # MCM: maximum softmax probability, ID is the positive class
+        auroc, _, _ = get_measures(id_probs.max(dim=-1)[0].numpy(), ood_probs.max(dim=-1)[0].numpy())
+        results[f"AUROC {directory}"] = auroc * 100
+    return results
+
+
+def main(args):
+    torch.set_num_threads(1)  # like a data loader worker
+    preprocess = clip._transform(args.size)
+    images = folder_images(args) if args.root else random_images(args)
+
+    full_rate, full = bench_decode(images, preprocess, 0, args.repeats)
+    draft_rate, draft = bench_decode(images, preprocess, args.size, args.repeats)
+    print(f"{len(images)} images, preprocessing to {args.size}x{args.size}, 1 thread")
+    print(f"  full decode   {full_rate:7.1f} images/s")
+    print(f"  draft decode  {draft_rate:7.1f} images/s")
+    print(f"  speedup: {draft_rate / full_rate:.2f}x")
+    print(f"  mean abs difference of normalized inputs: {(full - draft).abs().mean().item():.4f}")
+
+    if args.root and args.arch:
+        torch.set_num_threads(args.threads)
+        model, _ = clip.load(args.arch, device="cpu")
+        model.eval()
+        full_results = evaluate(args, model, preprocess, 0)
+        draft_results = evaluate(args, model, preprocess, args.size)
+        print(f"held-out subset, {args.num_eval} images per set")
+        for name in full_results:
+            delta = draft_results[name] - full_results[name]
+            print(f"  {name:28s} full {full_results[name]:6.2f}  draft {draft_results[name]:6.2f}  "
+                  f"delta {delta:+.2f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default="", help="benchmark on the directories under this root")
+    parser.add_argument("--arch", type=str, default="", help="CLIP model for the accuracy/AUROC comparison")
+    parser.add_argument("--classnames", type=str, default="", help="<folder> <class name> lines of the ID set")
+    parser.add_argument("--num-images", type=int, default=200, help="images timed (per directory with --root)")
+    parser.add_argument("--num-eval", type=int, default=1000, help="held-out images per set")
+    parser.add_argument("--width", type=int, default=500)
+    parser.add_argument("--height", type=int, default=375)
+    parser.add_argument("--size", type=int, default=224)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-workers", type=int, default=4)
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads())
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("directories", nargs="*", help="directories under --root, the first is the ID set")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,110 @@
+"""Benchmark reading images from an image shard store against reading
+their original files.
+
+Times loading and preprocessing images the way the OOD evaluation
+loaders do (open, decode, Resize(224), CenterCrop(224), ToTensor) in
+one process, in the packed order. Images are random JPEGs of ImageNet's
+average size unless --root and directories are given. With
+--drop-caches (needs root) the page cache is dropped before each pass,
+so the files are read from disk.
+
+    python benchmarks/bench_image_shards.py --num-images 2000
+    python benchmarks/bench_image_shards.py --root /data imagenet/val
+"""
+import os
+import io
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+from dassl.data.image_shards import ImageShards, list_images, pack_image_shards  # noqa: E402
+from dassl.utils import read_image  # noqa: E402
+
+
+def write_images(args, root):
+    rng = np.random.default_rng(args.seed)
+    directory = os.path.join(root, "images")
+    os.makedirs(directory)
+    for i in range(args.num_images):
+        # smooth random content, so the JPEG is not dominated by noise
+        small = rng.integers(0, 256, (args.height // 16, args.width // 16, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((args.width, args.height), Image.BICUBIC)
+        image.save(os.path.join(directory, f"{i:06d}.JPEG"), quality=90)
+    return ["images"]
+
+
+def drop_caches():
+    os.sync()
+    with open("/proc/sys/vm/drop_caches", "w") as f:
+        f.write("3\n")
+
+
+def bench(read, paths, preprocess, args):
+    if args.drop_caches:
+        drop_caches()
+    start = time.perf_counter()
+    for path in paths:
+        image = preprocess(read(path))
+    assert image.shape == (3, 224, 224)
+    return (time.perf_counter() - start) / len(paths)
+
+
+def main(args):
+    torch.set_num_threads(1)  # like a data loader worker
+    work_dir = tempfile.mkdtemp(dir=args.work_dir)
+    try:
+        if args.root:
+            root, directories = args.root, args.directories
+        else:
+            root, directories = work_dir, write_images(args, work_dir)
+        paths = []
+        for directory in directories:
+            paths.extend(list_images(os.path.join(root, directory)))
+        paths = paths[:args.num_images]
+
+        store = os.path.join(work_dir, "shards")
+        start = time.perf_counter()
+        pack_image_shards(root, directories, store, short_side=args.short_side, num_workers=args.num_workers)
+        print(f"packing: {time.perf_counter() - start:.1f}s")
+        shards = ImageShards(store)
+
+        preprocess = transforms.Compose([
+            transforms.Resize(224, interpolation=transforms.InterpolationMode.BICUBIC),
+            transforms.CenterCrop(224),
+            transforms.ToTensor(),
+        ])
+        file_bytes = sum(os.path.getsize(path) for path in paths)
+        shard_bytes = sum(int(shards.locations[shards.locate(path), 2]) for path in paths)
+        print(f"{len(paths)} images, {file_bytes / 2 ** 20:.1f} MiB as files, "
+              f"{shard_bytes / 2 ** 20:.1f} MiB in shards (short side {args.short_side})")
+        file_time = bench(read_image, paths, preprocess, args)
+        shard_time = bench(shards.read_image, paths, preprocess, args)
+        print(f"  files   {file_time * 1000:7.2f} ms/image")
+        print(f"  shards  {shard_time * 1000:7.2f} ms/image")
+        print(f"  speedup: {file_time / shard_time:.2f}x")
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default="", help="benchmark on the directories under this root")
+    parser.add_argument("--num-images", type=int, default=1000)
+    parser.add_argument("--width", type=int, default=500)
+    parser.add_argument("--height", type=int, default=375)
+    parser.add_argument("--short-side", type=int, default=256)
+    parser.add_argument("--num-workers", type=int, default=4, help="processes that pack the store")
+    parser.add_argument("--drop-caches", action="store_true", help="read from disk, needs root")
+    parser.add_argument("--work-dir", type=str, default=None, help="where the images and the store are written")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("directories", nargs="*", help="directories under --root")
+    args = parser.parse_args()
+    main(args)
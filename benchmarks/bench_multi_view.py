@@ -0,0 +1,100 @@
+"""Benchmark the multi-view training augmentation of DatasetWrapper.
+
+Times producing NUM_VIEWS augmented views of one image, the work a data
+loader worker does per training sample, with the PIL transform applied
+once per view (random_resized_crop, random_flip, normalize) and with the
+batched MultiViewTransform (DATALOADER.BATCHED_VIEWS). Images are random
+JPEGs of ImageNet's average size unless --image is given, decoding is
+included in both.
+
+    python benchmarks/bench_multi_view.py --num-views 16
+"""
+import os
+import io
+import sys
+import time
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+from dassl.config import get_cfg_default  # noqa: E402
+from dassl.data.transforms import build_transform, build_multi_view_transform  # noqa: E402
+
+
+def build_cfg(args):
+    cfg = get_cfg_default()
+    cfg.INPUT.SIZE = (args.size, args.size)
+    # the only interpolation of the batched transform, both paths compute the same augmentation
+    cfg.INPUT.INTERPOLATION = "bilinear"
+    cfg.INPUT.PIXEL_MEAN = [0.48145466, 0.4578275, 0.40821073]
+    cfg.INPUT.PIXEL_STD = [0.26862954, 0.26130258, 0.27577711]
+    cfg.INPUT.TRANSFORMS = ["random_resized_crop", "random_flip", "normalize"]
+    return cfg
+
+
+def load_images(args):
+    if args.image:
+        with open(args.image, "rb") as f:
+            return [f.read()]
+    rng = np.random.default_rng(args.seed)
+    images = []
+    for _ in range(args.num_images):
+        # smooth random content, so the JPEG is not dominated by noise
+        small = rng.integers(0, 256, (args.height // 16, args.width // 16, 3), dtype=np.uint8)
+        image = Image.fromarray(small).resize((args.width, args.height), Image.BICUBIC)
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+
+def pil_views(tfm, data, num_views):
+    img0 = Image.open(io.BytesIO(data)).convert("RGB")
+    return torch.stack([tfm(img0) for _ in range(num_views)])
+
+
+def batched_views(tfm, data, num_views):
+    img0 = Image.open(io.BytesIO(data)).convert("RGB")
+    return tfm(img0, num_views)
+
+
+def bench(fn, tfm, images, num_views, repeats):
+    fn(tfm, images[0], num_views)  # warmup
+    start = time.perf_counter()
+    for _ in range(repeats):
+        for data in images:
+            views = fn(tfm, data, num_views)
+    return (time.perf_counter() - start) / (repeats * len(images)), views
+
+
+def main(args):
+    torch.set_num_threads(1)  # like a data loader worker
+    cfg = build_cfg(args)
+    images = load_images(args)
+    pil_tfm = build_transform(cfg, is_train=True)
+    batched_tfm = build_multi_view_transform(cfg)
+
+    print(f"{len(images)} images, {args.num_views} views of {args.size}x{args.size}, 1 thread")
+    pil_time, pil_out = bench(pil_views, pil_tfm, images, args.num_views, args.repeats)
+    batched_time, batched_out = bench(batched_views, batched_tfm, images, args.num_views, args.repeats)
+    assert pil_out.shape == batched_out.shape
+    print(f"  PIL per view  {pil_time * 1000:7.1f} ms/image")
+    print(f"  batched       {batched_time * 1000:7.1f} ms/image")
+    print(f"  speedup: {pil_time / batched_time:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--image", type=str, default="", help="benchmark on this image instead of random JPEGs")
+    parser.add_argument("--num-images", type=int, default=8)
+    parser.add_argument("--width", type=int, default=500)
+    parser.add_argument("--height", type=int, default=375)
+    parser.add_argument("--size", type=int, default=224)
+    parser.add_argument("--num-views", type=int, default=16)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,88 @@
+"""Benchmark the sort-once OOD metrics against the per-call sklearn path.
+
+Simulates ImageNet-scale evaluation: 50k ID scores and 10k scores for each of
+the four OOD sets, scored by MCM and Local-Prompt, plus a T/top_k grid
+evaluated as one stacked 2-D array.
+
+    python benchmarks/bench_ood_metrics.py
+"""
+import os
+import sys
+import time
+import argparse
+
+import numpy as np
+import sklearn.metrics as sk
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from utils.detection_util import fpr_and_fdr_at_recall, get_measures_batch  # noqa: E402
+
+
+def get_measures_sklearn(_pos, _neg, recall_level=0.95):
+    pos = np.array(_pos[:]).reshape((-1, 1))
+    neg = np.array(_neg[:]).reshape((-1, 1))
+    examples = np.squeeze(np.vstack((pos, neg)))
+    labels = np.zeros(len(examples), dtype=np.int32)
+    labels[:len(pos)] += 1
+
+    auroc = sk.roc_auc_score(labels, examples)
+    aupr = sk.average_precision_score(labels, examples)
+    fpr = fpr_and_fdr_at_recall(labels, examples, recall_level)
+
+    return auroc, aupr, fpr
+
+
+def timeit(fn, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, out
+
+
+def main(args):
+    rng = np.random.default_rng(args.seed)
+    num_sets, num_scores = 4, 2
+    # scores rounded to float32 like the ones produced by test_ood, with some ties
+    in_scores = rng.normal(0.5, 1.0, (num_scores, args.num_id)).astype(np.float32)
+    out_scores = rng.normal(0.0, 1.0, (num_sets, num_scores, args.num_ood)).astype(np.float32)
+
+    def reference():
+        return [[get_measures_sklearn(in_scores[s], out_scores[d, s]) for s in range(num_scores)] for d in range(num_sets)]
+
+    def engine():
+        pos = np.broadcast_to(in_scores, (num_sets, num_scores, args.num_id))
+        return get_measures_batch(pos, out_scores)
+
+    t_ref, ref = timeit(reference, args.repeat)
+    t_new, (auroc, aupr, fpr) = timeit(engine, args.repeat)
+
+    ref = np.array(ref)
+    err = np.abs(ref - np.stack([auroc, aupr, fpr[..., 0]], axis=-1)).max()
+    print(f"{num_sets} OOD sets x {num_scores} scores, {args.num_id} ID + {args.num_ood} OOD samples each")
+    print(f"  sklearn + fpr_and_fdr_at_recall: {t_ref * 1000:.1f} ms")
+    print(f"  get_measures_batch:              {t_new * 1000:.1f} ms  ({t_ref / t_new:.1f}x), max abs diff {err:.2e}")
+
+    # a T x top_k sweep of one OOD set, stacked as a 2-D array of score vectors
+    grid = args.grid
+    in_grid = rng.normal(0.5, 1.0, (grid, args.num_id)).astype(np.float32)
+    out_grid = rng.normal(0.0, 1.0, (grid, args.num_ood)).astype(np.float32)
+
+    t_ref, ref = timeit(lambda: [get_measures_sklearn(in_grid[g], out_grid[g]) for g in range(grid)], args.repeat)
+    t_new, (auroc, aupr, fpr) = timeit(lambda: get_measures_batch(in_grid, out_grid, recall_levels=(0.9, 0.95)), args.repeat)
+    err = np.abs(np.array(ref) - np.stack([auroc, aupr, fpr[:, 1]], axis=-1)).max()
+    print(f"grid of {grid} score vectors, recall levels 0.90 and 0.95")
+    print(f"  sklearn + fpr_and_fdr_at_recall: {t_ref * 1000:.1f} ms")
+    print(f"  get_measures_batch:              {t_new * 1000:.1f} ms  ({t_ref / t_new:.1f}x), max abs diff {err:.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num-id", type=int, default=50000, help="number of ID samples")
+    parser.add_argument("--num-ood", type=int, default=10000, help="number of samples per OOD set")
+    parser.add_argument("--grid", type=int, default=24, help="number of score vectors in the T/top_k grid")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,123 @@
+"""Benchmark the startup of an OOD inference process: the trainer against the
+exported scorer (export_scorer.py, utils/scorer.py).
+
+'trainer' is the deployment without the export: build the cfg and the Dassl
+trainer (CLIP weights, dataset, prompt learner), load_model() and score a
+batch with encode_image_features() and score_ood(). 'scorer' loads the
+TorchScript archive with torch.jit.load() and scores the same batch. Each runs
+in a fresh process, the time is measured from the start of the process to the
+first scores, with the interpreter and imports, and the peak RSS at that point
+is reported. The scores of both are compared.
+
+The arguments after -- are those of export_scorer.py, the scorer is exported
+to --scorer first if it does not exist.
+
+    python benchmarks/bench_scorer_startup.py --scorer scorer.pt -- --root data --trainer LOCALPROMPT \\
+        --dataset-config-file configs/datasets/imagenet.yaml --config-file configs/trainers/LOCALPROMPT/vit_b16_ep30.yaml \\
+        --model-dir output/imagenet/LOCALPROMPT/seed1 --load-epoch 30 USE_CUDA False
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import subprocess
+
+import numpy as np
+import torch
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def peak_rss_mib():
+    # ru_maxrss of a child starts at the peak of the forked parent on Linux, VmHWM is reset on exec
+    if os.path.isfile("/proc/self/status"):
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def trainer_scores(args, images):
+    sys.path.insert(0, REPO)
+    sys.path.insert(0, os.path.join(REPO, "Dassl"))
+    from dassl.engine import build_trainer
+    import export_scorer
+
+    export_args = export_scorer.parse_args(["--output", args.scorer] + args.export_args)
+    cfg = export_scorer.setup_cfg(export_args)
+    trainer = build_trainer(cfg)
+    trainer.load_model(export_args.model_dir, epoch=export_args.load_epoch)
+    trainer.model.training = False
+    trainer.model.eval()
+    with torch.no_grad():
+        image_features, local_image_features = trainer.model.encode_image_features(images.to(trainer.device))
+        mcm_score, local_score = trainer.score_ood(image_features, local_image_features, export_args.top_k, export_args.T)
+    return mcm_score, mcm_score + local_score
+
+
+def scorer_scores(args, images):
+    scorer = torch.jit.load(args.scorer, map_location="cpu" if args.cpu else None)
+    with torch.no_grad():
+        mcm_score, local_prompt_score = scorer(images.to(scorer.global_text_features.device))
+    return mcm_score.cpu().numpy(), local_prompt_score.cpu().numpy()
+
+
+def worker(args):
+    torch.manual_seed(args.seed)
+    images = torch.randn(args.batch_size, 3, args.size, args.size)
+    fn = trainer_scores if args.worker == "trainer" else scorer_scores
+    mcm_score, local_prompt_score = fn(args, images)
+    print(json.dumps({
+        "rss": peak_rss_mib(),
+        "scores": np.stack([mcm_score, local_prompt_score]).tolist(),
+    }))
+
+
+def run(args, mode):
+    command = [sys.executable, os.path.abspath(__file__), "--worker", mode, "--scorer", args.scorer,
+               "--batch-size", str(args.batch_size), "--size", str(args.size), "--seed", str(args.seed)]
+    if args.cpu:
+        command.append("--cpu")
+    start = time.perf_counter()
+    output = subprocess.run(command + ["--"] + args.export_args, check=True, capture_output=True, text=True).stdout
+    result = json.loads(output.strip().splitlines()[-1])
+    result["wall"] = time.perf_counter() - start
+    return result
+
+
+def main(args):
+    if not os.path.isfile(args.scorer):
+        subprocess.run([sys.executable, os.path.join(REPO, "export_scorer.py"), "--output", args.scorer] + args.export_args,
+                       check=True, cwd=REPO)
+
+    results = {mode: [run(args, mode) for _ in range(args.repeats)] for mode in ["trainer", "scorer"]}
+    print(f"time to the first scores of {args.batch_size} images, in a fresh process, best of {args.repeats}")
+    for mode, runs in results.items():
+        best = min(runs, key=lambda r: r["wall"])
+        print(f"  {mode:8s} {best['wall']:6.2f} s  peak RSS {best['rss']:8.1f} MiB")
+    trainer, scorer = results["trainer"][0], results["scorer"][0]
+    print(f"  speedup: {trainer['wall'] / scorer['wall']:.2f}x, memory: {scorer['rss'] / trainer['rss']:.2f}x")
+    error = np.abs(np.array(trainer["scores"]) - np.array(scorer["scores"])).max()
+    print(f"  max. score difference: {error:.2e}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scorer", type=str, required=True, help="exported scorer, written first if it does not exist")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--size", type=int, default=224, help="input size of the model")
+    parser.add_argument("--cpu", action="store_true", help="load the scorer on the CPU")
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--worker", type=str, default="", help=argparse.SUPPRESS)
+    parser.add_argument("export_args", nargs=argparse.REMAINDER, help="arguments of export_scorer.py, after --")
+    args = parser.parse_args()
+    if args.export_args[:1] == ["--"]:
+        args.export_args = args.export_args[1:]
+    if args.worker:
+        worker(args)
+    else:
+        main(args)
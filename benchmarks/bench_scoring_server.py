@@ -0,0 +1,162 @@
+"""Benchmark the micro-batching scoring server (serve_scorer.py) under load:
+p50/p99 latency against throughput, with and without batching.
+
+Starts serve_scorer.py once with --max-batch-size 1 (every request is its own
+encoder call) and once with batching, and drives each with closed-loop
+clients: every client sends one JPEG per request over a keep-alive
+connection and waits for the reply before sending the next. For each number
+of concurrent clients, the throughput, the p50/p99 request latency and the
+mean batch size (from /metrics) are reported.
+
+Without --scorer, a scorer with random weights (ViT-B/16 dimensions) and
+random text features is exported to a temporary file.
+
+    python benchmarks/bench_scoring_server.py --clients 1 4 16 64 --requests 256
+    python benchmarks/bench_scoring_server.py --scorer scorer.pt --max-batch-size 64 --max-latency-ms 20
+"""
+import os
+import io
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import subprocess
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+from clip_w_local.model import CLIP  # noqa: E402
+from utils.scorer import OODScorer, save_scorer  # noqa: E402
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def random_scorer(args, path):
+    torch.manual_seed(args.seed)
+    model = CLIP(512, 224, args.vision_layers, 768, 16, 77, 49408, 512, 8, 1).eval()
+    normalized = lambda n: F.normalize(torch.randn(n, 512), dim=-1)
+    with torch.no_grad():
+        image_encoder = torch.jit.trace(model.visual, torch.randn(2, 3, 224, 224))
+    scorer = OODScorer(
+        image_encoder, normalized(args.num_classes), normalized(args.num_classes), normalized(args.num_neg),
+        model.logit_scale.exp().detach(), classnames=[f"class {i}" for i in range(args.num_classes)], input_size=224
+    )
+    save_scorer(torch.jit.script(scorer), path)
+
+
+def random_jpeg(args):
+    rng = np.random.default_rng(args.seed)
+    small = rng.integers(0, 256, (args.height // 16, args.width // 16, 3), dtype=np.uint8)
+    buffer = io.BytesIO()
+    Image.fromarray(small).resize((args.width, args.height), Image.BICUBIC).save(buffer, format="JPEG", quality=90)
+    return buffer.getvalue()
+
+
+async def request(reader, writer, method, path, body=b""):
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: localhost\r\nContent-Length: {len(body)}\r\n\r\n".encode() + body)
+    await writer.drain()
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode().partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    payload = json.loads(await reader.readexactly(length))
+    assert status == 200, payload
+    return payload
+
+
+async def client(args, image, num_requests, latencies):
+    reader, writer = await asyncio.open_connection("127.0.0.1", args.port)
+    for _ in range(num_requests):
+        start = time.perf_counter()
+        await request(reader, writer, "POST", "/score", image)
+        latencies.append(time.perf_counter() - start)
+    writer.close()
+
+
+async def metrics(args):
+    reader, writer = await asyncio.open_connection("127.0.0.1", args.port)
+    result = await request(reader, writer, "GET", "/metrics")
+    writer.close()
+    return result
+
+
+async def load(args, image, num_clients):
+    latencies = []
+    per_client = max(1, args.requests // num_clients)
+    before = await metrics(args)
+    start = time.perf_counter()
+    await asyncio.gather(*[client(args, image, per_client, latencies) for _ in range(num_clients)])
+    elapsed = time.perf_counter() - start
+    after = await metrics(args)
+    batches = after["batches"] - before["batches"]
+    return {
+        "throughput": len(latencies) / elapsed,
+        "p50": np.percentile(latencies, 50) * 1000,
+        "p99": np.percentile(latencies, 99) * 1000,
+        "batch": (after["images"] - before["images"]) / max(1, batches),
+    }
+
+
+def bench_server(args, scorer, image, max_batch_size):
+    command = [sys.executable, os.path.join(REPO, "serve_scorer.py"), "--scorer", scorer, "--port", str(args.port),
+               "--max-batch-size", str(max_batch_size), "--max-latency-ms", str(args.max_latency_ms),
+               "--decode-workers", str(args.decode_workers)]
+    server = subprocess.Popen(command, stdout=subprocess.PIPE, text=True, cwd=REPO)
+    try:
+        for line in server.stdout:
+            if line.startswith("Serving on"):
+                break
+        else:
+            raise RuntimeError("serve_scorer.py exited before serving")
+        # the first requests warm up the decode threads
+        asyncio.run(load(args, image, 1))
+        return [(num_clients, asyncio.run(load(args, image, num_clients))) for num_clients in args.clients]
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(args):
+    image = random_jpeg(args)
+    with tempfile.TemporaryDirectory() as tmp:
+        scorer = args.scorer
+        if not scorer:
+            scorer = os.path.join(tmp, "scorer.pt")
+            random_scorer(args, scorer)
+        print(f"{args.requests} requests of a {args.width}x{args.height} JPEG per point, "
+              f"max. latency {args.max_latency_ms:g} ms")
+        print(f"  {'server':10s} {'clients':>7s} {'images/s':>9s} {'p50 ms':>8s} {'p99 ms':>8s} {'batch':>6s}")
+        for max_batch_size in [1, args.max_batch_size]:
+            for num_clients, result in bench_server(args, scorer, image, max_batch_size):
+                print(f"  {f'batch {max_batch_size}':10s} {num_clients:7d} {result['throughput']:9.1f} "
+                      f"{result['p50']:8.1f} {result['p99']:8.1f} {result['batch']:6.1f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scorer", type=str, default="", help="exported scorer, random ViT-B/16 weights if not given")
+    parser.add_argument("--vision-layers", type=int, default=12, help="layers of the random image encoder")
+    parser.add_argument("--num-classes", type=int, default=1000, help="classes of the random text features")
+    parser.add_argument("--num-neg", type=int, default=300, help="negative local prompts of the random text features")
+    parser.add_argument("--clients", type=int, nargs="+", default=[1, 4, 16, 64], help="concurrent clients")
+    parser.add_argument("--requests", type=int, default=256, help="requests per point")
+    parser.add_argument("--max-batch-size", type=int, default=32)
+    parser.add_argument("--max-latency-ms", type=float, default=10)
+    parser.add_argument("--decode-workers", type=int, default=4)
+    parser.add_argument("--width", type=int, default=500)
+    parser.add_argument("--height", type=int, default=375)
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,133 @@
+"""Benchmark the 'per_pos' and 'joint' update schedules of LOCALPROMPT.
+
+Builds a randomly initialized CLIP with the dimensions of the chosen backbone
+and ImageNet-sized prompt sets (1000 classes, 300 negative prompts), then times
+forward_backward on batches of precomputed image features, the input of a
+feature-store run. Image encoding does not depend on the schedule and is left
+out. The time per iteration is extrapolated to one epoch of the few-shot split.
+
+    python benchmarks/bench_update_schedule.py --backbone ViT-B/16 --batch-size 256
+"""
+import os
+import sys
+import time
+import argparse
+import warnings
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+from dassl.config import get_cfg_default  # noqa: E402
+from dassl.optim import build_optimizer, build_lr_scheduler  # noqa: E402
+from torch.cuda.amp import GradScaler  # noqa: E402
+
+from clip_w_local.model import CLIP  # noqa: E402
+from train import extend_cfg  # noqa: E402
+from trainers.localprompt import CustomCLIP, LOCALPROMPT  # noqa: E402
+
+
+# embed_dim, image_resolution, vision_layers, vision_width, vision_patch_size, transformer_width, transformer_heads
+BACKBONES = {
+    "ViT-B/16": (512, 224, 12, 768, 16, 512, 8),
+    "RN50": (1024, 224, (3, 4, 6, 3), 64, None, 512, 8),
+}
+
+
+def build_trainer(args, schedule, device):
+    cfg = get_cfg_default()
+    extend_cfg(cfg)
+    cfg.MODEL.BACKBONE.NAME = args.backbone
+    cfg.OPTIM.NAME = "sgd"
+    cfg.OPTIM.LR = 0.002
+    cfg.OPTIM.MAX_EPOCH = 30
+    cfg.TRAINER.LOCALPROMPT.N_CTX = args.n_ctx
+    cfg.TRAINER.LOCALPROMPT.CSC = True  # local prompts are class-specific
+    cfg.TRAINER.LOCALPROMPT.UPDATE_SCHEDULE = schedule
+    cfg.TRAINER.LOCALPROMPT.GLOBAL_TEXT_CACHE = ""  # random weights
+    cfg.num_neg_prompts = args.num_neg_prompts
+    cfg.num_pos = args.num_pos
+    cfg.lambda_value = 5.0
+    cfg.div_value = 0.5
+    cfg.topk = 20
+    cfg.T = 1.0
+
+    torch.manual_seed(args.seed)
+    embed_dim, resolution, vision_layers, vision_width, patch_size, width, heads = BACKBONES[args.backbone]
+    clip_model = CLIP(embed_dim, resolution, vision_layers, vision_width, patch_size, 77, 49408, width, heads, 12)
+    classnames = [f"class {i}" for i in range(args.num_classes)]
+    model = CustomCLIP(cfg, classnames, clip_model.float()).to(device)
+    for name, param in model.named_parameters():
+        if "prompt_learner" not in name:
+            param.requires_grad_(False)
+
+    # only the parts of the trainer used by forward_backward, without a dataset
+    trainer = LOCALPROMPT.__new__(LOCALPROMPT)
+    trainer.cfg = cfg
+    trainer.model = model
+    trainer.device = device
+    trainer.top_k = cfg.topk
+    trainer.T = cfg.T
+    trainer.optim = build_optimizer(model.prompt_learner, cfg.OPTIM)
+    trainer.sched = build_lr_scheduler(trainer.optim, cfg.OPTIM)
+    trainer._models, trainer._optims, trainer._scheds = {}, {}, {}
+    trainer.register_model("prompt_learner", model.prompt_learner, trainer.optim, trainer.sched)
+    trainer.scaler = GradScaler(enabled=device.type == "cuda")
+    trainer.batch_idx = 0
+    trainer.num_batches = args.iters + args.warmup + 1
+    return trainer, embed_dim, (resolution // patch_size) ** 2 if patch_size else (resolution // 32) ** 2
+
+
+def bench(args, schedule, device):
+    trainer, dim, num_regions = build_trainer(args, schedule, device)
+    generator = torch.Generator().manual_seed(args.seed)
+    batch = {
+        "label": torch.randint(args.num_classes, (args.batch_size,), generator=generator),
+        "image_features": torch.randn(args.batch_size, args.num_views, dim, generator=generator).half(),
+        "local_image_features": torch.randn(args.batch_size, args.num_views, num_regions, dim, generator=generator).half(),
+    }
+
+    for _ in range(args.warmup):
+        trainer.forward_backward(batch)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(args.iters):
+        loss = trainer.forward_backward(batch)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / args.iters, loss["loss"]
+
+
+def main(args):
+    warnings.filterwarnings("ignore", category=UserWarning)
+    warnings.filterwarnings("ignore", category=FutureWarning)
+    device = torch.device(args.device)
+    iters_per_epoch = -(-args.num_classes * args.shots // args.batch_size)
+
+    print(f"{args.backbone}, {args.num_classes} classes + {args.num_neg_prompts} negative prompts, "
+          f"batch {args.batch_size}, num_pos {args.num_pos}, {iters_per_epoch} iterations per epoch, device {device}")
+    results = {}
+    for schedule in ["per_pos", "joint"]:
+        per_iter, loss = bench(args, schedule, device)
+        results[schedule] = per_iter
+        print(f"  {schedule:8s} {per_iter * 1000:9.1f} ms/iter  {per_iter * iters_per_epoch:8.1f} s/epoch  (last loss {loss:.4f})")
+    print(f"  speedup per epoch: {results['per_pos'] / results['joint']:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--backbone", type=str, default="ViT-B/16", choices=list(BACKBONES))
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--num-classes", type=int, default=1000)
+    parser.add_argument("--num-neg-prompts", type=int, default=300)
+    parser.add_argument("--shots", type=int, default=16)
+    parser.add_argument("--batch-size", type=int, default=256)
+    parser.add_argument("--num-views", type=int, default=16)
+    parser.add_argument("--num-pos", type=int, default=8)
+    parser.add_argument("--n-ctx", type=int, default=16)
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,100 @@
+"""Benchmark the multi-view batch layouts of DatasetWrapper.
+
+Compares K separate img1..imgK keys (default_collate, then
+LOCALPROMPT.parse_batch_train moves and stacks them one by one) with one
+stacked "views" tensor (DATALOADER.STACK_VIEWS, multi_view_collate writes
+all views into one shared-memory [K, B, 3, H, W] tensor). Samples are
+precomputed so that only collation, worker-to-main transfer and parsing
+are timed, not decoding or augmentation.
+
+    python benchmarks/bench_view_collate.py --batch-size 64 --num-workers 4
+"""
+import os
+import sys
+import time
+import argparse
+
+import torch
+from torch.utils.data import Dataset as TorchDataset
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+from dassl.data.data_manager import multi_view_collate  # noqa: E402
+
+
+class ViewDataset(TorchDataset):
+    """Same sample content as DatasetWrapper, from a fixed tensor."""
+
+    def __init__(self, num_samples, num_views, size, stack):
+        self.num_samples = num_samples
+        self.views = torch.randn(num_views, 3, size, size)
+        self.stack = stack
+
+    def __len__(self):
+        return self.num_samples
+
+    def __getitem__(self, idx):
+        output = {"label": idx % 1000, "domain": 0, "impath": f"/data/imagenet/train/{idx}.JPEG", "index": idx}
+        if self.stack:
+            output["views"] = self.views.clone()
+        else:
+            for i in range(self.views.shape[0]):
+                output["img" + str(i + 1)] = self.views[i].clone()
+        return output
+
+
+def parse_keys(batch, device):
+    # LOCALPROMPT.parse_batch_train for img1..imgK, then the stack of multi_loader_select
+    num = max(int(key[3:]) for key in batch if key.startswith("img"))
+    inputs = [batch["img" + str(i + 1)].to(device) for i in range(num)]
+    return torch.stack(inputs, dim=0), batch["label"].to(device)
+
+
+def parse_stacked(batch, device):
+    return batch["views"].to(device, non_blocking=True), batch["label"].to(device)
+
+
+def bench(args, stack, device):
+    dataset = ViewDataset(args.batch_size * (args.batches + args.warmup), args.num_views, args.size, stack)
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=args.batch_size,
+        num_workers=args.num_workers,
+        pin_memory=device.type == "cuda",
+        collate_fn=multi_view_collate,
+    )
+    parse = parse_stacked if stack else parse_keys
+    for i, batch in enumerate(loader):
+        if i == args.warmup:
+            if device.type == "cuda":
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        images, _ = parse(batch, device)
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    assert images.shape == (args.num_views, args.batch_size, 3, args.size, args.size)
+    return (time.perf_counter() - start) / args.batches
+
+
+def main(args):
+    device = torch.device(args.device)
+    print(f"batch {args.batch_size} x {args.num_views} views of {args.size}x{args.size}, "
+          f"{args.num_workers} workers, device {device}")
+    results = {}
+    for stack in [False, True]:
+        name = "stacked" if stack else "img keys"
+        results[name] = bench(args, stack, device)
+        print(f"  {name:9s} {results[name] * 1000:8.1f} ms/batch")
+    print(f"  speedup: {results['img keys'] / results['stacked']:.2f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", type=str, default="cuda" if torch.cuda.is_available() else "cpu")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--num-views", type=int, default=16)
+    parser.add_argument("--size", type=int, default=224)
+    parser.add_argument("--num-workers", type=int, default=2)
+    parser.add_argument("--batches", type=int, default=10)
+    parser.add_argument("--warmup", type=int, default=2)
+    args = parser.parse_args()
+    main(args)
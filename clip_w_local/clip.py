@@ -1,16 +1,19 @@
 import hashlib
+import json
 import os
+import shutil
 import urllib
 import warnings
 from typing import Union, List
 
+import numpy as np
 import torch
 from PIL import Image
 from torchvision.transforms import Compose, Resize, CenterCrop, ToTensor, Normalize
 from tqdm import tqdm
 
 from .model import build_model
-from .simple_tokenizer import SimpleTokenizer as _Tokenizer
+from .simple_tokenizer import default_bpe, bpe_sha256, get_tokenizer
 
 try:
     from torchvision.transforms import InterpolationMode
@@ -23,8 +26,7 @@ if torch.__version__.split(".") < ["1", "7", "1"]:
     warnings.warn("PyTorch version 1.7.1 or higher is recommended")
 
 
-__all__ = ["available_models", "load", "tokenize"]
-_tokenizer = _Tokenizer()
+__all__ = ["available_models", "load", "load_weights", "tokenize", "tokenize_cached"]
 
 _MODELS = {
     "RN50": "https://openaipublic.azureedge.net/clip/models/afeb0e10f9e5a86da6080e35cf09123aca3b358a0c3e3b6c78a7b63bc04b6762/RN50.pt",
@@ -36,6 +38,37 @@ _MODELS = {
 }
 
 
+def _sha256(path: str):
+    '''
+    SHA256 of a file, read in chunks. The result is recorded next to the file together with its size and
+    modification time, so an unchanged file is only hashed once.
+    '''
+    stat = os.stat(path)
+    record = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+    record_path = path + ".sha256"
+    if os.path.isfile(record_path):
+        with open(record_path) as f:
+            cached = json.load(f)
+        if cached.get("size") == record["size"] and cached.get("mtime_ns") == record["mtime_ns"]:
+            return cached["sha256"]
+
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as f:
+        for buffer in iter(lambda: f.read(1 << 20), b""):
+            sha256.update(buffer)
+    record["sha256"] = sha256.hexdigest()
+
+    try:
+        tmp_path = f"{record_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(record, f)
+        os.replace(tmp_path, record_path)
+    except OSError:
+        # read-only location, hash again next time
+        pass
+    return record["sha256"]
+
+
 def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
     os.makedirs(root, exist_ok=True)
     filename = os.path.basename(url)
@@ -47,7 +80,7 @@ def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
         raise RuntimeError(f"{download_target} exists and is not a regular file")
 
     if os.path.isfile(download_target):
-        if hashlib.sha256(open(download_target, "rb").read()).hexdigest() == expected_sha256:
+        if _sha256(download_target) == expected_sha256:
             return download_target
         else:
             warnings.warn(f"{download_target} exists, but the SHA256 checksum does not match; re-downloading the file")
@@ -62,12 +95,110 @@ def _download(url: str, root: str = os.path.expanduser("~/.cache/clip")):
                 output.write(buffer)
                 loop.update(len(buffer))
 
-    if hashlib.sha256(open(download_target, "rb").read()).hexdigest() != expected_sha256:
+    if _sha256(download_target) != expected_sha256:
         raise RuntimeError(f"Model has been downloaded but the SHA256 checksum does not not match")
 
     return download_target
 
 
+def _load_state_dict(model_path: str):
+    try:
+        # loading JIT archive
+        return torch.jit.load(model_path, map_location="cpu").eval().state_dict()
+    except RuntimeError:
+        # loading saved state dict
+        return torch.load(model_path, map_location="cpu")
+
+
+_WEIGHTS_ALIGNMENT = 64
+
+
+def _save_weights(state_dict: dict, path: str):
+    '''
+    write a state dict as one raw file of aligned tensors and a json index of their offsets, shapes and dtypes.
+    '''
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    index, offset = {}, 0
+    with open(os.path.join(tmp_path, "weights.bin"), "wb") as f:
+        for key, tensor in state_dict.items():
+            array = tensor.detach().cpu().contiguous().numpy()
+            offset = -(-offset // _WEIGHTS_ALIGNMENT) * _WEIGHTS_ALIGNMENT
+            f.seek(offset)
+            f.write(array.tobytes())
+            index[key] = {"offset": offset, "shape": list(array.shape), "dtype": array.dtype.str}
+            offset += array.nbytes
+    with open(os.path.join(tmp_path, "index.json"), "w") as f:
+        json.dump(index, f)
+
+    try:
+        os.replace(tmp_path, path)
+    except OSError:
+        # written concurrently by another process
+        shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+def _map_weights(path: str):
+    with open(os.path.join(path, "index.json")) as f:
+        index = json.load(f)
+    # copy-on-write mapping: tensors are writable, pages are read from disk on first access and shared between processes
+    buffer = np.memmap(os.path.join(path, "weights.bin"), dtype=np.uint8, mode="c")
+    state_dict = {}
+    for key, entry in index.items():
+        dtype = np.dtype(entry["dtype"])
+        count = int(np.prod(entry["shape"], dtype=np.int64))
+        array = buffer[entry["offset"]:entry["offset"] + count * dtype.itemsize].view(dtype).reshape(entry["shape"])
+        state_dict[key] = torch.from_numpy(array)
+    return state_dict
+
+
+def load_weights(name: str, dtype: torch.dtype = torch.float32,
+                 cache_dir: str = os.path.expanduser("~/.cache/clip/weights")):
+    """Load the state dict of a built CLIP model as memory-mapped tensors
+
+    On first use the checkpoint is downloaded and verified, the model is built and its state dict is written to
+    cache_dir in the target dtype. Later loads map that file, without reading, hashing or converting the checkpoint.
+    The result is meant for `build_model(state_dict, assign=True)`.
+
+    Parameters
+    ----------
+    name : str
+        A model name listed by `clip.available_models()`, or the path to a model checkpoint
+
+    dtype : torch.dtype
+        torch.float16 keeps CLIP's mixed fp16/fp32 weights, torch.float32 converts all of them to fp32
+
+    cache_dir : str
+        Directory of the converted weights, keyed by the SHA256 of the checkpoint
+
+    Returns
+    -------
+    state_dict : dict
+        The parameters and buffers of the built model, backed by the cache file
+    """
+    if dtype not in (torch.float16, torch.float32):
+        raise ValueError(f"dtype must be torch.float16 or torch.float32, got {dtype}")
+
+    if name in _MODELS:
+        model_path = None
+        checkpoint_sha256 = _MODELS[name].split("/")[-2]
+    elif os.path.isfile(name):
+        model_path = name
+        checkpoint_sha256 = _sha256(name)
+    else:
+        raise RuntimeError(f"Model {name} not found; available models = {available_models()}")
+
+    path = os.path.join(cache_dir, f"{checkpoint_sha256[:16]}-{'fp16' if dtype == torch.float16 else 'fp32'}")
+    if not os.path.isfile(os.path.join(path, "index.json")):
+        os.makedirs(cache_dir, exist_ok=True)
+        model = build_model(_load_state_dict(model_path or _download(_MODELS[name])))
+        if dtype == torch.float32:
+            model.float()
+        _save_weights(model.state_dict(), path)
+
+    return _map_weights(path)
+
+
 def _transform(n_px):
     return Compose([
         Resize(n_px, interpolation=BICUBIC),
@@ -204,18 +335,50 @@ def tokenize(texts: Union[str, List[str]], context_length: int = 77, truncate: b
     if isinstance(texts, str):
         texts = [texts]
 
-    sot_token = _tokenizer.encoder["<|startoftext|>"]
-    eot_token = _tokenizer.encoder["<|endoftext|>"]
-    all_tokens = [[sot_token] + _tokenizer.encode(text) + [eot_token] for text in texts]
-    result = torch.zeros(len(all_tokens), context_length, dtype=torch.long)
+    tokenizer = get_tokenizer()
+    sot_token = tokenizer.encoder["<|startoftext|>"]
+    eot_token = tokenizer.encoder["<|endoftext|>"]
+    all_tokens = [[sot_token] + tokenizer.encode(text) + [eot_token] for text in texts]
 
     for i, tokens in enumerate(all_tokens):
         if len(tokens) > context_length:
             if truncate:
                 tokens = tokens[:context_length]
                 tokens[-1] = eot_token
+                all_tokens[i] = tokens
             else:
                 raise RuntimeError(f"Input {texts[i]} is too long for context length {context_length}")
-        result[i, :len(tokens)] = torch.tensor(tokens)
 
+    # pad in python and build the tensor in one go
+    return torch.tensor([tokens + [0] * (context_length - len(tokens)) for tokens in all_tokens], dtype=torch.long).reshape(len(all_tokens), context_length)
+
+
+def tokenize_cached(texts: List[str], context_length: int = 77, truncate: bool = False,
+                    cache_dir: str = os.path.expanduser("~/.cache/clip/tokens")) -> torch.LongTensor:
+    """
+    Same as tokenize(), but the result is stored in cache_dir, keyed by the SHA256 of the bpe file, the texts
+    and the arguments, so that a prompt set is tokenized only once. An empty cache_dir disables the cache.
+    """
+    if isinstance(texts, str):
+        texts = [texts]
+    if not cache_dir:
+        return tokenize(texts, context_length, truncate)
+
+    h = hashlib.sha1()
+    h.update(f"{bpe_sha256(default_bpe())}-{context_length}-{truncate}".encode())
+    for text in texts:
+        h.update(text.encode("utf-8"))
+        h.update(b"\0")
+    cache_file = os.path.join(os.path.expanduser(cache_dir), f"{h.hexdigest()}.npy")
+    if os.path.isfile(cache_file):
+        return torch.from_numpy(np.load(cache_file).astype(np.int64))
+
+    result = tokenize(texts, context_length, truncate)
+    try:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp.npy"
+        np.save(tmp_file, result.numpy().astype(np.int32))
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
     return result
@@ -4,9 +4,31 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 from torch import nn
+from torch.utils.checkpoint import checkpoint
+from contextlib import nullcontext
 import math
 
 
+# torch >= 1.11 has non-reentrant checkpointing, which also works when no input of the function requires grad
+_NON_REENTRANT_CHECKPOINT = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (1, 11)
+
+
+def activation_checkpoint(function, *args):
+    '''
+    run function without storing its activations, they are recomputed in backward.
+    '''
+    if _NON_REENTRANT_CHECKPOINT:
+        return checkpoint(function, *args, use_reentrant=False)
+    return checkpoint(function, *args)
+
+
+# torch >= 2.0 can construct modules on the meta device, without allocating and initializing weights
+_META_INIT = tuple(int(v) for v in torch.__version__.split(".")[:2]) >= (2, 0)
+
+# attention implementations of ResidualAttentionBlock, 'sdpa' needs torch >= 2.0
+ATTENTION_BACKENDS = ("mha", "sdpa")
+
+
 class Bottleneck(nn.Module):
     expansion = 4
 
@@ -184,16 +206,62 @@ class ResidualAttentionBlock(nn.Module):
         ]))
         self.ln_2 = LayerNorm(d_model)
         self.attn_mask = attn_mask
+        # 'mha': nn.MultiheadAttention, 'sdpa': F.scaled_dot_product_attention, see set_attention_backend
+        self.attn_backend = "mha"
+        # int8 copies of the attention projections, see quantize_int8
+        self.qkv_proj = None
+        self.out_proj = None
+
+    @property
+    def attn_mask(self):
+        return self._attn_mask
+
+    @attn_mask.setter
+    def attn_mask(self, attn_mask):
+        self._attn_mask = attn_mask
+        self._attn_masks = {}  # attn_mask per (dtype, device), converted on first use
+
+    def cast_attn_mask(self, x: torch.Tensor):
+        if self._attn_mask is None:
+            return None
+        key = (x.dtype, x.device)
+        if key not in self._attn_masks:
+            self._attn_masks[key] = self._attn_mask.to(dtype=x.dtype, device=x.device)
+        return self._attn_masks[key]
 
     def attention(self, x: torch.Tensor):
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=False, attn_mask=self.attn_mask)[0]
+        if self.attn_backend == "sdpa" or self.qkv_proj is not None:
+            return self.sdpa_attention(x)
+        attn_mask = self.cast_attn_mask(x)
+        # text sequences may be trimmed below context_length, the causal mask is cut to the same length
+        attn_mask = attn_mask[:x.shape[0], :x.shape[0]] if attn_mask is not None else None
+        return self.attn(x, x, x, need_weights=False, attn_mask=attn_mask)[0]
+
+    def sdpa_attention(self, x: torch.Tensor):
+        # the only mask CLIP uses is the causal text mask, so the text path runs with is_causal and no mask tensor
+        L, N, C = x.shape
+        n_head = self.attn.num_heads
+        if self.qkv_proj is not None:
+            qkv = self.qkv_proj(x)
+        else:
+            qkv = F.linear(x, self.attn.in_proj_weight, self.attn.in_proj_bias)
+        q, k, v = qkv.view(L, N, 3, n_head, C // n_head).permute(2, 1, 3, 0, 4).unbind(0)  # 3 x [N, n_head, L, C / n_head]
+        out = F.scaled_dot_product_attention(q, k, v, is_causal=self._attn_mask is not None)
+        out = out.permute(2, 0, 1, 3).reshape(L, N, C)
+        if self.out_proj is not None:
+            return self.out_proj(out)
+        return F.linear(out, self.attn.out_proj.weight, self.attn.out_proj.bias)
 
     def attention_weight(self, x: torch.Tensor):  # ADDED
-        self.attn_mask = self.attn_mask.to(dtype=x.dtype, device=x.device) if self.attn_mask is not None else None
-        return self.attn(x, x, x, need_weights=True, attn_mask=self.attn_mask)[1]
+        return self.attn(x, x, x, need_weights=True, attn_mask=self.cast_attn_mask(x))[1]
+
+    def forward(self, x: torch.Tensor, return_attention: bool = False, return_qkv: bool = True):
+        if not return_qkv:
+            # standard single path, the value-path features are only needed from the last block
+            x = x + self.attention(self.ln_1(x))
+            x = x + self.mlp(self.ln_2(x))
+            return x, None, None, None
 
-    def forward(self, x: torch.Tensor, return_attention: bool = False):
         y = self.ln_1(x)
         y = y.permute(1, 0, 2)
         y = F.linear(y, self.attn.in_proj_weight, self.attn.in_proj_bias)
@@ -221,10 +289,18 @@ class Transformer(nn.Module):
         self.resblocks = nn.Sequential(*[ResidualAttentionBlock(width, heads, attn_mask) for _ in range(layers)])
         # self.resblock = ResidualAttentionBlock(width, heads, attn_mask)
 
-    def forward(self, x: torch.Tensor):
+    def forward(self, x: torch.Tensor, return_qkv: bool = True, use_checkpoint: bool = False):
         # return self.resblocks(x)
+        # q, k, v only come from the last block, earlier blocks skip the value path
+        # use_checkpoint keeps only the input of every block for backward and recomputes the rest
+        use_checkpoint = use_checkpoint and torch.is_grad_enabled() and x.requires_grad
         for i in range(self.layers):
-            x, q, k, v = self.resblocks[i](x)
+            block_qkv = return_qkv and i == self.layers - 1
+            if use_checkpoint and not block_qkv:
+                x = activation_checkpoint(lambda x, block=self.resblocks[i]: block(x, return_qkv=False)[0], x)
+                q, k, v = None, None, None
+            else:
+                x, q, k, v = self.resblocks[i](x, return_qkv=block_qkv)
         return x, q, k, v
 
 
@@ -387,16 +463,17 @@ class CLIP(nn.Module):
         return self.visual(image.type(self.dtype))
 
     def encode_text(self, text):
+        # take features from the eot embedding (eot_token is the highest number in each sequence)
+        # with the causal mask, positions after the last eot cannot change the eot rows, so they are dropped
+        eot = text.argmax(dim=-1)
+        text = text[:, :int(eot.max()) + 1]
         x = self.token_embedding(text).type(self.dtype)  # [batch_size, n_ctx, d_model]
 
-        x = x + self.positional_embedding.type(self.dtype)
+        x = x + self.positional_embedding[:x.shape[1]].type(self.dtype)
         x = x.permute(1, 0, 2)  # NLD -> LND
-        x, q, k, v = self.transformer(x)
+        x, _, _, _ = self.transformer(x, return_qkv=False)
         x = x.permute(1, 0, 2)  # LND -> NLD
-        x = self.ln_final(x).type(self.dtype)
-
-        # take features from the eot embedding (eot_token is the highest number in each sequence)
-        x = x[torch.arange(x.shape[0]), text.argmax(dim=-1)] @ self.text_projection
+        x = self.ln_final(x[torch.arange(x.shape[0]), eot]).type(self.dtype) @ self.text_projection
 
         return x
 
@@ -441,7 +518,66 @@ def convert_weights(model: nn.Module):
     model.apply(_convert_weights_to_fp16)
 
 
-def build_model(state_dict: dict):
+def set_attention_backend(model: nn.Module, backend: str):
+    '''
+    select the attention implementation of every ResidualAttentionBlock of model, one of ATTENTION_BACKENDS.
+    '''
+    if backend not in ATTENTION_BACKENDS:
+        raise ValueError(f"Unknown attention backend {backend}, expected one of {ATTENTION_BACKENDS}")
+    if backend == "sdpa" and not hasattr(F, "scaled_dot_product_attention"):
+        raise RuntimeError("The sdpa attention backend needs torch >= 2.0")
+    for module in model.modules():
+        if isinstance(module, ResidualAttentionBlock):
+            module.attn_backend = backend
+
+
+def quantize_int8(model: nn.Module):
+    '''
+    dynamic int8 quantization (CPU inference) of the linear layers of every ResidualAttentionBlock of model, in place.
+    weights are int8 with per-channel scales, activations are quantized per batch. the MLPs are quantized in place,
+    the attention projections get int8 copies that run through F.scaled_dot_product_attention (torch >= 2.0, on
+    older versions they stay in float). the value path of the last vision block and AttentionPool2d read float
+    weights, so a ModifiedResNet is unchanged.
+    '''
+    qconfig_spec = {nn.Linear: torch.quantization.per_channel_dynamic_qconfig}
+    for module in model.modules():
+        if isinstance(module, ResidualAttentionBlock):
+            torch.quantization.quantize_dynamic(module.mlp, qconfig_spec, dtype=torch.qint8, inplace=True)
+            if hasattr(F, "scaled_dot_product_attention"):
+                d_model = module.attn.embed_dim
+                projections = nn.Sequential(nn.Linear(d_model, 3 * d_model), nn.Linear(d_model, d_model))
+                projections[0].weight.data, projections[0].bias.data = module.attn.in_proj_weight.data, module.attn.in_proj_bias.data
+                projections[1].weight.data, projections[1].bias.data = module.attn.out_proj.weight.data, module.attn.out_proj.bias.data
+                projections = torch.quantization.quantize_dynamic(projections, qconfig_spec, dtype=torch.qint8)
+                module.qkv_proj, module.out_proj = projections[0], projections[1]
+    return model
+
+
+def assign_state_dict(model: nn.Module, state_dict: dict):
+    '''
+    use the tensors of state_dict as the parameters and buffers of model, without copying them.
+    '''
+    expected = set(model.state_dict().keys())
+    if set(state_dict.keys()) != expected:
+        missing, unexpected = sorted(expected - set(state_dict)), sorted(set(state_dict) - expected)
+        raise RuntimeError(f"Error(s) in assigning state_dict: missing keys {missing}, unexpected keys {unexpected}")
+
+    for prefix, module in model.named_modules():
+        prefix = prefix + "." if prefix else ""
+        for name, param in module._parameters.items():
+            if param is not None:
+                module._parameters[name] = nn.Parameter(state_dict[prefix + name], requires_grad=param.requires_grad)
+        for name, buffer in module._buffers.items():
+            if buffer is not None:
+                module._buffers[name] = state_dict[prefix + name]
+
+
+def build_model(state_dict: dict, assign: bool = False):
+    '''
+    assign: use the tensors of state_dict as they are, they already have the dtypes of the built model (e.g. a
+    memory-mapped state dict from clip.load_weights). The model is built without initializing weights that are
+    replaced anyway, and no weights are copied.
+    '''
     vit = "visual.proj" in state_dict
 
     if vit:
@@ -466,16 +602,25 @@ def build_model(state_dict: dict):
     transformer_heads = transformer_width // 64
     transformer_layers = len(set(k.split(".")[2] for k in state_dict if k.startswith(f"transformer.resblocks")))
 
-    model = CLIP(
-        embed_dim,
-        image_resolution, vision_layers, vision_width, vision_patch_size,
-        context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
-    )
+    with torch.device("meta") if assign and _META_INIT else nullcontext():
+        model = CLIP(
+            embed_dim,
+            image_resolution, vision_layers, vision_width, vision_patch_size,
+            context_length, vocab_size, transformer_width, transformer_heads, transformer_layers
+        )
 
     for key in ["input_resolution", "context_length", "vocab_size"]:
         if key in state_dict:
             del state_dict[key]
 
+    if assign:
+        assign_state_dict(model, state_dict)
+        # the causal mask is not part of the state dict
+        attn_mask = model.build_attention_mask()
+        for block in model.transformer.resblocks:
+            block.attn_mask = attn_mask
+        return model.eval()
+
     convert_weights(model)
     model.load_state_dict(state_dict)
     return model.eval()
\ No newline at end of file
@@ -1,6 +1,8 @@
 import gzip
+import hashlib
 import html
 import os
+import pickle
 from functools import lru_cache
 
 import ftfy
@@ -35,6 +37,66 @@ def bytes_to_unicode():
     return dict(zip(bs, cs))
 
 
+BPE_TABLES_VERSION = 1
+
+
+@lru_cache()
+def bpe_sha256(bpe_path):
+    with open(bpe_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def load_bpe_tables(bpe_path, cache_dir=os.path.expanduser("~/.cache/clip")):
+    """
+    Returns the vocabulary (token -> id) and the merge ranks of a bpe file.
+    Building them from the gzipped merges is done once, the tables are then pickled to cache_dir,
+    keyed by the SHA256 of the bpe file, and loaded from there. The pickle stores the version of its
+    format and the SHA256 of the bpe file, a pickle that does not match (or cannot be read) is rebuilt.
+    """
+    sha256 = bpe_sha256(bpe_path)
+    cache_file = os.path.join(cache_dir, f"bpe-{sha256[:16]}.pkl")
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, "rb") as f:
+                tables = pickle.load(f)
+            if tables["version"] == BPE_TABLES_VERSION and tables["sha256"] == sha256:
+                return tables["encoder"], tables["bpe_ranks"]
+        except Exception:
+            # truncated or from an older format, built again below
+            pass
+
+    with gzip.open(bpe_path) as f:
+        merges = f.read().decode("utf-8").split('\n')
+    merges = merges[1:49152-256-2+1]
+    merges = [tuple(merge.split()) for merge in merges]
+    vocab = list(bytes_to_unicode().values())
+    vocab = vocab + [v+'</w>' for v in vocab]
+    for merge in merges:
+        vocab.append(''.join(merge))
+    vocab.extend(['<|startoftext|>', '<|endoftext|>'])
+    encoder = dict(zip(vocab, range(len(vocab))))
+    bpe_ranks = dict(zip(merges, range(len(merges))))
+
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+        with open(tmp_file, "wb") as f:
+            tables = {"version": BPE_TABLES_VERSION, "sha256": sha256, "encoder": encoder, "bpe_ranks": bpe_ranks}
+            pickle.dump(tables, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        pass
+    return encoder, bpe_ranks
+
+
+@lru_cache()
+def get_tokenizer(bpe_path: str = None):
+    """
+    Returns the tokenizer shared by the whole process, it is built on first use.
+    """
+    return SimpleTokenizer(bpe_path or default_bpe())
+
+
 def get_pairs(word):
     """Return set of symbol pairs in a word.
     Word is represented as tuple of symbols (symbols being variable-length strings).
@@ -63,17 +125,8 @@ class SimpleTokenizer(object):
     def __init__(self, bpe_path: str = default_bpe()):
         self.byte_encoder = bytes_to_unicode()
         self.byte_decoder = {v: k for k, v in self.byte_encoder.items()}
-        merges = gzip.open(bpe_path).read().decode("utf-8").split('\n')
-        merges = merges[1:49152-256-2+1]
-        merges = [tuple(merge.split()) for merge in merges]
-        vocab = list(bytes_to_unicode().values())
-        vocab = vocab + [v+'</w>' for v in vocab]
-        for merge in merges:
-            vocab.append(''.join(merge))
-        vocab.extend(['<|startoftext|>', '<|endoftext|>'])
-        self.encoder = dict(zip(vocab, range(len(vocab))))
+        self.encoder, self.bpe_ranks = load_bpe_tables(bpe_path)
         self.decoder = {v: k for k, v in self.encoder.items()}
-        self.bpe_ranks = dict(zip(merges, range(len(merges))))
         self.cache = {'<|startoftext|>': '<|startoftext|>', '<|endoftext|>': '<|endoftext|>'}
         self.pat = re.compile(r"""<\|startoftext\|>|<\|endoftext\|>|'s|'t|'re|'ve|'m|'ll|'d|[\p{L}]+|[\p{N}]|[^\s\p{L}\p{N}]+""", re.IGNORECASE)
 
@@ -2,58 +2,75 @@ import os
 import pickle
 from collections import OrderedDict
 
-from dassl.data.datasets import DATASET_REGISTRY, Datum, DatasetBase
+import numpy as np
+
+from dassl.data.datasets import DATASET_REGISTRY, DatumIndex, DatasetBase
 from dassl.utils import listdir_nohidden, mkdir_if_missing
 
 from .oxford_pets import OxfordPets
 
 
-@DATASET_REGISTRY.register()
-class ImageNet(DatasetBase):
+class ImageNetBase(DatasetBase):
+    """ImageNet-style dataset with one folder per class in train/ and val/.
 
-    dataset_dir = "imagenet"
+    The image lists are kept as memory-mapped DatumIndex arrays in index/,
+    so loading does not depend on the number of images.
+    """
+
+    dataset_dir = ""
+    classnames_sep = " "  # separator of folder and class name in classnames.txt
 
     def __init__(self, cfg):
         root = os.path.abspath(os.path.expanduser(cfg.DATASET.ROOT))
         self.dataset_dir = os.path.join(root, self.dataset_dir)
         self.image_dir = os.path.join(self.dataset_dir, "images")
+        self.index_dir = os.path.join(self.dataset_dir, "index")
         self.preprocessed = os.path.join(self.dataset_dir, "preprocessed.pkl")
         self.split_fewshot_dir = os.path.join(self.dataset_dir, "split_fewshot")
         mkdir_if_missing(self.split_fewshot_dir)
 
-        if os.path.exists(self.preprocessed):
-            with open(self.preprocessed, "rb") as f:
-                preprocessed = pickle.load(f)
-                train = preprocessed["train"]
-                test = preprocessed["test"]
-        else:
-            text_file = os.path.join(self.dataset_dir, "classnames.txt")
-            classnames = self.read_classnames(text_file)
-            train = self.read_data(classnames, "train")
-            # Follow standard practice to perform evaluation on the val set
-            # Also used as the val set (so evaluate the last-step model)
-            test = self.read_data(classnames, "val")
-
-            preprocessed = {"train": train, "test": test}
-            with open(self.preprocessed, "wb") as f:
-                pickle.dump(preprocessed, f, protocol=pickle.HIGHEST_PROTOCOL)
+        train_dir = os.path.join(self.index_dir, "train")
+        test_dir = os.path.join(self.index_dir, "test")
+        if not (DatumIndex.exists(train_dir) and DatumIndex.exists(test_dir)):
+            if os.path.exists(self.preprocessed):
+                # Datum lists written by earlier versions
+                with open(self.preprocessed, "rb") as f:
+                    preprocessed = pickle.load(f)
+                    train = DatumIndex.from_datums(preprocessed["train"])
+                    test = DatumIndex.from_datums(preprocessed["test"])
+            else:
+                text_file = os.path.join(self.dataset_dir, "classnames.txt")
+                classnames = self.read_classnames(text_file, self.classnames_sep)
+                train = self.read_data(classnames, "train")
+                # Follow standard practice to perform evaluation on the val set
+                # Also used as the val set (so evaluate the last-step model)
+                test = self.read_data(classnames, "val")
+
+            train.save(train_dir)
+            test.save(test_dir)
+        train = DatumIndex.load(train_dir)
+        test = DatumIndex.load(test_dir)
 
         num_shots = cfg.DATASET.NUM_SHOTS
         if num_shots >= 1:
             seed = cfg.SEED
-            preprocessed = os.path.join(self.split_fewshot_dir, f"shot_{num_shots}-seed_{seed}.pkl")
-            
-            if os.path.exists(preprocessed):
+            fewshot_dir = os.path.join(self.split_fewshot_dir, f"shot_{num_shots}-seed_{seed}")
+            preprocessed = fewshot_dir + ".pkl"
+
+            if DatumIndex.exists(fewshot_dir):
+                print(f"Loading preprocessed few-shot data from {fewshot_dir}")
+                train = DatumIndex.load(fewshot_dir)
+            elif os.path.exists(preprocessed):
+                # few-shot split written by earlier versions
                 print(f"Loading preprocessed few-shot data from {preprocessed}")
                 with open(preprocessed, "rb") as file:
                     data = pickle.load(file)
-                    train = data["train"]
+                    train = DatumIndex.from_datums(data["train"])
+                train.save(fewshot_dir)
             else:
                 train = self.generate_fewshot_dataset(train, num_shots=num_shots)
-                data = {"train": train}
-                print(f"Saving preprocessed few-shot data to {preprocessed}")
-                with open(preprocessed, "wb") as file:
-                    pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
+                print(f"Saving preprocessed few-shot data to {fewshot_dir}")
+                train.save(fewshot_dir)
 
         subsample = cfg.DATASET.SUBSAMPLE_CLASSES
         train, test = OxfordPets.subsample_classes(train, test, subsample=subsample)
@@ -61,7 +78,7 @@ class ImageNet(DatasetBase):
         super().__init__(train_x=train, val=test, test=test)
 
     @staticmethod
-    def read_classnames(text_file):
+    def read_classnames(text_file, sep=" "):
         """Return a dictionary containing
         key-value pairs of <folder name>: <class name>.
         """
@@ -69,7 +86,7 @@ class ImageNet(DatasetBase):
         with open(text_file, "r") as f:
             lines = f.readlines()
             for line in lines:
-                line = line.strip().split(" ")
+                line = line.strip().split(sep)
                 folder = line[0]
                 classname = " ".join(line[1:])
                 classnames[folder] = classname
@@ -78,262 +95,39 @@ class ImageNet(DatasetBase):
     def read_data(self, classnames, split_dir):
         split_dir = os.path.join(self.dataset_dir, split_dir)
         folders = sorted(f.name for f in os.scandir(split_dir) if f.is_dir())
-        items = []
+        impaths, labels = [], []
 
         for label, folder in enumerate(folders):
             imnames = listdir_nohidden(os.path.join(split_dir, folder))
-            classname = classnames[folder]
-            for imname in imnames:
-                impath = os.path.join(split_dir, folder, imname)
-                item = Datum(impath=impath, label=label, classname=classname)
-                items.append(item)
+            impaths.extend(os.path.join(split_dir, folder, imname) for imname in imnames)
+            labels.extend([label] * len(imnames))
 
-        return items
+        return DatumIndex.from_arrays(
+            impaths, labels, np.zeros(len(labels), dtype=np.int32), [classnames[folder] for folder in folders]
+        )
 
 
 @DATASET_REGISTRY.register()
-class ImageNet100(DatasetBase):
-
-    dataset_dir = "imagenet100"
-
-    def __init__(self, cfg):
-        root = os.path.abspath(os.path.expanduser(cfg.DATASET.ROOT))
-        self.dataset_dir = os.path.join(root, self.dataset_dir)
-        self.image_dir = os.path.join(self.dataset_dir, "images")
-        self.preprocessed = os.path.join(self.dataset_dir, "preprocessed.pkl")
-        self.split_fewshot_dir = os.path.join(self.dataset_dir, "split_fewshot")
-        mkdir_if_missing(self.split_fewshot_dir)
-
-        if os.path.exists(self.preprocessed):
-            with open(self.preprocessed, "rb") as f:
-                preprocessed = pickle.load(f)
-                train = preprocessed["train"]
-                test = preprocessed["test"]
-        else:
-            text_file = os.path.join(self.dataset_dir, "classnames.txt")
-            classnames = self.read_classnames(text_file)
-            train = self.read_data(classnames, "train")
-            # Follow standard practice to perform evaluation on the val set
-            # Also used as the val set (so evaluate the last-step model)
-            test = self.read_data(classnames, "val")
-
-            preprocessed = {"train": train, "test": test}
-            with open(self.preprocessed, "wb") as f:
-                pickle.dump(preprocessed, f, protocol=pickle.HIGHEST_PROTOCOL)
+class ImageNet(ImageNetBase):
 
-        num_shots = cfg.DATASET.NUM_SHOTS
-        if num_shots >= 1:
-            seed = cfg.SEED
-            preprocessed = os.path.join(self.split_fewshot_dir, f"shot_{num_shots}-seed_{seed}.pkl")
-
-            if os.path.exists(preprocessed):
-                print(f"Loading preprocessed few-shot data from {preprocessed}")
-                with open(preprocessed, "rb") as file:
-                    data = pickle.load(file)
-                    train = data["train"]
-            else:
-                train = self.generate_fewshot_dataset(train, num_shots=num_shots)
+    dataset_dir = "imagenet"
 
-                data = {"train": train}
-                print(f"Saving preprocessed few-shot data to {preprocessed}")
-                with open(preprocessed, "wb") as file:
-                    pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
 
-        subsample = cfg.DATASET.SUBSAMPLE_CLASSES
-        train, test = OxfordPets.subsample_classes(train, test, subsample=subsample)
-
-        super().__init__(train_x=train, val=test, test=test)
-
-    @staticmethod
-    def read_classnames(text_file):
-        """Return a dictionary containing
-        key-value pairs of <folder name>: <class name>.
-        """
-        classnames = OrderedDict()
-        with open(text_file, "r") as f:
-            lines = f.readlines()
-            for line in lines:
-                line = line.strip().split(" ")
-                folder = line[0]
-                classname = " ".join(line[1:])
-                classnames[folder] = classname
-        return classnames
-
-    def read_data(self, classnames, split_dir):
-        split_dir = os.path.join(self.dataset_dir, split_dir)
-        folders = sorted(f.name for f in os.scandir(split_dir) if f.is_dir())
-        items = []
-        for label, folder in enumerate(folders):
-            imnames = listdir_nohidden(os.path.join(split_dir, folder))
-            classname = classnames[folder]
-            for imname in imnames:
-                impath = os.path.join(split_dir, folder, imname)
-                item = Datum(impath=impath, label=label, classname=classname)
-                items.append(item)
+@DATASET_REGISTRY.register()
+class ImageNet100(ImageNetBase):
 
-        return items
+    dataset_dir = "imagenet100"
 
 
 @DATASET_REGISTRY.register()
-class ImageNet10(DatasetBase):
+class ImageNet10(ImageNetBase):
 
     dataset_dir = "imagenet10"
+    classnames_sep = ","
 
-    def __init__(self, cfg):
-        root = os.path.abspath(os.path.expanduser(cfg.DATASET.ROOT))
-        self.dataset_dir = os.path.join(root, self.dataset_dir)
-        self.image_dir = os.path.join(self.dataset_dir, "images")
-        self.preprocessed = os.path.join(self.dataset_dir, "preprocessed.pkl")
-        self.split_fewshot_dir = os.path.join(self.dataset_dir, "split_fewshot")
-        mkdir_if_missing(self.split_fewshot_dir)
-
-        if os.path.exists(self.preprocessed):
-            with open(self.preprocessed, "rb") as f:
-                preprocessed = pickle.load(f)
-                train = preprocessed["train"]
-                test = preprocessed["test"]
-        else:
-            text_file = os.path.join(self.dataset_dir, "classnames.txt")
-            classnames = self.read_classnames(text_file)
-
-            train = self.read_data(classnames, "train")
-            # Follow standard practice to perform evaluation on the val set
-            # Also used as the val set (so evaluate the last-step model)
-            test = self.read_data(classnames, "val")
-
-            preprocessed = {"train": train, "test": test}
-            with open(self.preprocessed, "wb") as f:
-                pickle.dump(preprocessed, f, protocol=pickle.HIGHEST_PROTOCOL)
-
-        num_shots = cfg.DATASET.NUM_SHOTS
-        if num_shots >= 1:
-            seed = cfg.SEED
-            preprocessed = os.path.join(self.split_fewshot_dir, f"shot_{num_shots}-seed_{seed}.pkl")
-            
-            if os.path.exists(preprocessed):
-                print(f"Loading preprocessed few-shot data from {preprocessed}")
-                with open(preprocessed, "rb") as file:
-                    data = pickle.load(file)
-                    train = data["train"]
-            else:
-                train = self.generate_fewshot_dataset(train, num_shots=num_shots)
-                data = {"train": train}
-                print(f"Saving preprocessed few-shot data to {preprocessed}")
-                with open(preprocessed, "wb") as file:
-                    pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
-
-        subsample = cfg.DATASET.SUBSAMPLE_CLASSES
-        train, test = OxfordPets.subsample_classes(train, test, subsample=subsample)
-
-        super().__init__(train_x=train, val=test, test=test)
-
-    @staticmethod
-    def read_classnames(text_file):
-        """Return a dictionary containing
-        key-value pairs of <folder name>: <class name>.
-        """
-        classnames = OrderedDict()
-        with open(text_file, "r") as f:
-            lines = f.readlines()
-            for line in lines:
-                line = line.strip().split(",")
-                folder = line[0]
-                classname = " ".join(line[1:])
-                classnames[folder] = classname
-        return classnames
-
-    def read_data(self, classnames, split_dir):
-        split_dir = os.path.join(self.dataset_dir, split_dir)
-        folders = sorted(f.name for f in os.scandir(split_dir) if f.is_dir())
-        items = []
-
-        for label, folder in enumerate(folders):
-            imnames = listdir_nohidden(os.path.join(split_dir, folder))
-            classname = classnames[folder]
-            for imname in imnames:
-                impath = os.path.join(split_dir, folder, imname)
-                item = Datum(impath=impath, label=label, classname=classname)
-                items.append(item)
-
-        return items
 
 @DATASET_REGISTRY.register()
-class ImageNet20(DatasetBase):
+class ImageNet20(ImageNetBase):
 
     dataset_dir = "imagenet20"
-
-    def __init__(self, cfg):
-        root = os.path.abspath(os.path.expanduser(cfg.DATASET.ROOT))
-        self.dataset_dir = os.path.join(root, self.dataset_dir)
-        self.image_dir = os.path.join(self.dataset_dir, "images")
-        self.preprocessed = os.path.join(self.dataset_dir, "preprocessed.pkl")
-        self.split_fewshot_dir = os.path.join(self.dataset_dir, "split_fewshot")
-        mkdir_if_missing(self.split_fewshot_dir)
-
-        if os.path.exists(self.preprocessed):
-            with open(self.preprocessed, "rb") as f:
-                preprocessed = pickle.load(f)
-                train = preprocessed["train"]
-                test = preprocessed["test"]
-        else:
-            text_file = os.path.join(self.dataset_dir, "classnames.txt")
-            classnames = self.read_classnames(text_file)
-            train = self.read_data(classnames, "train")
-            # Follow standard practice to perform evaluation on the val set
-            # Also used as the val set (so evaluate the last-step model)
-            test = self.read_data(classnames, "val")
-
-            preprocessed = {"train": train, "test": test}
-            with open(self.preprocessed, "wb") as f:
-                pickle.dump(preprocessed, f, protocol=pickle.HIGHEST_PROTOCOL)
-
-        num_shots = cfg.DATASET.NUM_SHOTS
-        if num_shots >= 1:
-            seed = cfg.SEED
-            preprocessed = os.path.join(self.split_fewshot_dir, f"shot_{num_shots}-seed_{seed}.pkl")
-            
-            if os.path.exists(preprocessed):
-                print(f"Loading preprocessed few-shot data from {preprocessed}")
-                with open(preprocessed, "rb") as file:
-                    data = pickle.load(file)
-                    train = data["train"]
-            else:
-                train = self.generate_fewshot_dataset(train, num_shots=num_shots)
-                data = {"train": train}
-                print(f"Saving preprocessed few-shot data to {preprocessed}")
-                with open(preprocessed, "wb") as file:
-                    pickle.dump(data, file, protocol=pickle.HIGHEST_PROTOCOL)
-
-        subsample = cfg.DATASET.SUBSAMPLE_CLASSES
-        train, test = OxfordPets.subsample_classes(train, test, subsample=subsample)
-
-        super().__init__(train_x=train, val=test, test=test)
-
-    @staticmethod
-    def read_classnames(text_file):
-        """Return a dictionary containing
-        key-value pairs of <folder name>: <class name>.
-        """
-        classnames = OrderedDict()
-        with open(text_file, "r") as f:
-            lines = f.readlines()
-            for line in lines:
-                line = line.strip().split(",")
-                folder = line[0]
-                classname = " ".join(line[1:])
-                classnames[folder] = classname
-        return classnames
-
-    def read_data(self, classnames, split_dir):
-        split_dir = os.path.join(self.dataset_dir, split_dir)
-        folders = sorted(f.name for f in os.scandir(split_dir) if f.is_dir())
-        items = []
-        for label, folder in enumerate(folders):
-            imnames = listdir_nohidden(os.path.join(split_dir, folder))
-            classname = classnames[folder]
-            for imname in imnames:
-                impath = os.path.join(split_dir, folder, imname)
-                item = Datum(impath=impath, label=label, classname=classname)
-                items.append(item)
-
-        return items
\ No newline at end of file
+    classnames_sep = ","
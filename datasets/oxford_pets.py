@@ -4,7 +4,9 @@ import math
 import random
 from collections import defaultdict
 
-from dassl.data.datasets import DATASET_REGISTRY, Datum, DatasetBase
+import numpy as np
+
+from dassl.data.datasets import DATASET_REGISTRY, Datum, DatumIndex, DatasetBase
 from dassl.utils import read_json, write_json, mkdir_if_missing
 
 
@@ -153,9 +155,12 @@ class OxfordPets(DatasetBase):
             return args
 
         dataset = args[0]
-        labels = set()
-        for item in dataset:
-            labels.add(item.label)
+        if isinstance(dataset, DatumIndex):
+            labels = set(np.unique(dataset.labels).tolist())
+        else:
+            labels = set()
+            for item in dataset:
+                labels.add(item.label)
         labels = list(labels)
         labels.sort()
         n = len(labels)
@@ -172,6 +177,16 @@ class OxfordPets(DatasetBase):
         output = []
 
         for dataset in args:
+            if isinstance(dataset, DatumIndex):
+                relabel = np.full(len(dataset.classnames), -1, dtype=np.int32)
+                relabel[selected] = np.arange(len(selected))
+                indices = np.flatnonzero(np.isin(dataset.labels, selected))
+                output.append(dataset.subset(
+                    indices, relabel=relabel,
+                    classnames=[dataset.classnames[y] for y in selected]
+                ))
+                continue
+
             dataset_new = []
             for item in dataset:
                 if item.label not in selected:
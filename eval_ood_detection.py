@@ -1,12 +1,18 @@
+import time
+START_TIME = time.perf_counter()
+
 import argparse
 import torch
 from dassl.utils import setup_logger, set_random_seed, collect_env_info
 from dassl.config import get_cfg_default
 from dassl.engine import build_trainer
 import numpy as np
-from utils.train_eval_util import set_val_loader, set_ood_loader_ImageNet
+from utils.train_eval_util import set_val_loader, set_ood_loader_ImageNet, set_ood_dataset_ImageNet, set_multi_loader, FirstBatchTimer, image_draft_size
 from utils.detection_util import get_and_print_results
 from utils.plot_util import plot_distribution
+from utils.feature_cache import FeatureCache
+from dassl.data.image_shards import ImageShards
+from clip_w_local import clip
 import trainers.localprompt
 import datasets.imagenet
 
@@ -29,6 +35,12 @@ def reset_cfg(cfg, args):
     if args.root:
         cfg.DATASET.ROOT = args.root
 
+    if args.image_shards:
+        cfg.DATASET.IMAGE_SHARDS = args.image_shards
+
+    if args.draft_decode:
+        cfg.INPUT.DRAFT_DECODE = True
+
     if args.output_dir:
         cfg.OUTPUT_DIR = args.output_dir
 
@@ -73,6 +85,19 @@ def extend_cfg(cfg):
     cfg.TRAINER.LOCALPROMPT.CTX_INIT = ""  # initialization words
     cfg.TRAINER.LOCALPROMPT.PREC = "amp"  # fp16, fp32, amp
     cfg.TRAINER.LOCALPROMPT.CLASS_TOKEN_POSITION = "end"  # 'middle' or 'end' or 'front'
+    cfg.TRAINER.LOCALPROMPT.CACHE_TEXT_FEATURES = True  # encode prompts once for inference
+    cfg.TRAINER.LOCALPROMPT.FEATURE_STORE = ""  # directory of precomputed training image features, empty to disable
+    cfg.TRAINER.LOCALPROMPT.FEATURE_STORE_VIEWS = 0  # augmented views encoded per training image, 0 = 2 x DATALOADER.NUM_VIEWS; fp16 global + local features take ~0.2 MB per view with ViT-B/16 (6.4 MB per image at 32 views, ~100 GB for 16-shot ImageNet)
+    cfg.TRAINER.LOCALPROMPT.SCORE_CHUNK_SIZE = 128  # prompts per chunk when computing OOD scores
+    cfg.TRAINER.LOCALPROMPT.SELECT_MICRO_BATCHES = 4  # encoder calls for all crops of a training batch, 1 = a single call
+    cfg.TRAINER.LOCALPROMPT.UPDATE_SCHEDULE = "per_pos"  # 'per_pos': one step per positive view, 'joint': one step per batch
+    cfg.TRAINER.LOCALPROMPT.TEXT_CHUNK_SIZE = 0  # prompts per text-encoder call in training, 0 = all at once
+    cfg.TRAINER.LOCALPROMPT.TEXT_CHECKPOINT = False  # recompute text-encoder activations in backward to save memory
+    cfg.TRAINER.LOCALPROMPT.GLOBAL_TEXT_CACHE = "~/.cache/clip/global_text_features"  # cache of the frozen global text features, empty to disable
+    cfg.TRAINER.LOCALPROMPT.TOKEN_CACHE = "~/.cache/clip/tokens"  # cache of tokenized prompt sets, empty to disable
+    cfg.TRAINER.LOCALPROMPT.WEIGHT_CACHE = "~/.cache/clip/weights"  # memory-mapped CLIP weights in the target precision, empty to disable
+    cfg.TRAINER.LOCALPROMPT.ATTN_BACKEND = "mha"  # attention of the CLIP transformers, 'mha' or 'sdpa' (torch >= 2.0)
+    cfg.TRAINER.LOCALPROMPT.INT8 = False  # CPU inference with an int8 image encoder and int8 cached text features
 
     cfg.DATASET.SUBSAMPLE_CLASSES = "all"  # all, base or new
 
@@ -101,10 +126,10 @@ def setup_cfg(args):
 
 
 def main(args):
-    import clip_w_local
     cfg = setup_cfg(args)
-    _, preprocess = clip_w_local.load(cfg.MODEL.BACKBONE.NAME)
-    
+    # the CLIP weights are only loaded once, by the trainer; the test transform only depends on the input size
+    preprocess = clip._transform(cfg.INPUT.SIZE[0])
+
     if cfg.SEED >= 0:
         print("Setting fixed seed: {}".format(cfg.SEED))
         set_random_seed(cfg.SEED)
@@ -114,8 +139,9 @@ def main(args):
         torch.backends.cudnn.benchmark = True
 
     print_args(args, cfg)
-    print("Collecting env info ...")
-    print("** System info **\n{}\n".format(collect_env_info()))
+    if not args.no_env_info:
+        print("Collecting env info ...")
+        print("** System info **\n{}\n".format(collect_env_info()))
 
     if args.in_dataset in ['imagenet','imagenet100']:
         out_datasets = ['iNaturalist', 'SUN', 'places365', 'Texture']
@@ -131,20 +157,49 @@ def main(args):
     trainer.load_model(args.model_dir, epoch=args.load_epoch)
     trainer.model.training  = False
     id_data_loader = set_val_loader(args, preprocess)
-    id_acc = trainer.test(id_data_loader)[0]
+
+    feature_cache = None
+    if args.feature_cache:
+        # image features only depend on the frozen CLIP weights, keyed by the checkpoint's SHA256
+        checkpoint = clip._MODELS[cfg.MODEL.BACKBONE.NAME].split("/")[-2]
+        # and on how the images are decoded and the precision of the image encoder
+        settings = {
+            "draft_size": image_draft_size(args, preprocess),
+            "prec": cfg.TRAINER.LOCALPROMPT.PREC,
+            "int8": cfg.TRAINER.LOCALPROMPT.INT8,
+        }
+        if args.image_shards:
+            shards_meta = ImageShards(args.image_shards).meta
+            settings["image_shards"] = {"short_side": shards_meta["short_side"], "quality": shards_meta["quality"]}
+        feature_cache = FeatureCache(args.feature_cache, checkpoint, settings)
+
+    if args.single_pass:
+        # one pass over the ID and all OOD sets, every image is decoded and encoded once
+        ood_datasets = [set_ood_dataset_ImageNet(args, out_dataset, preprocess) for out_dataset in out_datasets]
+        multi_loader = FirstBatchTimer(set_multi_loader(args, [id_data_loader.dataset] + ood_datasets), START_TIME)
+        id_acc, scores = trainer.test_multi(multi_loader, [args.in_dataset] + out_datasets, args.top_k, args.T,
+                                            feature_cache=feature_cache)
+        in_score_mcm, in_score_localprompt = scores[args.in_dataset]
+    else:
+        # test() evaluates the trainer's own test loader
+        trainer.test_loader = FirstBatchTimer(trainer.test_loader, START_TIME)
+        id_acc = trainer.test(id_data_loader)[0]
+        in_score_mcm, in_score_localprompt = trainer.test_ood(id_data_loader, args.top_k, args.T,
+                                                             feature_cache=feature_cache, name=args.in_dataset)
     
     print("id accuracy:{}".format(id_acc))
 
     auroc_list_mcm, aupr_list_mcm, fpr_list_mcm = [], [], []
     auroc_list_localprompt, aupr_list_localprompt, fpr_list_localprompt = [], [], []
 
-    in_score_mcm, in_score_localprompt = trainer.test_ood(id_data_loader, args.top_k, args.T)
-
     for out_dataset in out_datasets:
         print(f"Evaluting OOD dataset {out_dataset}")
-        ood_loader = set_ood_loader_ImageNet(args, out_dataset, preprocess)
-
-        out_score_mcm, out_score_localprompt = trainer.test_ood(ood_loader, args.top_k, args.T)
+        if args.single_pass:
+            out_score_mcm, out_score_localprompt = scores[out_dataset]
+        else:
+            ood_loader = set_ood_loader_ImageNet(args, out_dataset, preprocess)
+            out_score_mcm, out_score_localprompt = trainer.test_ood(ood_loader, args.top_k, args.T,
+                                                                   feature_cache=feature_cache, name=out_dataset)
         print("MCM score")
         get_and_print_results(args, in_score_mcm, out_score_mcm,
                             auroc_list_mcm, aupr_list_mcm, fpr_list_mcm)
@@ -165,6 +220,9 @@ def main(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--root", type=str, default="", help="path to dataset")
+    parser.add_argument("--image-shards", type=str, default="", help="image shard store written by pack_shards.py")
+    parser.add_argument("--draft-decode", action="store_true",
+                        help="decode JPEGs at the smallest reduced scale that is still as large as the input size")
     parser.add_argument('--in_dataset', default="", type=str, help='in-distribution dataset')
     parser.add_argument("--output-dir", type=str, default="", help="output directory")
     parser.add_argument(
@@ -211,5 +269,11 @@ if __name__ == "__main__":
                         help='temperature parameter')
     parser.add_argument('--top_k', type=int, default=10,
                         help='top_k selection of regions')
+    parser.add_argument('--single-pass', action='store_true',
+                        help='evaluate accuracy and OOD scores of all datasets in one pass over a shared loader')
+    parser.add_argument('--feature-cache', type=str, default="",
+                        help='directory to cache image features, re-scoring with new T/top_k reuses them')
+    parser.add_argument('--no-env-info', action='store_true',
+                        help='do not collect system info at startup (takes a few seconds)')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,89 @@
+'''
+export a trained LOCALPROMPT checkpoint as a standalone OOD scorer (see utils/scorer.py), a TorchScript archive with
+the image encoder, the normalized text features and the MCM and Local-Prompt scoring, loadable with torch.jit.load().
+the arguments are those of eval_ood_detection.py, export on the device the scorer will run on (USE_CUDA False for CPU).
+
+    python export_scorer.py --root data --trainer LOCALPROMPT --dataset-config-file configs/datasets/imagenet.yaml \
+        --config-file configs/trainers/LOCALPROMPT/vit_b16_ep30.yaml --model-dir output/imagenet/LOCALPROMPT/seed1 \
+        --load-epoch 30 --top_k 10 --output scorer.pt TRAINER.LOCALPROMPT.N_CTX 16 TRAINER.LOCALPROMPT.CSC True
+'''
+import time
+import argparse
+
+import torch
+from dassl.utils import set_random_seed
+from dassl.engine import build_trainer
+
+from eval_ood_detection import setup_cfg
+from utils.scorer import build_scorer, save_scorer
+
+
+def main(args):
+    cfg = setup_cfg(args)
+    if cfg.SEED >= 0:
+        set_random_seed(cfg.SEED)
+
+    trainer = build_trainer(cfg)
+    trainer.load_model(args.model_dir, epoch=args.load_epoch)
+
+    scorer = build_scorer(trainer, args.top_k, args.T)
+    save_scorer(scorer, args.output)
+    print(f"Saved the OOD scorer to {args.output}")
+
+    # the archive scores like the trainer
+    start = time.perf_counter()
+    loaded = torch.jit.load(args.output, map_location=trainer.device)
+    load_time = time.perf_counter() - start
+
+    size = cfg.INPUT.SIZE[0]
+    images = torch.randn(4, 3, size, size, device=trainer.device)
+    with torch.no_grad():
+        image_features, local_image_features = trainer.model.encode_image_features(images)
+        expected = trainer.score_ood(image_features, local_image_features, args.top_k, args.T)
+        mcm_score, local_prompt_score = loaded(images)
+    error = max(
+        abs(mcm_score.cpu().numpy() - expected[0]).max(),
+        abs(local_prompt_score.cpu().numpy() - (expected[0] + expected[1])).max()
+    )
+    print(f"Loaded in {load_time:.2f}s, max. score difference to the trainer: {error:.2e}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, default="", help="path to dataset")
+    parser.add_argument("--output", type=str, required=True, help="path of the exported scorer")
+    parser.add_argument("--output-dir", type=str, default="", help="output directory")
+    parser.add_argument("--seed", type=int, default=-1, help="only positive value enables a fixed seed")
+    parser.add_argument("--config-file", type=str, default="", help="path to config file")
+    parser.add_argument(
+        "--dataset-config-file",
+        type=str,
+        default="",
+        help="path to config file for dataset setup",
+    )
+    parser.add_argument("--trainer", type=str, default="", help="name of trainer")
+    parser.add_argument("--backbone", type=str, default="", help="name of CNN backbone")
+    parser.add_argument("--model-dir", type=str, default="", help="load model from this directory")
+    parser.add_argument("--load-epoch", type=int, help="load model weights at this epoch")
+    parser.add_argument('--num_neg_prompts', type=int, default=300,
+                        help='number of negative local prompts')
+    parser.add_argument('--T', type=float, default=1,
+                        help='default temperature of the scorer')
+    parser.add_argument('--top_k', type=int, default=10,
+                        help='default top_k selection of regions of the scorer')
+    parser.add_argument(
+        "opts",
+        default=None,
+        nargs=argparse.REMAINDER,
+        help="modify config options using the command-line",
+    )
+    args = parser.parse_args(argv)
+    # arguments of eval_ood_detection.py that do not apply to the export
+    args.resume = ""
+    args.image_shards = ""
+    args.draft_decode = False
+    return args
+
+
+if __name__ == "__main__":
+    main(parse_args())
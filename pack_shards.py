@@ -0,0 +1,36 @@
+'''
+pack the images of the training and OOD datasets into an image shard store, read with --image-shards
+(or DATASET.IMAGE_SHARDS) by train.py and eval_ood_detection.py.
+
+    python pack_shards.py --root /data --output /data/shards-256 \
+        imagenet/train imagenet/val iNaturalist SUN Places dtd/images
+'''
+import argparse
+
+from dassl.data.image_shards import pack_image_shards
+
+
+def main(args):
+    pack_image_shards(
+        args.root,
+        args.directories,
+        args.output,
+        short_side=args.short_side,
+        quality=args.quality,
+        shard_size=args.shard_size << 20,
+        num_workers=args.num_workers
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--root", type=str, required=True, help="path to dataset, the same as --root of train.py")
+    parser.add_argument("--output", type=str, required=True, help="directory of the image shard store")
+    parser.add_argument("--short-side", type=int, default=256,
+                        help="images are resized so that their shorter side is at most this long")
+    parser.add_argument("--quality", type=int, default=90, help="JPEG quality of resized images")
+    parser.add_argument("--shard-size", type=int, default=1024, help="shard file size in MiB")
+    parser.add_argument("--num-workers", type=int, default=8, help="number of processes that resize images")
+    parser.add_argument("directories", nargs="+", help="directories under --root to pack")
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,125 @@
+'''
+bulk OOD screening of a manifest or a directory of images with an exported scorer (export_scorer.py).
+
+images are streamed through the data loader, scores are written to CSV shards of --shard-size rows in the output
+directory (id, MCM score, Local-Prompt score, predicted class, -1 and empty scores for unreadable images), with the
+class names in classnames.txt. progress is checkpointed every --checkpoint-every batches, running the same command
+again resumes where a killed job stopped. memory does not depend on the number of images.
+
+    python screen_images.py --scorer scorer.pt --manifest images.txt --root /data/images --output screening
+    python screen_images.py --scorer scorer.pt --directory /data/images --output screening
+'''
+import os
+import argparse
+
+import torch
+from tqdm import tqdm
+
+from clip_w_local import clip
+from utils.bulk_score import ManifestDataset, ScoreShardWriter, Progress, write_manifest
+
+
+@torch.no_grad()
+def score_batch(scorer, images, top_k, T):
+    image_features, local_image_features = scorer.encode(images)
+    mcm_score, local_prompt_score = scorer.score_features(image_features, local_image_features, top_k, T)
+    labels = scorer.classify_features(image_features, local_image_features).argmax(dim=-1)
+    return mcm_score.cpu().tolist(), local_prompt_score.cpu().tolist(), labels.cpu().tolist()
+
+
+def main(args):
+    os.makedirs(args.output, exist_ok=True)
+    manifest, root = args.manifest, args.root
+    if args.directory:
+        # listed once, a resumed job reads the same order
+        manifest, root = os.path.join(args.output, "manifest.txt"), args.directory
+        if not os.path.isfile(manifest):
+            print(f"Listing the images under {args.directory} to {manifest}")
+            write_manifest(args.directory, manifest)
+
+    scorer = torch.jit.load(args.scorer, map_location=args.device or None)
+    device = scorer.global_text_features.device
+    top_k = args.top_k or scorer.top_k
+    T = args.T or scorer.T
+
+    settings = {
+        "manifest": os.path.abspath(manifest),
+        "manifest_size": os.path.getsize(manifest),
+        "root": os.path.abspath(root) if root else "",
+        "scorer": os.path.abspath(args.scorer),
+        "top_k": top_k,
+        "T": T,
+        "shard_size": args.shard_size,
+    }
+    progress = Progress(args.output, settings)
+    if progress.state["done"]:
+        print(f"{args.output} is complete, {progress.state['images']} images")
+        return
+    if progress.state["images"]:
+        print(f"Resuming after {progress.state['images']} images")
+
+    with open(os.path.join(args.output, "classnames.txt"), "w") as f:
+        f.write("".join(f"{name}\n" for name in scorer.classnames))
+
+    dataset = ManifestDataset(
+        manifest,
+        root=root,
+        transform=clip._transform(scorer.input_size),
+        input_size=scorer.input_size,
+        batch_size=args.batch_size,
+        start=progress.state["offset"],
+        draft_size=scorer.input_size if args.draft_decode else 0
+    )
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_size=None,
+        num_workers=args.num_workers,
+        pin_memory=device.type == "cuda"
+    )
+    writer = ScoreShardWriter(
+        args.output, args.shard_size, progress.state["images"], progress.state["shard"], progress.state["shard_bytes"]
+    )
+
+    images_done = progress.state["images"]
+    with tqdm(initial=images_done, unit="images") as bar:
+        for batch_idx, (ids, images, valid, end) in enumerate(loader):
+            mcm_score, local_prompt_score, labels = score_batch(scorer, images.to(device, non_blocking=True), top_k, T)
+            rows = []
+            for i, image_id in enumerate(ids):
+                if valid[i]:
+                    rows.append([image_id, mcm_score[i], local_prompt_score[i], labels[i]])
+                else:
+                    rows.append([image_id, "", "", -1])
+            writer.write(rows)
+            images_done += len(rows)
+            bar.update(len(rows))
+
+            if (batch_idx + 1) % args.checkpoint_every == 0:
+                progress.save(offset=end, images=images_done, shard=writer.shard, shard_bytes=writer.sync())
+
+    progress.save(offset=settings["manifest_size"], images=images_done, shard=writer.shard, shard_bytes=writer.sync(),
+                  done=True)
+    writer.close()
+    print(f"Scored {images_done} images into {writer.shard + 1} shard(s) in {args.output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scorer", type=str, required=True, help="scorer written by export_scorer.py")
+    parser.add_argument("--manifest", type=str, default="", help='one "<path>" or "<id>\\t<path>" per line')
+    parser.add_argument("--root", type=str, default="", help="directory the paths of the manifest are relative to")
+    parser.add_argument("--directory", type=str, default="", help="score all images under this directory instead")
+    parser.add_argument("--output", type=str, required=True, help="directory of the score shards and the checkpoint")
+    parser.add_argument("--device", type=str, default="", help="device of the scorer, the export device by default")
+    parser.add_argument('-b', '--batch-size', default=128, type=int, help='mini-batch size')
+    parser.add_argument("--num-workers", type=int, default=8, help="data loader workers")
+    parser.add_argument("--shard-size", type=int, default=1000000, help="rows per output shard")
+    parser.add_argument("--checkpoint-every", type=int, default=100, help="batches between checkpoints")
+    parser.add_argument('--T', type=float, default=0, help='temperature, the one of the export by default')
+    parser.add_argument('--top_k', type=int, default=0, help='top_k selection of regions, the one of the export by default')
+    parser.add_argument("--draft-decode", action="store_true",
+                        help="decode JPEGs at the smallest reduced scale that is still as large as the input size")
+    args = parser.parse_args()
+    if bool(args.manifest) == bool(args.directory):
+        parser.error("give either --manifest or --directory")
+    main(args)
@@ -0,0 +1,47 @@
+'''
+serve an exported OOD scorer (export_scorer.py) over HTTP, batching concurrent requests (see utils/scoring_server.py).
+
+    python serve_scorer.py --scorer scorer.pt --port 8000 --max-batch-size 32 --max-latency-ms 10
+    curl --data-binary @image.jpg http://127.0.0.1:8000/score
+    curl http://127.0.0.1:8000/metrics
+'''
+import asyncio
+import argparse
+
+import torch
+
+from utils.scoring_server import ScoringServer
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    scorer = torch.jit.load(args.scorer, map_location=args.device or None)
+    server = ScoringServer(
+        scorer,
+        max_batch_size=args.max_batch_size,
+        max_latency=args.max_latency_ms / 1000,
+        decode_workers=args.decode_workers,
+        draft_decode=args.draft_decode,
+        max_body_bytes=args.max_body_bytes
+    )
+    asyncio.run(server.serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scorer", type=str, required=True, help="scorer written by export_scorer.py")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--device", type=str, default="", help="device of the scorer, the export device by default")
+    parser.add_argument("--max-batch-size", type=int, default=32, help="images per encoder call")
+    parser.add_argument("--max-latency-ms", type=float, default=10,
+                        help="longest a request waits for others to fill its batch")
+    parser.add_argument("--decode-workers", type=int, default=4, help="threads decoding and preprocessing images")
+    parser.add_argument("--draft-decode", action="store_true",
+                        help="decode JPEGs at the smallest reduced scale that is still as large as the input size")
+    parser.add_argument("--max-body-bytes", type=int, default=32 * 1024 * 1024,
+                        help="largest accepted image, larger requests get a 413")
+    parser.add_argument("--threads", type=int, default=0, help="torch threads, 0 for the default")
+    args = parser.parse_args()
+    main(args)
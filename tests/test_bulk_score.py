@@ -0,0 +1,100 @@
+"""Bulk OOD screening (screen_images.py): resuming after a kill and invalid manifest rows.
+
+    python -m pytest tests/test_bulk_score.py
+"""
+import os
+import sys
+import glob
+
+import pytest
+import torchvision.transforms as transforms
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+from utils.bulk_score import ManifestDataset, ScoreShardWriter, Progress  # noqa: E402
+
+SHARD_SIZE = 4
+BATCH_SIZE = 2
+ROWS = [[f"image{i}", i / 10, i / 5, i % 3] for i in range(13)]
+
+
+def screen(directory, kill_after=None):
+    """The loop of screen_images.main() over ROWS, checkpointing after every batch.
+
+    With kill_after, the job stops without closing after kill_after checkpoints, once it has written one more
+    batch that is not checkpointed, like a job killed between two checkpoints.
+    """
+    progress = Progress(directory, {"shard_size": SHARD_SIZE})
+    if progress.state["done"]:
+        return
+    writer = ScoreShardWriter(
+        directory, SHARD_SIZE, progress.state["images"], progress.state["shard"], progress.state["shard_bytes"]
+    )
+    images_done = progress.state["images"]
+    checkpoints = 0
+    for start in range(images_done, len(ROWS), BATCH_SIZE):
+        writer.write(ROWS[start:start + BATCH_SIZE])
+        images_done += len(ROWS[start:start + BATCH_SIZE])
+        if kill_after is not None and checkpoints == kill_after:
+            # the rows of the last batch reach the disk, the progress does not
+            writer.close()
+            return
+        progress.save(offset=0, images=images_done, shard=writer.shard, shard_bytes=writer.sync())
+        checkpoints += 1
+    progress.save(images=images_done, shard=writer.shard, shard_bytes=writer.sync(), done=True)
+    writer.close()
+
+
+def read_shards(directory):
+    shards = []
+    for path in sorted(glob.glob(os.path.join(directory, "scores-*.csv"))):
+        with open(path, "r") as f:
+            shards.append(f.read())
+    return shards
+
+
+@pytest.mark.parametrize("kill_after", range(len(ROWS) // BATCH_SIZE + 1))
+def test_resume_after_kill(tmp_path, kill_after):
+    full, killed = str(tmp_path / "full"), str(tmp_path / "killed")
+    os.makedirs(full)
+    os.makedirs(killed)
+    screen(full)
+    screen(killed, kill_after=kill_after)
+    screen(killed)
+    assert read_shards(killed) == read_shards(full)
+
+
+def test_resume_at_shard_boundary(tmp_path):
+    full, killed = str(tmp_path / "full"), str(tmp_path / "killed")
+    os.makedirs(full)
+    os.makedirs(killed)
+    screen(full)
+    # checkpointed after 2 batches, exactly the rows of the first shard, then killed inside the second shard
+    screen(killed, kill_after=SHARD_SIZE // BATCH_SIZE)
+    progress = Progress(killed, {"shard_size": SHARD_SIZE})
+    assert progress.state["images"] == SHARD_SIZE and progress.state["shard"] == 0
+    screen(killed)
+    shards = read_shards(killed)
+    assert shards == read_shards(full)
+    assert len(shards) == -(-len(ROWS) // SHARD_SIZE)
+    assert all(shard.count("\n") == SHARD_SIZE + 1 for shard in shards[:-1])
+
+
+def test_invalid_rows(tmp_path, monkeypatch):
+    root = tmp_path / "images"
+    root.mkdir()
+    Image.new("RGB", (8, 8)).save(root / "good.png")
+    Image.new("RGB", (20, 20)).save(root / "bomb.png")
+    (root / "broken.jpg").write_bytes(b"not an image")
+    manifest = tmp_path / "manifest.txt"
+    manifest.write_bytes(b"good.png\nmissing.png\nbroken.jpg\nbomb.png\nbad\xff\tgood.png\nid\tgood.png\n")
+    # bomb.png has more than twice the pixels, PIL raises DecompressionBombError
+    monkeypatch.setattr(Image, "MAX_IMAGE_PIXELS", 100)
+
+    dataset = ManifestDataset(str(manifest), root=str(root), transform=transforms.ToTensor(), input_size=8, batch_size=6)
+    (ids, images, valid, end), = list(dataset)
+    assert ids == ["good.png", "missing.png", "broken.jpg", "bomb.png", "bad\\xff\tgood.png", "id"]
+    assert valid.tolist() == [True, False, False, False, False, True]
+    assert images.shape == (6, 3, 8, 8)
+    assert end == manifest.stat().st_size
@@ -0,0 +1,73 @@
+"""OOD scores from the feature cache (eval_ood_detection.py --feature-cache) against encoding the images.
+
+    python -m pytest tests/test_feature_cache.py
+"""
+import os
+import sys
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+import train  # noqa: E402
+from dassl.config import get_cfg_default  # noqa: E402
+from dassl.engine.trainer import TrainerBase  # noqa: E402
+from dassl.evaluation import build_evaluator  # noqa: E402
+from clip_w_local.model import CLIP  # noqa: E402
+from trainers.localprompt import LOCALPROMPT, CustomCLIP  # noqa: E402
+from utils.feature_cache import FeatureCache  # noqa: E402
+
+CLASSNAMES = ["dog", "cat", "bird", "fish", "horse"]
+
+
+class RandomImages(torch.utils.data.Dataset):
+    # an ImageFolder to dataset_key()
+    samples = [(f"/images/{i}.jpg", 0) for i in range(13)]
+
+    def __len__(self):
+        return len(self.samples)
+
+    def __getitem__(self, idx):
+        generator = torch.Generator().manual_seed(idx)
+        return torch.randn(3, 32, 32, generator=generator), 0
+
+
+def build_trainer():
+    """A LOCALPROMPT trainer around a small random CLIP, without a dataset."""
+    cfg = get_cfg_default()
+    train.extend_cfg(cfg)
+    cfg.INPUT.SIZE = (32, 32)
+    cfg.num_neg_prompts = 5
+    cfg.topk = 3
+    cfg.T = 1.0
+    cfg.TRAINER.LOCALPROMPT.CSC = True
+    cfg.TRAINER.LOCALPROMPT.N_CTX = 4
+    cfg.TRAINER.LOCALPROMPT.PREC = "fp32"
+    cfg.TRAINER.LOCALPROMPT.GLOBAL_TEXT_CACHE = ""
+    cfg.TRAINER.LOCALPROMPT.TOKEN_CACHE = ""
+
+    torch.manual_seed(0)
+    clip_model = CLIP(64, 32, 3, 64, 8, 77, 49408, 64, 2, 3).float().eval()
+    trainer = LOCALPROMPT.__new__(LOCALPROMPT)
+    TrainerBase.__init__(trainer)
+    trainer.cfg = cfg
+    trainer.device = torch.device("cpu")
+    trainer.model = CustomCLIP(cfg, CLASSNAMES, clip_model).eval()
+    trainer.register_model("prompt_learner", trainer.model.prompt_learner)
+    trainer.evaluator = build_evaluator(cfg, lab2cname=dict(enumerate(CLASSNAMES)))
+    return trainer
+
+
+def test_cached_scores_match(tmp_path):
+    trainer = build_trainer()
+    data_loader = torch.utils.data.DataLoader(RandomImages(), batch_size=4)
+    feature_cache = FeatureCache(str(tmp_path), "checkpoint", {"prec": "fp32"})
+
+    encoded = trainer.test_ood(data_loader, 3, 1.0)
+    # the run that builds the cache, then a run that only reads it
+    cold = trainer.test_ood(data_loader, 3, 1.0, feature_cache=feature_cache, name="images")
+    warm = trainer.test_ood(data_loader, 3, 1.0, feature_cache=feature_cache, name="images")
+    for scores in [cold, warm]:
+        for expected, actual in zip(encoded, scores):
+            np.testing.assert_array_equal(actual, expected)
@@ -0,0 +1,31 @@
+"""Image shard stores (pack_shards.py, DATASET.IMAGE_SHARDS).
+
+    python -m pytest tests/test_image_shards.py
+"""
+import os
+import sys
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Dassl"))
+from dassl.data.image_shards import ImageShards, pack_image_shards  # noqa: E402
+
+
+def test_open_through_home(tmp_path, monkeypatch):
+    # a "~" path that the shell did not expand, e.g. from a config file
+    monkeypatch.setenv("HOME", str(tmp_path))
+    image_root = tmp_path / "images"
+    (image_root / "train").mkdir(parents=True)
+    rng = np.random.default_rng(0)
+    for i in range(3):
+        Image.fromarray(rng.integers(0, 256, (16, 24, 3), dtype=np.uint8)).save(image_root / "train" / f"{i}.png")
+    pack_image_shards("~/images", ["train"], "~/shards", short_side=16, num_workers=1)
+
+    store = ImageShards("~/shards")
+    assert store.root == str(tmp_path / "shards")
+    assert len(store) == 3
+    path = str(image_root / "train" / "1.png")
+    assert path in store
+    image = store.read_image(path)
+    assert image.size == (24, 16)
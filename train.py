@@ -1,10 +1,13 @@
+import time
+START_TIME = time.perf_counter()
+
 import argparse
 import torch
 
 from dassl.utils import setup_logger, set_random_seed, collect_env_info
 from dassl.config import get_cfg_default
 from dassl.engine import build_trainer
-from utils.train_eval_util import set_val_loader
+from utils.train_eval_util import set_val_loader, FirstBatchTimer
 import trainers.localprompt
 import datasets.imagenet
 
@@ -27,6 +30,12 @@ def reset_cfg(cfg, args):
     if args.root:
         cfg.DATASET.ROOT = args.root
 
+    if args.image_shards:
+        cfg.DATASET.IMAGE_SHARDS = args.image_shards
+
+    if args.draft_decode:
+        cfg.INPUT.DRAFT_DECODE = True
+
     if args.output_dir:
         cfg.OUTPUT_DIR = args.output_dir
 
@@ -85,6 +94,19 @@ def extend_cfg(cfg):
     cfg.TRAINER.LOCALPROMPT.CTX_INIT = ""  # initialization words
     cfg.TRAINER.LOCALPROMPT.PREC = "amp"  # fp16, fp32, amp
     cfg.TRAINER.LOCALPROMPT.CLASS_TOKEN_POSITION = "end"  # 'middle' or 'end' or 'front'
+    cfg.TRAINER.LOCALPROMPT.CACHE_TEXT_FEATURES = True  # encode prompts once for inference
+    cfg.TRAINER.LOCALPROMPT.FEATURE_STORE = ""  # directory of precomputed training image features, empty to disable
+    cfg.TRAINER.LOCALPROMPT.FEATURE_STORE_VIEWS = 0  # augmented views encoded per training image, 0 = 2 x DATALOADER.NUM_VIEWS; fp16 global + local features take ~0.2 MB per view with ViT-B/16 (6.4 MB per image at 32 views, ~100 GB for 16-shot ImageNet)
+    cfg.TRAINER.LOCALPROMPT.SCORE_CHUNK_SIZE = 128  # prompts per chunk when computing OOD scores
+    cfg.TRAINER.LOCALPROMPT.SELECT_MICRO_BATCHES = 4  # encoder calls for all crops of a training batch, 1 = a single call
+    cfg.TRAINER.LOCALPROMPT.UPDATE_SCHEDULE = "per_pos"  # 'per_pos': one step per positive view, 'joint': one step per batch
+    cfg.TRAINER.LOCALPROMPT.TEXT_CHUNK_SIZE = 0  # prompts per text-encoder call in training, 0 = all at once
+    cfg.TRAINER.LOCALPROMPT.TEXT_CHECKPOINT = False  # recompute text-encoder activations in backward to save memory
+    cfg.TRAINER.LOCALPROMPT.GLOBAL_TEXT_CACHE = "~/.cache/clip/global_text_features"  # cache of the frozen global text features, empty to disable
+    cfg.TRAINER.LOCALPROMPT.TOKEN_CACHE = "~/.cache/clip/tokens"  # cache of tokenized prompt sets, empty to disable
+    cfg.TRAINER.LOCALPROMPT.WEIGHT_CACHE = "~/.cache/clip/weights"  # memory-mapped CLIP weights in the target precision, empty to disable
+    cfg.TRAINER.LOCALPROMPT.ATTN_BACKEND = "mha"  # attention of the CLIP transformers, 'mha' or 'sdpa' (torch >= 2.0)
+    cfg.TRAINER.LOCALPROMPT.INT8 = False  # CPU inference with an int8 image encoder and int8 cached text features
 
     cfg.DATASET.SUBSAMPLE_CLASSES = "all"  # all, base or new
 
@@ -123,10 +145,12 @@ def main(args):
         torch.backends.cudnn.benchmark = False
 
     print_args(args, cfg)
-    print("Collecting env info ...")
-    print("** System info **\n{}\n".format(collect_env_info()))
+    if not args.no_env_info:
+        print("Collecting env info ...")
+        print("** System info **\n{}\n".format(collect_env_info()))
 
     trainer = build_trainer(cfg)
+    trainer.train_loader_x = FirstBatchTimer(trainer.train_loader_x, START_TIME)
 
     if not args.no_train:
         trainer.train()
@@ -135,6 +159,9 @@ def main(args):
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--root", type=str, default="", help="path to dataset")
+    parser.add_argument("--image-shards", type=str, default="", help="image shard store written by pack_shards.py")
+    parser.add_argument("--draft-decode", action="store_true",
+                        help="decode JPEGs at the smallest reduced scale that is still as large as the input size")
     parser.add_argument("--output-dir", type=str, default="", help="output directory")
     parser.add_argument(
         "--resume",
@@ -170,6 +197,9 @@ if __name__ == "__main__":
     parser.add_argument(
         "--no-train", action="store_true", help="do not call trainer.train()"
     )
+    parser.add_argument(
+        "--no-env-info", action="store_true", help="do not collect system info at startup (takes a few seconds)"
+    )
     parser.add_argument(
         "opts",
         default=None,
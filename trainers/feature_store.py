@@ -0,0 +1,128 @@
+import os
+import json
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset as TorchDataset
+from tqdm import tqdm
+
+
+STORE_VERSION = 1
+
+
+class FeatureStore:
+    '''
+    On-disk store of frozen image-encoder features of augmented training views.
+
+    global.npy: [num_images, num_views, dim]
+    local.npy:  [num_images, num_views, num_regions, dim]
+    Both arrays are float16 and memory-mapped, meta.json describes the content, with the settings the features
+    depend on (a JSON-serializable dict: the training transform, how the images are decoded, the encoder dtype).
+    '''
+
+    def __init__(self, root, settings=None):
+        self.root = root
+        # as read back from meta.json, tuples become lists
+        self.settings = json.loads(json.dumps(settings or {}))
+        self.meta_file = os.path.join(root, "meta.json")
+        self.global_file = os.path.join(root, "global.npy")
+        self.local_file = os.path.join(root, "local.npy")
+        self.meta = None
+        if os.path.isfile(self.meta_file):
+            with open(self.meta_file, "r") as f:
+                self.meta = json.load(f)
+
+    def is_valid(self, backbone, num_views, key):
+        meta = self.meta
+        return (
+            meta is not None and meta["complete"] and meta["version"] == STORE_VERSION
+            and meta["backbone"] == backbone and meta["num_views"] >= num_views and meta["key"] == key
+            and meta.get("settings") == self.settings
+        )
+
+    def open(self):
+        global_features = np.load(self.global_file, mmap_mode="r")
+        local_features = np.load(self.local_file, mmap_mode="r")
+        return global_features, local_features
+
+    @torch.no_grad()
+    def build(self, image_encoder, data_loader, num_views, backbone, key, dtype, device):
+        '''
+        run the frozen image encoder over num_views augmented views of every image in data_loader.
+        data_loader must return each image exactly once per pass (no drop_last), with its "index".
+        '''
+        os.makedirs(self.root, exist_ok=True)
+        num_images = len(data_loader.dataset)
+        global_features, local_features = None, None
+
+        num_written = 0
+        num_passes = 0
+        while num_written < num_views:
+            print(f"Encoding views {num_written}-{num_views} for the feature store (pass {num_passes + 1})")
+            for batch in tqdm(data_loader):
+                index = batch["index"].numpy()
+                if "views" in batch:
+                    views = batch["views"][:num_views - num_written]
+                else:
+                    keys = sorted((k for k in batch.keys() if k.startswith("img") and k[3:].isdigit()), key=lambda k: int(k[3:]))
+                    views = [batch[k] for k in keys[:num_views - num_written]]
+                for j, view in enumerate(views):
+                    image_feature, local_image_feature = image_encoder(view.to(device).type(dtype))
+                    if global_features is None:
+                        global_features = np.lib.format.open_memmap(
+                            self.global_file, mode="w+", dtype=np.float16,
+                            shape=(num_images, num_views, image_feature.shape[-1]))
+                        local_features = np.lib.format.open_memmap(
+                            self.local_file, mode="w+", dtype=np.float16,
+                            shape=(num_images, num_views) + tuple(local_image_feature.shape[1:]))
+                    global_features[index, num_written + j] = image_feature.half().cpu().numpy()
+                    local_features[index, num_written + j] = local_image_feature.half().cpu().numpy()
+            num_written += len(views)
+            num_passes += 1
+
+        global_features.flush()
+        local_features.flush()
+        del global_features, local_features
+
+        self.meta = {
+            "version": STORE_VERSION,
+            "backbone": backbone,
+            "num_images": num_images,
+            "num_views": num_views,
+            "key": key,
+            "settings": self.settings,
+            "complete": True,
+        }
+        with open(self.meta_file, "w") as f:
+            json.dump(self.meta, f, indent=4)
+
+
+class FeatureStoreDataset(TorchDataset):
+    '''
+    Samples views_per_sample random stored views of a training image instead of decoding and encoding it.
+    '''
+
+    def __init__(self, store, data_source, views_per_sample=16):
+        self.store = store
+        self.labels = [item.label for item in data_source]
+        self.views_per_sample = views_per_sample
+        self.global_features = None
+        self.local_features = None
+
+    def __len__(self):
+        return len(self.labels)
+
+    def __getitem__(self, idx):
+        # open lazily so that each worker maps the files itself
+        if self.global_features is None:
+            self.global_features, self.local_features = self.store.open()
+
+        num_views = self.global_features.shape[1]
+        views = np.sort(np.random.choice(num_views, self.views_per_sample, replace=False))
+
+        return {
+            "label": self.labels[idx],
+            "index": idx,
+            "image_features": torch.from_numpy(np.ascontiguousarray(self.global_features[idx, views])),
+            "local_image_features": torch.from_numpy(np.ascontiguousarray(self.local_features[idx, views])),
+        }
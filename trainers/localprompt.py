@@ -8,22 +8,34 @@ from torch.cuda.amp import GradScaler, autocast
 from dassl.engine import TRAINER_REGISTRY, TrainerX
 from dassl.utils import load_pretrained_weights, load_checkpoint
 from dassl.optim import build_optimizer, build_lr_scheduler
+from dassl.data.data_manager import build_data_loader, DatasetWrapper, get_draft_size
+from dassl.data.image_shards import ImageShards
 
 from clip_w_local import clip
-from clip_w_local.simple_tokenizer import SimpleTokenizer as _Tokenizer
+from clip_w_local.model import activation_checkpoint, set_attention_backend, quantize_int8
+from .feature_store import FeatureStore, FeatureStoreDataset
+from utils.ood_score import mcm_score, local_prompt_local_score, local_class_score, text_logits, Int8TextFeatures
+from utils.feature_cache import dataset_key, data_source_key
+from utils.train_eval_util import FirstBatchTimer
 import numpy as np
 from tqdm import tqdm
 from PIL import Image
 from einops import repeat
 
-import os 
-os.environ['CUDA_LAUNCH_BLOCKING']='1'
-
-_tokenizer = _Tokenizer()
-softmax = nn.Softmax(dim=1).cuda()
+import os
+import hashlib
+from functools import partial
 
 def load_clip_to_cpu(cfg):
     backbone_name = cfg.MODEL.BACKBONE.NAME
+    weight_cache = cfg.TRAINER.LOCALPROMPT.WEIGHT_CACHE
+    if weight_cache:
+        # memory-mapped weights already in the precision the trainer runs CLIP in
+        dtype = torch.float16 if cfg.TRAINER.LOCALPROMPT.PREC == "fp16" else torch.float32
+        state_dict = clip.load_weights(backbone_name, dtype, cache_dir=os.path.expanduser(weight_cache))
+        model = clip.build_model(state_dict, assign=True)
+        return model.eval()
+
     url = clip._MODELS[backbone_name]
     model_path = clip._download(url)
 
@@ -36,27 +48,54 @@ def load_clip_to_cpu(cfg):
         state_dict = torch.load(model_path, map_location="cpu")
 
     model = clip.build_model(state_dict or model.state_dict())
-    return model.cuda().eval()
+    return model.eval()
 
 
 class TextEncoder(nn.Module):
-    def __init__(self, clip_model):
+    def __init__(self, clip_model, chunk_size=0, use_checkpoint=False):
         super().__init__()
         self.transformer = clip_model.transformer
         self.positional_embedding = clip_model.positional_embedding
         self.ln_final = clip_model.ln_final
         self.text_projection = clip_model.text_projection
         self.dtype = clip_model.dtype
+        # memory-efficient training: prompts are encoded chunk_size at a time (0: all at once) and
+        # use_checkpoint recomputes activations in backward, per chunk if chunked and per block otherwise
+        self.chunk_size = chunk_size
+        self.use_checkpoint = use_checkpoint
 
     def forward(self, prompts, tokenized_prompts):
-        x = prompts + self.positional_embedding.type(self.dtype)
+        chunk_size = self.chunk_size or prompts.shape[0]
+        if chunk_size >= prompts.shape[0]:
+            return self.encode(prompts, tokenized_prompts, use_checkpoint=self.use_checkpoint)
+
+        # bucket prompts of similar length into the same chunk, each chunk is trimmed to its longest prompt
+        order = torch.argsort(tokenized_prompts.argmax(dim=-1))
+        prompts, tokenized_prompts = prompts[order], tokenized_prompts[order]
+
+        checkpoint_chunks = self.use_checkpoint and torch.is_grad_enabled() and prompts.requires_grad
+        text_features = []
+        for start in range(0, prompts.shape[0], chunk_size):
+            chunk = prompts[start:start + chunk_size], tokenized_prompts[start:start + chunk_size]
+            if checkpoint_chunks:
+                # only the prompts of the chunk are kept for backward, peak memory is one chunk of activations
+                text_features.append(activation_checkpoint(self.encode, *chunk))
+            else:
+                text_features.append(self.encode(*chunk))
+        return torch.cat(text_features, dim=0)[torch.argsort(order)]
+
+    def encode(self, prompts, tokenized_prompts, use_checkpoint=False):
+        # take features from the eot embedding (eot_token is the highest number in each sequence)
+        # with the causal mask, positions after the last eot cannot change the eot rows, so they are dropped
+        eot = tokenized_prompts.argmax(dim=-1)
+        length = int(eot.max()) + 1
+
+        x = prompts[:, :length] + self.positional_embedding[:length].type(self.dtype)
         x = x.permute(1, 0, 2)  # NLD -> LND
-        x, _, _, _ = self.transformer(x)
+        x, _, _, _ = self.transformer(x, return_qkv=False, use_checkpoint=use_checkpoint)
         x = x.permute(1, 0, 2)  # LND -> NLD
-        x = self.ln_final(x).type(self.dtype)
-        # x.shape = [batch_size, n_ctx, transformer.width]
-        # take features from the eot embedding (eot_token is the highest number in each sequence)
-        x = x[torch.arange(x.shape[0]), tokenized_prompts.argmax(dim=-1)] @ self.text_projection
+        # x.shape = [batch_size, length, transformer.width]
+        x = self.ln_final(x[torch.arange(x.shape[0]), eot]).type(self.dtype) @ self.text_projection
 
         return x
 
@@ -69,6 +108,7 @@ class PromptLearner(nn.Module):
         n_ctx = cfg.TRAINER.LOCALPROMPT.N_CTX
         ctx_init = cfg.TRAINER.LOCALPROMPT.CTX_INIT
         dtype = clip_model.dtype
+        device = clip_model.token_embedding.weight.device
         ctx_dim = clip_model.ln_final.weight.shape[0]
         clip_imsize = clip_model.visual.input_resolution
         cfg_imsize = cfg.INPUT.SIZE[0]
@@ -79,7 +119,7 @@ class PromptLearner(nn.Module):
             # use given words to initialize context vectors
             ctx_init = ctx_init.replace("_", " ")
             n_ctx = len(ctx_init.split(" "))
-            prompt = clip.tokenize(ctx_init)
+            prompt = clip.tokenize(ctx_init).to(device)
             with torch.no_grad():
                 embedding = clip_model.token_embedding(prompt).type(dtype)
             global_ctx_vectors = embedding[0, 1 : 1 + n_ctx, :]
@@ -100,15 +140,10 @@ class PromptLearner(nn.Module):
         print(f"Number of context words (tokens): {n_ctx}")
         
         classnames = [name.replace("_", " ") for name in classnames]
-        name_lens = [len(_tokenizer.encode(name)) for name in classnames]
-        global_prompts = ["a photo of a" + " " + name + "." for name in classnames]
-        
-        global_tokenized_prompts = torch.cat([clip.tokenize(p).cuda() for p in global_prompts])
-        with torch.no_grad():
-            embedding = clip_model.token_embedding(global_tokenized_prompts).type(dtype)
-        
-        self.global_embedding = embedding
-        self.global_tokenized_prompts = global_tokenized_prompts  # torch.Tensor  #1000,77
+        # tokenized prompt sets are cached on disk, keyed by their text
+        self.token_cache = cfg.TRAINER.LOCALPROMPT.TOKEN_CACHE
+        # frozen, encoded once by CustomCLIP.build_global_text_features()
+        self.global_prompts = ["a photo of a" + " " + name + "." for name in classnames]
         self.class_token_position = cfg.TRAINER.LOCALPROMPT.CLASS_TOKEN_POSITION
 
         # for local prompt initialization: learnable
@@ -116,7 +151,7 @@ class PromptLearner(nn.Module):
             # use given words to initialize context vectors
             ctx_init = ctx_init.replace("_", " ")
             n_ctx = len(ctx_init.split(" "))
-            prompt = clip.tokenize(ctx_init)
+            prompt = clip.tokenize(ctx_init).to(device)
             with torch.no_grad():
                 embedding = clip_model.token_embedding(prompt).type(dtype)
             local_ctx_vectors = embedding[0, 1 : 1 + n_ctx, :]
@@ -136,7 +171,7 @@ class PromptLearner(nn.Module):
         self.local_ctx = nn.Parameter(local_ctx_vectors)  # to be optimized
         
         local_prompts = [prompt_prefix + " " + name + "." for name in classnames]
-        local_tokenized_prompts = torch.cat([clip.tokenize(p).cuda() for p in local_prompts])
+        local_tokenized_prompts = clip.tokenize_cached(local_prompts, cache_dir=self.token_cache).to(device)
 
         with torch.no_grad():
             embedding = clip_model.token_embedding(local_tokenized_prompts).type(dtype)
@@ -147,7 +182,8 @@ class PromptLearner(nn.Module):
         self.register_buffer("token_prefix", embedding[:, :1, :])  # SOS
         self.register_buffer("token_suffix", embedding[:, 1 + n_ctx :, :])  # CLS, EOS
 
-        self.local_tokenized_prompts = local_tokenized_prompts
+        # not trained and not saved, but moved with the module
+        self.register_buffer("local_tokenized_prompts", local_tokenized_prompts, persistent=False)
 
         # for local prompt initialization: learnable and random initialization
         print("Initializing negative local contexts")
@@ -161,7 +197,7 @@ class PromptLearner(nn.Module):
         self.neg_ctx = nn.Parameter(neg_ctx_vectors)  # to be optimized
          
         neg_prompts = [neg_prompt_prefix + " " + "." for _ in range(self.num_neg_prompts)]
-        neg_tokenized_prompts = torch.cat([clip.tokenize(p).cuda() for p in neg_prompts])
+        neg_tokenized_prompts = clip.tokenize_cached(neg_prompts, cache_dir=self.token_cache).to(device)
 
         with torch.no_grad():
             embedding = clip_model.token_embedding(neg_tokenized_prompts).type(dtype)
@@ -173,7 +209,7 @@ class PromptLearner(nn.Module):
         self.register_buffer("neg_token_prefix", embedding[:, :1, :])  # SOS
         self.register_buffer("neg_token_suffix", embedding[:, 1 + n_ctx :, :])  # CLS, EOS
         
-        self.neg_tokenized_prompts = neg_tokenized_prompts
+        self.register_buffer("neg_tokenized_prompts", neg_tokenized_prompts, persistent=False)
 
     def forward(self):
         assert self.class_token_position == 'end', 'not expected class token position.'
@@ -210,56 +246,175 @@ class PromptLearner(nn.Module):
             dim=1,
         )
 
-        return self.global_embedding, local_prompts, neg_prompts
+        return local_prompts, neg_prompts
 
 class CustomCLIP(nn.Module):
     def __init__(self, cfg, classnames, clip_model):
         super().__init__()
         self.prompt_learner = PromptLearner(cfg, classnames, clip_model)
-        self.global_tokenized_prompts = self.prompt_learner.global_tokenized_prompts
-        self.local_tokenized_prompts =self.prompt_learner.local_tokenized_prompts
-        self.neg_tokenized_prompts = self.prompt_learner.neg_tokenized_prompts
         self.image_encoder = clip_model.visual
-        self.text_encoder = TextEncoder(clip_model)
+        self.text_encoder = TextEncoder(clip_model, chunk_size=cfg.TRAINER.LOCALPROMPT.TEXT_CHUNK_SIZE,
+                                        use_checkpoint=cfg.TRAINER.LOCALPROMPT.TEXT_CHECKPOINT)
         self.logit_scale = clip_model.logit_scale
         self.dtype = clip_model.dtype
-    
+
+        # compiled inference: text features are encoded once and reused until the prompts change
+        self.cache_text_features = cfg.TRAINER.LOCALPROMPT.CACHE_TEXT_FEATURES
+        self._text_features = None
+        self._text_features_key = None
+        # CPU inference: the cached text features are kept as int8 banks, packed in chunks of the scoring chunk size
+        self.int8 = cfg.TRAINER.LOCALPROMPT.INT8
+        self.score_chunk_size = cfg.TRAINER.LOCALPROMPT.SCORE_CHUNK_SIZE
+
+        # GPNA encodes all crops of a batch in this many encoder calls
+        self.select_micro_batches = cfg.TRAINER.LOCALPROMPT.SELECT_MICRO_BATCHES
+
+        # the hand-crafted global prompts are never trained, keep only their normalized text features
+        global_text_features = self.build_global_text_features(clip_model, cfg.MODEL.BACKBONE.NAME, cfg.TRAINER.LOCALPROMPT.GLOBAL_TEXT_CACHE)
+        self.register_buffer("global_text_features", global_text_features, persistent=False)
+
+    @torch.no_grad()
+    def build_global_text_features(self, clip_model, backbone, cache_dir=""):
+        '''
+        L2-normalized text features of the global prompts [n_cls, dim], loaded from cache_dir if it has them.
+        the cache file is keyed by the backbone, every weight of its text encoder, the dtype and the prompts.
+        '''
+        global_prompts = self.prompt_learner.global_prompts
+        device = clip_model.token_embedding.weight.device
+
+        cache_file = None
+        if cache_dir:
+            h = hashlib.sha1()
+            h.update(backbone.encode())
+            # a fine-tuned text tower with the original projection gets an entry of its own
+            text_weights = {"positional_embedding": clip_model.positional_embedding,
+                            "text_projection": clip_model.text_projection}
+            for prefix in ["token_embedding", "transformer", "ln_final"]:
+                for name, tensor in getattr(clip_model, prefix).state_dict().items():
+                    text_weights[f"{prefix}.{name}"] = tensor
+            for name, tensor in text_weights.items():
+                h.update(name.encode())
+                h.update(tensor.detach().cpu().contiguous().reshape(-1).view(torch.uint8).numpy().tobytes())
+            h.update(str(self.dtype).encode())
+            for prompt in global_prompts:
+                h.update(prompt.encode())
+                h.update(b"\0")
+            cache_file = osp.join(osp.expanduser(cache_dir), f"{h.hexdigest()}.pt")
+            if osp.isfile(cache_file):
+                print(f"Loading global text features from {cache_file}")
+                return torch.load(cache_file, map_location="cpu").to(device=device, dtype=self.dtype)
+
+        global_tokenized_prompts = clip.tokenize_cached(global_prompts, cache_dir=self.prompt_learner.token_cache).to(device)
+        embedding = clip_model.token_embedding(global_tokenized_prompts).type(self.dtype)
+        global_text_features = self.text_encoder(embedding, global_tokenized_prompts)
+        global_text_features = global_text_features / global_text_features.norm(dim=-1, keepdim=True)
+
+        if cache_file is not None:
+            os.makedirs(osp.dirname(cache_file), exist_ok=True)
+            tmp_file = f"{cache_file}.{os.getpid()}.tmp"
+            torch.save(global_text_features.cpu(), tmp_file)
+            os.replace(tmp_file, cache_file)
+        return global_text_features
+
+    @property
+    def local_tokenized_prompts(self):
+        return self.prompt_learner.local_tokenized_prompts
+
+    @property
+    def neg_tokenized_prompts(self):
+        return self.prompt_learner.neg_tokenized_prompts
+
+    def _prompt_state_key(self):
+        # in-place updates (optimizer steps, load_state_dict) bump the version counter of a tensor,
+        # moving the module to another device or dtype changes its storage
+        tensors = list(self.prompt_learner.parameters()) + list(self.prompt_learner.buffers())
+        return tuple((t.data_ptr(), t._version) for t in tensors)
+
+    def encode_text_features(self):
+        '''
+        encode local and negative prompts, return L2-normalized text features (global ones are precomputed).
+        '''
+        local_prompts, neg_prompts = self.prompt_learner()
+
+        global_text_features = self.global_text_features
+        local_text_features = self.text_encoder(local_prompts, self.local_tokenized_prompts)
+        neg_text_features = self.text_encoder(neg_prompts, self.neg_tokenized_prompts)
+
+        local_text_features = local_text_features / local_text_features.norm(dim=-1, keepdim=True)
+        neg_text_features = neg_text_features / neg_text_features.norm(dim=-1, keepdim=True)
+
+        return global_text_features, local_text_features, neg_text_features
+
+    def compile_text_features(self):
+        '''
+        encode the text features once and cache them for inference.
+        '''
+        with torch.no_grad():
+            self._text_features = self.encode_text_features()
+        if self.int8:
+            self._text_features = tuple(Int8TextFeatures(t, self.score_chunk_size) for t in self._text_features)
+        self._text_features_key = self._prompt_state_key()
+        return self._text_features
+
+    def invalidate_text_features(self):
+        self._text_features = None
+        self._text_features_key = None
+
+    def text_features(self):
+        '''
+        return normalized text features, re-encoding the cached ones if prompt parameters have changed.
+        '''
+        if not self.cache_text_features:
+            return self.encode_text_features()
+
+        if self._text_features is None or self._text_features_key != self._prompt_state_key():
+            self.compile_text_features()
+        return self._text_features
+
     def multi_loader_select(self, images, label):
         '''
         Global Prompt Guided Negative Augmentation
         select images according to similarity between global image features label texts.
+        images: list of [batch, 3, H, W] crops or a [crop, batch, 3, H, W] tensor.
         '''
         with torch.no_grad():
+            if isinstance(images, (list, tuple)):
+                images = torch.stack(images, dim=0)
+            num_crops, batch_size = images.shape[:2]
+
+            # fold the crops into the batch dimension and encode them in a few large calls
             image_features, local_image_features = [], []
-            similarity_list = []
-            
-            for image in images:
+            for image in images.flatten(0, 1).chunk(self.select_micro_batches, dim=0):
                 image_feature, local_image_feature = self.image_encoder(image.type(self.dtype))
                 image_features.append(image_feature)
                 local_image_features.append(local_image_feature)
 
-            global_prompts, _, _ = self.prompt_learner()
-            global_tokenized_prompts = self.global_tokenized_prompts
-            global_text_features = self.text_encoder(global_prompts, global_tokenized_prompts)
-            global_text_features = global_text_features / global_text_features.norm(dim=-1, keepdim=True)
+            image_features = torch.cat(image_features, dim=0).unflatten(0, (num_crops, batch_size))
+            local_image_features = torch.cat(local_image_features, dim=0).unflatten(0, (num_crops, batch_size))
 
-            image_features = [image_feature / image_feature.norm(dim=-1, keepdim=True) for image_feature in image_features]
-            global_text_selected_label = global_text_features.gather(0, label[...,None].expand_as(image_features[0]))
+            return self.select_by_global_prompts(image_features, local_image_features, label)
 
-            for image_feature in image_features:
-                similarity_list.append(torch.nn.functional.cosine_similarity(image_feature, global_text_selected_label, dim=-1))
+    def select_by_global_prompts(self, image_features, local_image_features, label):
+        '''
+        similarity between (unnormalized) global image features of every view and the global text feature of the label.
+        image_features: [view, batch, dim], local_image_features: [view, batch, regions, dim].
+        '''
+        with torch.no_grad():
+            global_text_features = self.global_text_features
+
+            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+            global_text_selected_label = global_text_features[label]
+
+            # [view, batch]
+            similarity_list = torch.nn.functional.cosine_similarity(image_features, global_text_selected_label[None], dim=-1)
 
-            image_features = torch.stack(image_features,dim=0)
-            local_image_features = torch.stack(local_image_features,dim=0)
-            similarity_list = torch.stack(similarity_list,dim=0)
-            
             return similarity_list, image_features, local_image_features
 
     def forward(self, images, image_features=None, local_image_features=None, max_list=None, min_list=None):
         if self.training:
             num_region, dimension = local_image_features.shape[-2:]
 
-            _, local_prompts, neg_prompts = self.prompt_learner()
+            local_prompts, neg_prompts = self.prompt_learner()
 
             local_tokenized_prompts = self.local_tokenized_prompts
             neg_tokenized_prompts = self.neg_tokenized_prompts
@@ -269,8 +424,9 @@ class CustomCLIP(nn.Module):
             
             # positive and negative feature selection
             with torch.no_grad():
-                pos_local_image_features = local_image_features.gather(0,repeat(max_list, 'q b -> q b n c', n=num_region, c = dimension)).squeeze()
-                neg_local_image_features = local_image_features.gather(0,repeat(min_list, 'q b -> q b n c', n=num_region, c = dimension)).squeeze()
+                # several selected views are folded into the batch dimension, view-major
+                pos_local_image_features = local_image_features.gather(0,repeat(max_list, 'q b -> q b n c', n=num_region, c = dimension)).flatten(0, 1)
+                neg_local_image_features = local_image_features.gather(0,repeat(min_list, 'q b -> q b n c', n=num_region, c = dimension)).flatten(0, 1)
 
             pos_local_image_features = pos_local_image_features / pos_local_image_features.norm(dim=-1, keepdim=True)
             neg_local_image_features = neg_local_image_features / neg_local_image_features.norm(dim=-1, keepdim=True)
@@ -293,32 +449,29 @@ class CustomCLIP(nn.Module):
             return logits_local, p2n_logits_local, n2p_logits_local, neg_logits_local, loss_div
 
         else: # for inference
-            global_prompts, local_prompts, neg_prompts = self.prompt_learner()
-
-            global_tokenized_prompts = self.global_tokenized_prompts
-            local_tokenized_prompts = self.local_tokenized_prompts
-            neg_tokenized_prompts = self.neg_tokenized_prompts
+            image_features, local_image_features = self.encode_image_features(images)
+            return self.logits_from_features(image_features, local_image_features)
 
-            global_text_features = self.text_encoder(global_prompts, global_tokenized_prompts)
-            local_text_features = self.text_encoder(local_prompts, local_tokenized_prompts)
-            neg_text_features = self.text_encoder(neg_prompts, neg_tokenized_prompts)
-            
-            image_features, local_image_features = self.image_encoder(images.type(self.dtype))
-            
-            image_features = image_features / image_features.norm(dim=-1, keepdim=True)
-            local_image_features = local_image_features / local_image_features.norm(dim=-1, keepdim=True)
+    def encode_image_features(self, images):
+        '''
+        L2-normalized global and local image features.
+        '''
+        image_features, local_image_features = self.image_encoder(images.type(self.dtype))
             
-            global_text_features = global_text_features / global_text_features.norm(dim=-1, keepdim=True)
-            local_text_features = local_text_features / local_text_features.norm(dim=-1, keepdim=True)
-            neg_text_features = neg_text_features / neg_text_features.norm(dim=-1, keepdim=True)
+        image_features = image_features / image_features.norm(dim=-1, keepdim=True)
+        local_image_features = local_image_features / local_image_features.norm(dim=-1, keepdim=True)
+        return image_features, local_image_features
 
-            logit_scale = self.logit_scale.exp()
+    def logits_from_features(self, image_features, local_image_features):
+        global_text_features, local_text_features, neg_text_features = self.text_features()
+
+        logit_scale = self.logit_scale.exp()
 
-            logits = logit_scale * image_features @ global_text_features.t()
-            logits_local = logit_scale * local_image_features @ local_text_features.t()
-            neg_logits_local = logit_scale * local_image_features @ neg_text_features.t()
+        logits = text_logits(logit_scale * image_features, global_text_features)
+        logits_local = text_logits(logit_scale * local_image_features, local_text_features)
+        neg_logits_local = text_logits(logit_scale * local_image_features, neg_text_features)
             
-            return logits, logits_local, neg_logits_local
+        return logits, logits_local, neg_logits_local
 
 @TRAINER_REGISTRY.register()
 class LOCALPROMPT(TrainerX):
@@ -328,6 +481,7 @@ class LOCALPROMPT(TrainerX):
 
     def check_cfg(self, cfg):
         assert cfg.TRAINER.LOCALPROMPT.PREC in ["fp16", "fp32", "amp"]
+        assert cfg.TRAINER.LOCALPROMPT.UPDATE_SCHEDULE in ["per_pos", "joint"]
 
     def build_model(self):
         cfg = self.cfg
@@ -336,12 +490,15 @@ class LOCALPROMPT(TrainerX):
         self.T = cfg.T
 
         print(f"Loading CLIP (backbone: {cfg.MODEL.BACKBONE.NAME})")
-        clip_model = load_clip_to_cpu(cfg)
+        # the custom CLIP computes its fixed prompt embeddings and global text features on the trainer's device
+        clip_model = load_clip_to_cpu(cfg).to(self.device)
 
         if cfg.TRAINER.LOCALPROMPT.PREC == "fp32" or cfg.TRAINER.LOCALPROMPT.PREC == "amp":
             # CLIP's default precision is fp16
             clip_model.float()
 
+        set_attention_backend(clip_model, cfg.TRAINER.LOCALPROMPT.ATTN_BACKEND)
+
         print("Building custom CLIP")
         self.model = CustomCLIP(cfg, classnames, clip_model)
 
@@ -354,6 +511,11 @@ class LOCALPROMPT(TrainerX):
             load_pretrained_weights(self.model.prompt_learner, cfg.MODEL.INIT_WEIGHTS)
 
         self.model.to(self.device)
+        if cfg.TRAINER.LOCALPROMPT.INT8:
+            # int8 image encoder and text features, see quantize_int8() and Int8TextFeatures
+            if self.device.type != "cpu" or cfg.TRAINER.LOCALPROMPT.PREC == "fp16":
+                raise ValueError("INT8 is only supported for fp32/amp inference on the CPU")
+            quantize_int8(self.model.image_encoder)
         # NOTE: only give prompt_learner to the optimizer
         self.optim = build_optimizer(self.model.prompt_learner, cfg.OPTIM)
         self.sched = build_lr_scheduler(self.optim, cfg.OPTIM)
@@ -412,33 +574,60 @@ class LOCALPROMPT(TrainerX):
 
         return loss_local_neg
 
+    def forward_loss(self, image, image_features, local_image_features, max_list, min_list, label):
+        '''
+        total loss for the positive views in max_list [num_views, batch] and the negative views in min_list [1, batch].
+        '''
+        output_local, p2n_output_local, n2p_output_local, neg_output_local, loss_div= self.model(image, image_features, local_image_features, max_list, min_list)
+
+        # Local Prompt Enhanced Regional Regularization
+        # calculate local loss, positive views are stacked view-major in the batch dimension
+        loss_local = self.calculate_loss_local(output_local, n2p_output_local, label.repeat(max_list.shape[0]))
+        loss_local_negative = self.calculate_loss_local_neg(neg_output_local, p2n_output_local, label)
+
+        # calculate total loss for LOCALPROMPT
+        loss = loss_local + self.lambda_value * loss_local_negative + self.div_value * loss_div
+        return loss, loss_local, loss_local_negative, loss_div
+
+    def update(self, loss):
+        self.optim.zero_grad()
+        if self.scaler is None:
+            loss.backward()
+            self.optim.step()
+        else:
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optim)
+            self.scaler.update()
+
     def forward_backward(self, batch):
         image, label = self.parse_batch_train(batch)
         prec = self.cfg.TRAINER.LOCALPROMPT.PREC
         num_pos = self.cfg.num_pos
         self.lambda_value = self.cfg.lambda_value
         self.div_value = self.cfg.div_value
-        if prec == "amp":
+        if prec == "fp16":
+            raise NotImplementedError('fp16 suffers from nan loss. Should be amp, or fp32 with TEXT_CHUNK_SIZE/TEXT_CHECKPOINT to avoid oom')
+
+        if "image_features" in batch:
+            # views were encoded offline, see build_feature_store()
+            image_features, local_image_features = self.parse_batch_features(batch)
+            similarity_list, image_features, local_image_features = self.model.select_by_global_prompts(image_features, local_image_features, label)
+        else:
             similarity_list, image_features, local_image_features = self.model.multi_loader_select(image, label)
-            max_list, min_list = torch.topk(similarity_list, k=num_pos, dim=0)[1], torch.topk(similarity_list, k=num_pos, largest=False, dim=0)[1]
-            
-            for i in range(num_pos):
-                with autocast():
-                    output_local, p2n_output_local, n2p_output_local, neg_output_local, loss_div= self.model(image, image_features, local_image_features, max_list[i:i+1,:], min_list[0:1,:])
-                    
-                    # Local Prompt Enhanced Regional Regularization
-                    # calculate local loss 
-                    loss_local = self.calculate_loss_local(output_local, n2p_output_local, label)
-                    loss_local_negative = self.calculate_loss_local_neg(neg_output_local, p2n_output_local, label)
-
-                    # calculate total loss for LOCALPROMPT
-                    loss = loss_local + self.lambda_value * loss_local_negative + self.div_value * loss_div
-                self.optim.zero_grad()
-                self.scaler.scale(loss).backward()
-                self.scaler.step(self.optim)
-                self.scaler.update()
+        # views ranked by similarity: the most similar ones are positives, the least similar one is the negative
+        order = torch.argsort(similarity_list, dim=0, descending=True)
+        max_list, min_list = order[:num_pos], order.flip(0)[:num_pos]
+
+        if self.cfg.TRAINER.LOCALPROMPT.UPDATE_SCHEDULE == "joint":
+            # one text-encoder pass and one step for all positive views, the loss is averaged over them
+            with autocast(enabled=prec == "amp"):
+                loss, loss_local, loss_local_negative, loss_div = self.forward_loss(image, image_features, local_image_features, max_list, min_list[0:1,:], label)
+            self.update(loss)
         else:
-            raise NotImplementedError('fp32 easily falls into oom and fp16 suffers from nan loss. Should be amp')
+            for i in range(num_pos):
+                with autocast(enabled=prec == "amp"):
+                    loss, loss_local, loss_local_negative, loss_div = self.forward_loss(image, image_features, local_image_features, max_list[i:i+1,:], min_list[0:1,:], label)
+                self.update(loss)
 
         loss_summary = {
             "loss": loss.item(),
@@ -453,6 +642,14 @@ class LOCALPROMPT(TrainerX):
         return loss_summary
 
     def parse_batch_train(self, total_batch):
+        if "image_features" in total_batch:
+            return None, total_batch["label"].to(self.device)
+
+        if "views" in total_batch:
+            # [view, batch, 3, H, W] in one transfer, the layout of multi_loader_select
+            inputs = total_batch["views"].to(self.device, non_blocking=True)
+            return inputs, total_batch["label"].to(self.device)
+
         num = 1
         # get number of random_crop
         for key in total_batch.keys():
@@ -465,6 +662,81 @@ class LOCALPROMPT(TrainerX):
         label = total_batch["label"].to(self.device)
         return inputs, label
 
+    def parse_batch_features(self, batch):
+        # [batch, view, ...] -> [view, batch, ...], the layout of multi_loader_select
+        dtype = self.model.dtype
+        image_features = batch["image_features"].to(self.device).type(dtype).transpose(0, 1)
+        local_image_features = batch["local_image_features"].to(self.device).type(dtype).transpose(0, 1)
+        return image_features, local_image_features
+
+    def before_train(self):
+        super().before_train()
+        if self.cfg.TRAINER.LOCALPROMPT.FEATURE_STORE:
+            self.build_feature_store()
+
+    def build_feature_store(self):
+        '''
+        encode FEATURE_STORE_VIEWS augmented views of every training image once with the frozen image encoder,
+        then train the prompts on features sampled from the on-disk store.
+        '''
+        cfg = self.cfg
+        # same number of views per step as DatasetWrapper produces crops
+        views_per_sample = cfg.DATALOADER.NUM_VIEWS
+        # a few times the views of a step, every view takes (1 + regions) x dim fp16 values on disk
+        num_views = cfg.TRAINER.LOCALPROMPT.FEATURE_STORE_VIEWS or 2 * views_per_sample
+        assert num_views >= views_per_sample, f"FEATURE_STORE_VIEWS must be at least {views_per_sample}"
+
+        data_source = self.dm.dataset.train_x
+        draft_size = get_draft_size(cfg, augment=True)
+        # stored views are stale if the augmentation, the decoding or the encoder precision changes
+        settings = {
+            "input": cfg.INPUT,
+            "batched_views": cfg.DATALOADER.BATCHED_VIEWS,
+            "draft_size": draft_size,
+            "image_shards": None,
+            "dtype": str(self.model.dtype),
+        }
+        if cfg.DATASET.IMAGE_SHARDS:
+            shards_meta = ImageShards(cfg.DATASET.IMAGE_SHARDS).meta
+            settings["image_shards"] = {"short_side": shards_meta["short_side"], "quality": shards_meta["quality"]}
+        store = FeatureStore(cfg.TRAINER.LOCALPROMPT.FEATURE_STORE, settings)
+        key = data_source_key(data_source)
+
+        if store.is_valid(cfg.MODEL.BACKBONE.NAME, num_views, key):
+            print(f"Loading image features from {store.root}")
+        else:
+            print(f"Building feature store at {store.root}")
+            # every image exactly once per pass, with the training augmentation
+            data_loader = build_data_loader(
+                cfg,
+                sampler_type="SequentialSampler",
+                data_source=data_source,
+                batch_size=cfg.DATALOADER.TRAIN_X.BATCH_SIZE,
+                tfm=self.dm.train_loader_x.dataset.transform,
+                is_train=False,
+                # decoded for the training transform, not for testing
+                dataset_wrapper=partial(
+                    DatasetWrapper, num_views=views_per_sample, draft_size=draft_size
+                ),
+            )
+            self.set_model_mode("eval")
+            store.build(self.model.image_encoder, data_loader, num_views, cfg.MODEL.BACKBONE.NAME, key, self.model.dtype, self.device)
+
+        batch_size = cfg.DATALOADER.TRAIN_X.BATCH_SIZE
+        train_loader_x = torch.utils.data.DataLoader(
+            FeatureStoreDataset(store, data_source, views_per_sample=views_per_sample),
+            batch_size=batch_size,
+            shuffle=True,
+            num_workers=cfg.DATALOADER.NUM_WORKERS,
+            drop_last=len(data_source) >= batch_size,
+            pin_memory=(torch.cuda.is_available() and cfg.USE_CUDA),
+        )
+        # keep a wrapper of the image loader (train.py's FirstBatchTimer), around the feature loader
+        if isinstance(self.train_loader_x, FirstBatchTimer):
+            self.train_loader_x.data_loader = train_loader_x
+        else:
+            self.train_loader_x = train_loader_x
+
     def load_model(self, directory, epoch=None):
         if not directory:
             print("Note that load_model() is skipped as no pretrained model is given")
@@ -501,6 +773,10 @@ class LOCALPROMPT(TrainerX):
             # set strict=False
             self._models[name].load_state_dict(state_dict, strict=False)
 
+        if self.cfg.TRAINER.LOCALPROMPT.CACHE_TEXT_FEATURES:
+            print("Caching text features for inference")
+            self.model.compile_text_features()
+
     @torch.no_grad()
     def test(self, split=None):
         """A generic testing pipeline."""
@@ -528,8 +804,7 @@ class LOCALPROMPT(TrainerX):
             output_global /= 100.0
             output_local /= 100.0
 
-            local_score = torch.topk(torch.exp(output_local/self.T), k=self.top_k, dim=1)[0]
-            output = torch.exp(output_global)*torch.mean(local_score,dim=1)
+            output = self.classify(output_global, output_local)
 
             outputs.append(F.softmax(output,dim=-1).data.cpu().numpy())
             pred = output.max(dim=1)[1]
@@ -553,35 +828,158 @@ class LOCALPROMPT(TrainerX):
 
         return list(results.values())[0], np.concatenate(outputs,axis=0), list_correct
 
+    def classify(self, output_global, output_local):
+        '''
+        class scores combining global logits and the top-k regional evidence (logits already divided by 100).
+        '''
+        local_score = torch.topk(torch.exp(output_local/self.T), k=self.top_k, dim=1)[0]
+        return torch.exp(output_global)*torch.mean(local_score,dim=1)
+
+    def classify_features(self, image_features, local_image_features):
+        '''
+        same class scores as classify(), computed from normalized features in chunks of classes.
+        '''
+        global_text_features, local_text_features, _ = self.model.text_features()
+        logit_scale = self.model.logit_scale.exp()
+        chunk_size = self.cfg.TRAINER.LOCALPROMPT.SCORE_CHUNK_SIZE
+
+        output_global = text_logits(logit_scale * image_features, global_text_features)
+        output_global /= 100.0
+        local_score = local_class_score(local_image_features, local_text_features, logit_scale, self.top_k, self.T, chunk_size=chunk_size)
+        return torch.exp(output_global)*local_score
+
     @torch.no_grad()
-    def test_ood(self, data_loader, top_k, T):
-        """Test-time OOD detection pipeline."""
-        to_np = lambda x: x.data.cpu().numpy()
+    def test_multi(self, data_loader, names, top_k, T, feature_cache=None):
+        """Single-pass evaluation over the ID set and the OOD sets.
+
+        data_loader interleaves all datasets (see utils.train_eval_util.set_multi_loader) and yields
+        (images, labels, source), the dataset names[0] is in-distribution. Every image is encoded once and
+        gives the ID accuracy (for the ID set), the MCM score and the Local-Prompt score together.
+        If a FeatureCache is given, the features of every dataset are also written to it.
+
+        Returns the ID accuracy and a dict mapping each name to its (mcm_score, local_prompt_score).
+        """
+        concat = lambda x: np.concatenate(x, axis=0)
+
+        self.set_model_mode("eval")
+        self.evaluator.reset()
+
+        writers = None
+        if feature_cache is not None:
+            writers = []
+            for name, tagged in zip(names, data_loader.dataset.datasets):
+                dataset = tagged.dataset
+                writers.append(feature_cache.writer(name, dataset_key(dataset), len(dataset)))
+
+        mcm_scores = [[] for _ in names]
+        local_prompt_scores = [[] for _ in names]
+
+        for batch_idx, (images, labels, source) in enumerate(tqdm(data_loader)):
+            images = images.to(self.device)
+            labels = labels.to(self.device)
+            source = source.numpy()
+
+            image_features, local_image_features = self.model.encode_image_features(images)
+            if writers is not None:
+                global_np, local_np = image_features.cpu().numpy(), local_image_features.cpu().numpy()
+                for s in np.unique(source):
+                    writers[s].append(global_np[source == s], local_np[source == s])
+
+            mcm_global_score, mcm_local_score = self.score_ood(image_features, local_image_features, top_k, T)
+
+            is_id = torch.from_numpy(source == 0).to(self.device)
+            if is_id.any():
+                output = self.classify_features(image_features[is_id], local_image_features[is_id])
+                self.evaluator.process(output, labels[is_id])
+
+            for s in np.unique(source):
+                mcm_scores[s].append(mcm_global_score[source == s])
+                local_prompt_scores[s].append(mcm_global_score[source == s] + mcm_local_score[source == s])
+
+        if writers is not None:
+            for writer in writers:
+                writer.close()
+
+        results = self.evaluator.evaluate()
+        scores = {name: (concat(mcm_scores[s]), concat(local_prompt_scores[s])) for s, name in enumerate(names)}
+        return list(results.values())[0], scores
+
+    @torch.no_grad()
+    def test_ood(self, data_loader, top_k, T, feature_cache=None, name=None):
+        """Test-time OOD detection pipeline.
+
+        If a FeatureCache is given, the normalized image features of the dataset are computed once and stored
+        under name, later calls (e.g. with other top_k and T) only score the cached features.
+        """
         concat = lambda x: np.concatenate(x, axis=0)
 
         self.set_model_mode("eval")
         self.evaluator.reset()
+
+        if feature_cache is not None:
+            return self.test_ood_cached(data_loader, top_k, T, feature_cache, name)
         
-        mcm_score = []
-        local_prompt_score = []
+        mcm_scores = []
+        local_prompt_scores = []
 
         for batch_idx, (images, labels, *id_flag) in enumerate(tqdm(data_loader)):
-            images = images.cuda()
-
-            output, output_local, neg_output_local = self.model_inference(images)
+            images = images.to(self.device)
 
-            output /= 100.0
-            output_local /= 100.0
-            neg_output_local /= 100.0
+            image_features, local_image_features = self.model.encode_image_features(images)
+            mcm_global_score, mcm_local_score = self.score_ood(image_features, local_image_features, top_k, T)
 
-            smax_global = to_np(F.softmax(output/T, dim=-1))
-            mcm_global_score = -np.max(smax_global, axis=1)
-            mcm_score.append(mcm_global_score)
-            
-            N, C = output_local.shape[1:]
-            smax_local = torch.topk((torch.exp(output_local/T)/ \
-                torch.sum(torch.exp(torch.cat((output_local, neg_output_local),dim=-1)/T),dim=-1,keepdim=True)).reshape(-1, N*C), k=top_k, dim=-1)[0]
-            mcm_local_score= -to_np(torch.mean(smax_local,dim=1))
-            local_prompt_score.append(mcm_global_score + mcm_local_score)
+            mcm_scores.append(mcm_global_score)
+            local_prompt_scores.append(mcm_global_score + mcm_local_score)
             
-        return concat(mcm_score)[:len(data_loader.dataset)].copy(), concat(local_prompt_score)[:len(data_loader.dataset)].copy()
+        return concat(mcm_scores)[:len(data_loader.dataset)].copy(), concat(local_prompt_scores)[:len(data_loader.dataset)].copy()
+
+    def score_ood(self, image_features, local_image_features, top_k, T):
+        '''
+        MCM score and the regional part of the Local-Prompt score from normalized image features, as numpy arrays.
+        the regional score is streamed over prompts, so memory does not grow with the number of classes.
+        '''
+        to_np = lambda x: x.data.cpu().numpy()
+        global_text_features, local_text_features, neg_text_features = self.model.text_features()
+        logit_scale = self.model.logit_scale.exp()
+        chunk_size = self.cfg.TRAINER.LOCALPROMPT.SCORE_CHUNK_SIZE
+
+        output = text_logits(logit_scale * image_features, global_text_features)
+        output /= 100.0
+
+        mcm_global_score = to_np(mcm_score(output, T))
+        mcm_local_score = to_np(local_prompt_local_score(local_image_features, local_text_features, neg_text_features,
+                                                         logit_scale, top_k, T, chunk_size=chunk_size))
+        return mcm_global_score, mcm_local_score
+
+    def test_ood_cached(self, data_loader, top_k, T, feature_cache, name):
+        concat = lambda x: np.concatenate(x, axis=0)
+        dataset = data_loader.dataset
+        key = dataset_key(dataset)
+
+        if not feature_cache.exists(name, key):
+            print(f"Caching image features of {name} to {feature_cache.entry(name, key)}")
+            feature_cache.write(name, key, len(dataset), self.iter_image_features(data_loader))
+        global_features, local_features = feature_cache.open(name, key)
+
+        mcm_scores = []
+        local_prompt_scores = []
+
+        batch_size = data_loader.batch_size
+        for start in tqdm(range(0, len(global_features), batch_size)):
+            image_features = torch.from_numpy(np.array(global_features[start:start + batch_size]))
+            local_image_features = torch.from_numpy(np.array(local_features[start:start + batch_size]))
+            image_features = image_features.to(self.device).type(self.model.dtype)
+            local_image_features = local_image_features.to(self.device).type(self.model.dtype)
+
+            mcm_global_score, mcm_local_score = self.score_ood(image_features, local_image_features, top_k, T)
+
+            mcm_scores.append(mcm_global_score)
+            local_prompt_scores.append(mcm_global_score + mcm_local_score)
+
+        return concat(mcm_scores), concat(local_prompt_scores)
+
+    def iter_image_features(self, data_loader):
+        for images, *_ in tqdm(data_loader):
+            images = images.to(self.device)
+            image_features, local_image_features = self.model.encode_image_features(images)
+            yield image_features.cpu().numpy(), local_image_features.cpu().numpy()
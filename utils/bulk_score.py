@@ -0,0 +1,180 @@
+import io
+import os
+import csv
+import json
+
+import torch
+from dassl.data.image_shards import IMAGE_EXTENSIONS
+from dassl.utils import read_image
+
+
+PROGRESS_VERSION = 2
+HEADER = ["id", "mcm_score", "local_prompt_score", "class"]
+
+
+def write_manifest(directory, manifest):
+    '''
+    list the image files under directory (relative paths, one per line) into manifest, streaming the directory
+    entries so that memory does not grow with the number of files. the order is that of the file system, it is
+    fixed once the manifest is written.
+    '''
+    tmp_manifest = f"{manifest}.tmp"
+    with open(tmp_manifest, "w") as f:
+        stack = [directory]
+        while stack:
+            with os.scandir(stack.pop()) as entries:
+                for entry in entries:
+                    if entry.is_dir():
+                        stack.append(entry.path)
+                    elif entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                        f.write(os.path.relpath(entry.path, directory) + "\n")
+    os.replace(tmp_manifest, manifest)
+
+
+class ManifestDataset(torch.utils.data.IterableDataset):
+    '''
+    Streams the images of a manifest in batches, without holding the manifest in memory.
+
+    Every line of the manifest is a path or "<id>\\t<path>", paths are relative to root, the id defaults to the
+    path. Reading starts at byte offset start. The manifest is cut into chunks of batch_size lines and chunk i is
+    loaded by data loader worker i % num_workers, so DataLoader(batch_size=None) yields the chunks in manifest
+    order. A batch is (ids, images, valid, end): valid is False for images that cannot be read (their image is
+    zeros), end is the byte offset of the manifest after the batch, to resume from.
+    '''
+
+    def __init__(self, manifest, root="", transform=None, input_size=224, batch_size=128, start=0, draft_size=0):
+        self.manifest = manifest
+        self.root = root
+        self.transform = transform
+        self.input_size = input_size
+        self.batch_size = batch_size
+        self.start = start
+        self.draft_size = draft_size
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        worker_id, num_workers = (worker_info.id, worker_info.num_workers) if worker_info else (0, 1)
+
+        with open(self.manifest, "rb") as f:
+            f.seek(self.start)
+            offset = self.start
+            chunk, index = [], 0
+            for line in f:
+                offset += len(line)
+                line = line.rstrip(b"\r\n")
+                if not line:
+                    continue
+                chunk.append(line)
+                if len(chunk) == self.batch_size:
+                    if index % num_workers == worker_id:
+                        yield self.load(chunk, offset)
+                    chunk, index = [], index + 1
+            if chunk and index % num_workers == worker_id:
+                yield self.load(chunk, offset)
+
+    def load(self, chunk, end):
+        ids, images, valid = [], [], []
+        for line in chunk:
+            # the id of a line that is not UTF-8
+            image_id = line.decode("utf-8", "backslashreplace")
+            try:
+                image_id, _, path = line.decode("utf-8").partition("\t")
+                path = path or image_id
+                images.append(self.transform(read_image(os.path.join(self.root, path), self.draft_size)))
+                valid.append(True)
+            except Exception:
+                # whatever a broken file makes PIL raise (DecompressionBombError, SyntaxError, ...) is an invalid row
+                images.append(torch.zeros(3, self.input_size, self.input_size))
+                valid.append(False)
+            ids.append(image_id)
+        return ids, torch.stack(images), torch.tensor(valid), end
+
+
+class ScoreShardWriter:
+    '''
+    Writes score rows to CSV shards of shard_size rows, <directory>/scores-<shard>.csv, each with a header.
+
+    Resuming after images rows continues shard, the one open when the progress was saved (a full shard if images
+    ended exactly at a shard boundary), truncated to shard_bytes, its size then. rows written after the last
+    checkpoint are dropped and written again.
+    '''
+
+    def __init__(self, directory, shard_size, images=0, shard=0, shard_bytes=0):
+        self.directory = directory
+        self.shard_size = shard_size
+        self.shard = shard
+        self.rows = images - shard * shard_size
+        assert 0 <= self.rows <= shard_size, f"{images} rows do not end in shard {shard} of {shard_size} rows"
+        self.file = None
+        self.open(shard_bytes)
+
+    def path(self, shard):
+        return os.path.join(self.directory, f"scores-{shard:05d}.csv")
+
+    def open(self, shard_bytes=0):
+        path = self.path(self.shard)
+        if shard_bytes:
+            self.file = open(path, "r+b")
+            self.file.truncate(shard_bytes)
+            self.file.seek(shard_bytes)
+        else:
+            self.file = open(path, "wb")
+            self.write_rows([HEADER])
+
+    def write_rows(self, rows):
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        self.file.write(buffer.getvalue().encode("utf-8"))
+
+    def write(self, rows):
+        while rows:
+            if self.rows == self.shard_size:
+                self.file.close()
+                self.shard += 1
+                self.rows = 0
+                self.open()
+            n = min(len(rows), self.shard_size - self.rows)
+            self.write_rows(rows[:n])
+            self.rows += n
+            rows = rows[n:]
+
+    def sync(self):
+        '''
+        flush the current shard to disk, return its size.
+        '''
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class Progress:
+    '''
+    Checkpoint of a bulk scoring job, <directory>/progress.json: the manifest offset, the number of rows written and
+    the open shard with its size.
+
+    The job settings are stored with it, a checkpoint of other settings (or another manifest) is not resumed.
+    '''
+
+    def __init__(self, directory, settings):
+        self.file = os.path.join(directory, "progress.json")
+        self.settings = settings
+        self.state = {"offset": 0, "images": 0, "shard": 0, "shard_bytes": 0, "done": False}
+        if os.path.isfile(self.file):
+            with open(self.file, "r") as f:
+                saved = json.load(f)
+            if saved.get("version") != PROGRESS_VERSION or saved["settings"] != settings:
+                raise ValueError(f"{self.file} is a checkpoint of other settings, {saved['settings']}, "
+                                 f"use another output directory")
+            self.state = saved["state"]
+
+    def save(self, **state):
+        self.state.update(state)
+        tmp_file = f"{self.file}.tmp"
+        with open(tmp_file, "w") as f:
+            json.dump({"version": PROGRESS_VERSION, "settings": self.settings, "state": self.state}, f, indent=4)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.file)
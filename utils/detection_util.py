@@ -2,7 +2,6 @@ import torch
 import torch.nn.functional as F
 import numpy as np
 from tqdm import tqdm
-import sklearn.metrics as sk
 import clip_w_local
 
 
@@ -80,17 +79,74 @@ def fpr_and_fdr_at_recall(y_true, y_score, recall_level=0.95, pos_label=None):
 
 
 def get_measures(_pos, _neg, recall_level=0.95):
-    pos = np.array(_pos[:]).reshape((-1, 1))
-    neg = np.array(_neg[:]).reshape((-1, 1))
-    examples = np.squeeze(np.vstack((pos, neg)))
-    labels = np.zeros(len(examples), dtype=np.int32)
-    labels[:len(pos)] += 1
+    auroc, aupr, fpr = get_measures_batch(_pos, _neg, recall_levels=(recall_level,))
 
-    auroc = sk.roc_auc_score(labels, examples)
-    aupr = sk.average_precision_score(labels, examples)
-    fpr = fpr_and_fdr_at_recall(labels, examples, recall_level)
+    return float(auroc), float(aupr), float(fpr[0])
 
-    return auroc, aupr, fpr
+
+def get_measures_batch(_pos, _neg, recall_levels=(0.95,)):
+    """AUROC, AUPR and FPR at each recall level for one or many score vectors.
+
+    Each row is sorted once and all metrics are derived from the same cumulative pass, with tied scores
+    handled like sklearn's roc_auc_score / average_precision_score and fpr_and_fdr_at_recall.
+
+    Parameters
+    ----------
+    _pos : array-like, shape [..., n_pos]
+        scores of the positive (in-distribution) samples, e.g. a T/top_k grid stacked along leading dims
+    _neg : array-like, shape [..., n_neg]
+        scores of the negative (out-of-distribution) samples, same leading dims as _pos
+    recall_levels : sequence of float
+
+    Returns
+    -------
+    auroc, aupr : arrays of shape [...]
+    fpr : array of shape [..., len(recall_levels)]
+    """
+    pos = np.asarray(_pos)
+    neg = np.asarray(_neg)
+    examples = np.concatenate((pos, neg), axis=-1)
+    labels = np.zeros(examples.shape[-1], dtype=np.int64)
+    labels[:pos.shape[-1]] = 1
+    num_pos, num_neg = pos.shape[-1], neg.shape[-1]
+
+    # sort once, by decreasing score
+    desc_score_indices = np.argsort(examples, axis=-1, kind="mergesort")[..., ::-1]
+    y_score = np.take_along_axis(examples, desc_score_indices, axis=-1)
+    y_true = labels[desc_score_indices]
+
+    # a threshold sits at the last position of every run of tied scores
+    is_threshold = np.ones(y_score.shape, dtype=bool)
+    is_threshold[..., :-1] = np.diff(y_score, axis=-1) != 0
+
+    tps = np.cumsum(y_true, axis=-1)
+    fps = np.cumsum(1 - y_true, axis=-1)
+
+    # cumulative counts at the threshold closing the run of each sample, and at the previous threshold
+    run_tps = np.minimum.accumulate(np.where(is_threshold, tps, np.iinfo(np.int64).max)[..., ::-1], axis=-1)[..., ::-1]
+    run_fps = np.minimum.accumulate(np.where(is_threshold, fps, np.iinfo(np.int64).max)[..., ::-1], axis=-1)[..., ::-1]
+    prev_tps = np.zeros_like(tps)
+    prev_tps[..., 1:] = np.maximum.accumulate(np.where(is_threshold, tps, 0), axis=-1)[..., :-1]
+
+    # trapezoidal ROC area: each negative covers the positives ranked above it, half of those tied with it
+    auroc = np.sum((1 - y_true) * (prev_tps + run_tps), axis=-1) / (2.0 * num_pos * num_neg)
+
+    # average precision: each positive adds the precision at the threshold closing its run
+    aupr = np.sum(y_true * run_tps / (run_tps + run_fps), axis=-1) / num_pos
+
+    # FPR at the threshold whose recall is closest to each level, ties resolved towards lower thresholds,
+    # only thresholds up to the first one reaching full recall are considered
+    recall = tps / num_pos
+    positions = np.arange(examples.shape[-1])
+    last_ind = np.argmax(tps == num_pos, axis=-1)
+    candidates = is_threshold & (positions <= last_ind[..., None])
+    fpr = []
+    for recall_level in recall_levels:
+        distance = np.where(candidates, np.abs(recall - recall_level), np.inf)
+        cutoff = examples.shape[-1] - 1 - np.argmin(distance[..., ::-1], axis=-1)
+        fpr.append(np.take_along_axis(fps, cutoff[..., None], axis=-1)[..., 0] / num_neg)
+
+    return auroc, aupr, np.stack(fpr, axis=-1)
 
 
 def get_and_print_results(args, in_score, out_score, auroc_list, aupr_list, fpr_list):
@@ -0,0 +1,133 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+from dassl.data.datasets import DatumIndex
+
+
+CACHE_VERSION = 2
+
+
+def data_source_key(data_source):
+    '''
+    identify a Dassl data source (DatumIndex or list of Datum) by its ordered list of image files.
+    '''
+    h = hashlib.sha1()
+    if isinstance(data_source, DatumIndex):
+        # the same bytes as the list of Datum, without creating them
+        paths, offsets = data_source.paths, data_source.offsets
+        for start, end in zip(offsets[:-1], offsets[1:]):
+            h.update(paths[start:end].tobytes())
+            h.update(b"\0")
+    else:
+        for item in data_source:
+            h.update(item.impath.encode())
+            h.update(b"\0")
+    return h.hexdigest()
+
+
+def dataset_key(dataset):
+    '''
+    identify a dataset by its ordered list of image files: the samples of a torchvision ImageFolder, or the
+    data source (DatumIndex or list of Datum) of a Dassl DatasetWrapper.
+    '''
+    samples = getattr(dataset, "samples", None)
+    data_source = getattr(dataset, "data_source", None)
+    if samples is not None:
+        h = hashlib.sha1()
+        for path, _ in samples:
+            h.update(path.encode())
+            h.update(b"\0")
+        return h.hexdigest()
+    if data_source is not None:
+        return data_source_key(data_source)
+    raise TypeError(f"cannot identify the images of a {type(dataset).__name__}, "
+                    f"expected an ImageFolder or a Dassl DatasetWrapper")
+
+
+class FeatureCache:
+    '''
+    Versioned on-disk cache of normalized image features for OOD evaluation.
+
+    Layout: <root>/v<version>/<checkpoint>/<dataset>-<key>-<settings>/{global.npy, local.npy, meta.json}
+    where <checkpoint> is the hash of the frozen CLIP weights that produced the features and <settings> the hash of
+    the other settings they depend on (a JSON-serializable dict, e.g. how the images are decoded). The features do
+    not depend on the learned prompts, so every prompt checkpoint and every (T, top_k) reuses the same entry.
+    '''
+
+    def __init__(self, root, checkpoint, settings=None):
+        self.root = os.path.join(root, f"v{CACHE_VERSION}", checkpoint)
+        self.settings = settings or {}
+        self.settings_key = hashlib.sha1(json.dumps(self.settings, sort_keys=True).encode()).hexdigest()
+
+    def entry(self, name, key):
+        return os.path.join(self.root, f"{name}-{key[:16]}-{self.settings_key[:8]}")
+
+    def exists(self, name, key):
+        meta_file = os.path.join(self.entry(name, key), "meta.json")
+        if not os.path.isfile(meta_file):
+            return False
+        with open(meta_file, "r") as f:
+            meta = json.load(f)
+        return meta["complete"] and meta["key"] == key and meta.get("settings") == self.settings
+
+    def open(self, name, key):
+        entry = self.entry(name, key)
+        global_features = np.load(os.path.join(entry, "global.npy"), mmap_mode="r")
+        local_features = np.load(os.path.join(entry, "local.npy"), mmap_mode="r")
+        return global_features, local_features
+
+    def writer(self, name, key, num_images):
+        return FeatureCacheWriter(self.entry(name, key), name, key, num_images, self.settings)
+
+    def write(self, name, key, num_images, batches):
+        '''
+        stream (global [b, dim], local [b, regions, dim]) numpy batches into the cache, in dataset order.
+        '''
+        writer = self.writer(name, key, num_images)
+        for image_features, local_image_features in batches:
+            writer.append(image_features, local_image_features)
+        writer.close()
+
+
+class FeatureCacheWriter:
+    '''
+    Appends feature batches of one dataset, in dataset order, to a cache entry. features are stored in the dtype
+    of the first batch, the one of the encoder, so cached features score exactly like the encoded ones.
+    '''
+
+    def __init__(self, entry, name, key, num_images, settings=None):
+        os.makedirs(entry, exist_ok=True)
+        self.entry = entry
+        self.name = name
+        self.key = key
+        self.num_images = num_images
+        self.settings = settings or {}
+        self.global_features = None
+        self.local_features = None
+        self.start = 0
+
+    def append(self, image_features, local_image_features):
+        if self.global_features is None:
+            self.global_features = np.lib.format.open_memmap(
+                os.path.join(self.entry, "global.npy"), mode="w+", dtype=image_features.dtype,
+                shape=(self.num_images,) + image_features.shape[1:])
+            self.local_features = np.lib.format.open_memmap(
+                os.path.join(self.entry, "local.npy"), mode="w+", dtype=local_image_features.dtype,
+                shape=(self.num_images,) + local_image_features.shape[1:])
+        end = min(self.start + len(image_features), self.num_images)
+        self.global_features[self.start:end] = image_features[:end - self.start]
+        self.local_features[self.start:end] = local_image_features[:end - self.start]
+        self.start = end
+
+    def close(self):
+        assert self.start == self.num_images, f"expected {self.num_images} images, got {self.start}"
+        self.global_features.flush()
+        self.local_features.flush()
+        self.global_features, self.local_features = None, None
+
+        meta = {"version": CACHE_VERSION, "name": self.name, "key": self.key, "settings": self.settings,
+                "num_images": self.num_images, "complete": True}
+        with open(os.path.join(self.entry, "meta.json"), "w") as f:
+            json.dump(meta, f, indent=4)
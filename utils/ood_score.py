@@ -0,0 +1,101 @@
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class Int8TextFeatures:
+    '''
+    int8 bank of text features [n, dim] for CPU inference, with a scale per feature row.
+
+    the bank is split into chunks of chunk_size rows, each packed once as a dynamically quantized linear layer, so
+    logits against image features run as int8 matrix products. use text_logits() and chunked_logits() for logits.
+    '''
+
+    def __init__(self, text_features, chunk_size=0):
+        self.shape = text_features.shape
+        self.chunk_size = chunk_size or self.shape[0]
+        qconfig_spec = {nn.Linear: torch.quantization.per_channel_dynamic_qconfig}
+        self.chunks = []
+        for start in range(0, self.shape[0], self.chunk_size):
+            linear = nn.Linear(self.shape[1], min(self.chunk_size, self.shape[0] - start), bias=False)
+            linear.weight.data = text_features[start:start + self.chunk_size].detach().float().cpu()
+            self.chunks.append(torch.quantization.quantize_dynamic(nn.Sequential(linear), qconfig_spec, dtype=torch.qint8)[0])
+
+    def __len__(self):
+        return self.shape[0]
+
+
+def chunked_logits(image_features, text_features, chunk_size=128):
+    '''
+    yield image_features @ text_features[start:start + chunk_size].t() for each chunk of the text features in order.
+    an Int8TextFeatures bank is iterated in its own chunks.
+    '''
+    if isinstance(text_features, Int8TextFeatures):
+        for chunk in text_features.chunks:
+            yield chunk(image_features.float())
+        return
+    for start in range(0, text_features.shape[0], chunk_size):
+        yield image_features @ text_features[start:start + chunk_size].t()
+
+
+def text_logits(image_features, text_features):
+    '''
+    image_features @ text_features.t(), for text feature tensors and Int8TextFeatures banks.
+    '''
+    if isinstance(text_features, Int8TextFeatures):
+        return torch.cat(list(chunked_logits(image_features, text_features)), dim=-1)
+    return image_features @ text_features.t()
+
+
+def mcm_score(output, T):
+    '''
+    negative maximum concept matching score of global logits (cosine similarities), shape [batch].
+    '''
+    smax_global = F.softmax(output / T, dim=-1)
+    return -torch.max(smax_global, dim=-1)[0]
+
+
+def local_prompt_local_score(local_image_features, local_text_features, neg_text_features, logit_scale, top_k, T, chunk_size=128):
+    '''
+    regional part of the Local-Prompt score from normalized local image features [batch, regions, dim], shape [batch].
+
+    Each region is normalized with a softmax over both positive and negative local prompts, the score is the mean of
+    the top_k region/class probabilities of positive prompts. Prompts are streamed in chunks of chunk_size with a
+    running log-sum-exp and a running per-region top-k, so at most [batch, regions, top_k + chunk_size] logits are
+    alive at a time, independent of the number of classes.
+    '''
+    B, N = local_image_features.shape[:2]
+    max_logit = local_image_features.new_full((B, N), float("-inf"), dtype=torch.float32)
+    sum_exp = local_image_features.new_zeros((B, N), dtype=torch.float32)
+    topk_logits = local_image_features.new_empty((B, N, 0), dtype=torch.float32)
+
+    for text_features, positive in ((local_text_features, True), (neg_text_features, False)):
+        for logits in chunked_logits(logit_scale * local_image_features, text_features, chunk_size):
+            # same logits as test_ood: logit_scale * cosine / 100
+            logits = logits.float() / 100.0
+
+            chunk_max = torch.max(logits / T, dim=-1)[0]
+            new_max = torch.maximum(max_logit, chunk_max)
+            sum_exp = sum_exp * torch.exp(max_logit - new_max) + torch.sum(torch.exp(logits / T - new_max[..., None]), dim=-1)
+            max_logit = new_max
+
+            if positive:
+                # the ranking inside a region does not depend on its normalizer, keep its top_k positive logits
+                candidates = torch.cat((topk_logits, logits), dim=-1)
+                topk_logits = torch.topk(candidates, k=min(top_k, candidates.shape[-1]), dim=-1)[0]
+
+    log_prob = topk_logits / T - (max_logit + torch.log(sum_exp))[..., None]
+    smax_local = torch.exp(torch.topk(log_prob.reshape(B, -1), k=top_k, dim=-1)[0])
+    return -torch.mean(smax_local, dim=1)
+
+
+def local_class_score(local_image_features, local_text_features, logit_scale, top_k, T, chunk_size=128):
+    '''
+    per-class mean of the top_k regional exp(logit / T) used for classification, shape [batch, classes],
+    computed in chunks of chunk_size classes.
+    '''
+    local_score = []
+    for logits in chunked_logits(logit_scale * local_image_features, local_text_features, chunk_size):
+        logits = logits / 100.0
+        local_score.append(torch.mean(torch.topk(torch.exp(logits/T), k=top_k, dim=1)[0], dim=1))
+    return torch.cat(local_score, dim=-1)
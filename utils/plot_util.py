@@ -1,15 +1,12 @@
-import seaborn as sns
-from matplotlib import pyplot as plt
-from  matplotlib.ticker import FormatStrFormatter
 import numpy as np
 import os
-import pandas as pd
-import torch
-import seaborn as sns
-import torch.nn.functional as F
 
 
 def plot_distribution(args, id_scores, ood_scores, out_dataset, score=None):
+    # seaborn and matplotlib are slow to import, only load them when plotting
+    import seaborn as sns
+    from matplotlib import pyplot as plt
+
     sns.set(style="white", palette="muted")
     palette = ['#A8BAE3', '#55AB83']
 
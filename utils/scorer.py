@@ -0,0 +1,162 @@
+'''
+standalone OOD scorer of a trained LOCALPROMPT model, written by export_scorer.py as a TorchScript archive.
+
+the archive holds the traced image encoder, the normalized global, local and negative text features and the scoring
+code, so it loads with torch alone (no Dassl, yacs, dataset or repo code):
+
+    scorer = torch.jit.load("scorer.pt", map_location="cpu")
+    mcm_score, local_prompt_score = scorer(images)  # or scorer(images, top_k, T)
+
+images are preprocessed like the evaluation (clip._transform(scorer.input_size), normalized with scorer.mean and
+scorer.std). scores are negative like test_ood(), the larger the score, the more in-distribution the image.
+'''
+import os
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+class OODScorer(nn.Module):
+    '''
+    MCM and Local-Prompt scores of images, the same computation as LOCALPROMPT.encode_image_features() and
+    score_ood(), in TorchScript. top_k and T default to the values given at export and can be passed per call.
+    '''
+
+    def __init__(self, image_encoder, global_text_features, local_text_features, neg_text_features, logit_scale,
+                 top_k=10, T=1.0, chunk_size=128, classnames=(), input_size=224, mean=(), std=()):
+        super().__init__()
+        self.image_encoder = image_encoder
+        self.register_buffer("global_text_features", global_text_features)
+        self.register_buffer("local_text_features", local_text_features)
+        self.register_buffer("neg_text_features", neg_text_features)
+        self.register_buffer("logit_scale", logit_scale)
+
+        self.top_k: int = top_k
+        self.T: float = T
+        self.chunk_size: int = chunk_size or max(len(local_text_features), len(neg_text_features))
+        self.classnames: List[str] = list(classnames)
+        self.input_size: int = input_size
+        self.mean: List[float] = list(mean)
+        self.std: List[float] = list(std)
+
+    @torch.jit.export
+    def encode(self, images: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        L2-normalized global [batch, dim] and local [batch, regions, dim] image features.
+        '''
+        image_features, local_image_features = self.image_encoder(images.to(self.global_text_features.dtype))
+        image_features = image_features / image_features.norm(p=2, dim=-1, keepdim=True)
+        local_image_features = local_image_features / local_image_features.norm(p=2, dim=-1, keepdim=True)
+        return image_features, local_image_features
+
+    @torch.jit.export
+    def local_score(self, local_image_features: torch.Tensor, top_k: int, T: float) -> torch.Tensor:
+        '''
+        regional part of the Local-Prompt score, streamed over prompts like utils.ood_score.local_prompt_local_score().
+        '''
+        B, N = local_image_features.shape[0], local_image_features.shape[1]
+        features = self.logit_scale * local_image_features
+        max_logit = torch.full((B, N), float("-inf"), dtype=torch.float32, device=features.device)
+        sum_exp = torch.zeros((B, N), dtype=torch.float32, device=features.device)
+        topk_logits = torch.empty((B, N, 0), dtype=torch.float32, device=features.device)
+
+        for text_features, positive in [(self.local_text_features, True), (self.neg_text_features, False)]:
+            for start in range(0, text_features.shape[0], self.chunk_size):
+                logits = (features @ text_features[start:start + self.chunk_size].t()).float() / 100.0
+
+                chunk_max = torch.max(logits / T, dim=-1)[0]
+                new_max = torch.maximum(max_logit, chunk_max)
+                sum_exp = sum_exp * torch.exp(max_logit - new_max) + torch.sum(torch.exp(logits / T - new_max[..., None]), dim=-1)
+                max_logit = new_max
+
+                if positive:
+                    candidates = torch.cat((topk_logits, logits), dim=-1)
+                    topk_logits = torch.topk(candidates, k=min(top_k, candidates.shape[-1]), dim=-1)[0]
+
+        log_prob = topk_logits / T - (max_logit + torch.log(sum_exp))[..., None]
+        smax_local = torch.exp(torch.topk(log_prob.reshape(B, -1), k=top_k, dim=-1)[0])
+        return -torch.mean(smax_local, dim=1)
+
+    @torch.jit.export
+    def score_features(self, image_features: torch.Tensor, local_image_features: torch.Tensor,
+                       top_k: int, T: float) -> Tuple[torch.Tensor, torch.Tensor]:
+        '''
+        MCM score and Local-Prompt score [batch] of normalized image features.
+        '''
+        output = (self.logit_scale * image_features) @ self.global_text_features.t()
+        output = output / 100.0
+        mcm_score = -torch.max(F.softmax(output / T, dim=-1), dim=-1)[0]
+        return mcm_score, mcm_score + self.local_score(local_image_features, top_k, T)
+
+    @torch.jit.export
+    def classify_features(self, image_features: torch.Tensor, local_image_features: torch.Tensor) -> torch.Tensor:
+        '''
+        class scores of LOCALPROMPT.classify_features() [batch, classes], with the top_k and T given at export.
+        '''
+        logit_scale = self.logit_scale
+        output_global = (logit_scale * image_features) @ self.global_text_features.t() / 100.0
+        local_score = []
+        for start in range(0, self.local_text_features.shape[0], self.chunk_size):
+            logits = (logit_scale * local_image_features) @ self.local_text_features[start:start + self.chunk_size].t() / 100.0
+            local_score.append(torch.mean(torch.topk(torch.exp(logits / self.T), k=self.top_k, dim=1)[0], dim=1))
+        return torch.exp(output_global) * torch.cat(local_score, dim=-1)
+
+    @torch.jit.export
+    def classify(self, images: torch.Tensor) -> torch.Tensor:
+        image_features, local_image_features = self.encode(images)
+        return self.classify_features(image_features, local_image_features)
+
+    def forward(self, images: torch.Tensor, top_k: Optional[int] = None,
+                T: Optional[float] = None) -> Tuple[torch.Tensor, torch.Tensor]:
+        image_features, local_image_features = self.encode(images)
+        return self.score_features(
+            image_features,
+            local_image_features,
+            self.top_k if top_k is None else top_k,
+            self.T if T is None else T
+        )
+
+
+@torch.no_grad()
+def build_scorer(trainer, top_k, T, example_batch_size=2):
+    '''
+    script an OODScorer of a LOCALPROMPT trainer (after load_model), with its image encoder traced on random images.
+    '''
+    model = trainer.model
+    cfg = trainer.cfg
+    model.training = False
+    model.eval()
+
+    # the float text features, an INT8 model keeps int8 banks for its own scoring
+    global_text_features, local_text_features, neg_text_features = model.encode_text_features()
+
+    size = cfg.INPUT.SIZE[0]
+    example = torch.randn(example_batch_size, 3, size, size, device=trainer.device).type(model.dtype)
+    image_encoder = torch.jit.trace(model.image_encoder, example)
+
+    scorer = OODScorer(
+        image_encoder,
+        global_text_features.detach().clone(),
+        local_text_features.detach().clone(),
+        neg_text_features.detach().clone(),
+        model.logit_scale.exp().detach().clone(),
+        top_k=top_k,
+        T=T,
+        chunk_size=cfg.TRAINER.LOCALPROMPT.SCORE_CHUNK_SIZE,
+        classnames=trainer.dm.dataset.classnames,
+        input_size=size,
+        mean=cfg.INPUT.PIXEL_MEAN,
+        std=cfg.INPUT.PIXEL_STD
+    )
+    return torch.jit.script(scorer)
+
+
+def save_scorer(scorer, path):
+    '''
+    save a scripted OODScorer, written to a temporary file first so readers never see a partial archive.
+    '''
+    tmp_path = f"{path}.tmp"
+    torch.jit.save(scorer, tmp_path)
+    os.replace(tmp_path, path)
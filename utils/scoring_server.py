@@ -0,0 +1,263 @@
+'''
+micro-batching HTTP scoring service around an exported OOD scorer (export_scorer.py), started by serve_scorer.py.
+
+    POST /score    body: one encoded image  ->  {"mcm_score", "local_prompt_score", "class", "classname"}
+    GET  /metrics  ->  queue depth, batch sizes and request counters
+
+images are decoded and preprocessed on a thread pool, then queued. the batcher takes everything queued (up to
+max_batch_size images) and waits for more until the oldest image has waited max_latency seconds, so a lone request is
+delayed by at most max_latency and concurrent requests share one encoder call. scores are those of test_ood() and
+the class is the argmax of classify_features(), with the top_k and T of the export.
+
+bodies that cannot be decoded get a 400, bodies larger than max_body_bytes a 413 and scoring failures a 500.
+'''
+import io
+import json
+import time
+import asyncio
+from http import HTTPStatus
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import torch
+from dassl.utils import read_image
+
+from clip_w_local import clip
+
+
+class HTTPError(Exception):
+    '''
+    a request that cannot be read, answered with status before the connection is closed.
+    '''
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ScoringServer:
+    def __init__(self, scorer, max_batch_size=32, max_latency=0.01, decode_workers=4, draft_decode=False,
+                 max_body_bytes=32 * 1024 * 1024):
+        self.scorer = scorer
+        self.device = scorer.global_text_features.device
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.max_body_bytes = max_body_bytes
+        # the preprocessing of eval_ood_detection.py
+        self.preprocess = clip._transform(scorer.input_size)
+        self.draft_size = scorer.input_size if draft_decode else 0
+
+        self.decode_pool = ThreadPoolExecutor(decode_workers)
+        # the model runs on a thread of its own, off the event loop
+        self.score_pool = ThreadPoolExecutor(1)
+        self.queue = None
+
+        self.decoding = 0
+        self.requests = 0
+        self.errors = 0
+        self.images = 0
+        self.batch_sizes = Counter()
+        self.last_batch_size = 0
+
+    def decode(self, data):
+        return self.preprocess(read_image(io.BytesIO(data), self.draft_size))
+
+    @torch.no_grad()
+    def score_batch(self, images):
+        images = torch.stack(images).to(self.device)
+        image_features, local_image_features = self.scorer.encode(images)
+        mcm_score, local_prompt_score = self.scorer.score_features(
+            image_features, local_image_features, self.scorer.top_k, self.scorer.T
+        )
+        labels = self.scorer.classify_features(image_features, local_image_features).argmax(dim=-1)
+
+        results = []
+        for mcm, local_prompt, label in zip(mcm_score.tolist(), local_prompt_score.tolist(), labels.tolist()):
+            classname = self.scorer.classnames[label] if label < len(self.scorer.classnames) else ""
+            results.append({"mcm_score": mcm, "local_prompt_score": local_prompt, "class": label, "classname": classname})
+        return results
+
+    async def decode_image(self, data):
+        loop = asyncio.get_running_loop()
+        self.decoding += 1
+        try:
+            return await loop.run_in_executor(self.decode_pool, self.decode, data)
+        finally:
+            self.decoding -= 1
+
+    async def score_image(self, image):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        await self.queue.put((loop.time(), image, future))
+        return await future
+
+    async def score(self, data):
+        return await self.score_image(await self.decode_image(data))
+
+    async def next_batch(self):
+        loop = asyncio.get_running_loop()
+        queued_at, image, future = await self.queue.get()
+        batch = [(image, future)]
+        deadline = queued_at + self.max_latency
+        while len(batch) < self.max_batch_size:
+            if self.queue.empty():
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    _, image, future = await asyncio.wait_for(self.queue.get(), timeout)
+                except asyncio.TimeoutError:
+                    break
+            else:
+                _, image, future = self.queue.get_nowait()
+            batch.append((image, future))
+        return batch
+
+    async def batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            images, futures = zip(*await self.next_batch())
+            try:
+                results = await loop.run_in_executor(self.score_pool, self.score_batch, images)
+            except Exception as e:
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            self.images += len(images)
+            self.batch_sizes[len(images)] += 1
+            self.last_batch_size = len(images)
+            for future, result in zip(futures, results):
+                # the client may have gone away
+                if not future.done():
+                    future.set_result(result)
+
+    def metrics(self):
+        batches = sum(self.batch_sizes.values())
+        return {
+            "queue_depth": self.queue.qsize() if self.queue is not None else 0,
+            "decoding": self.decoding,
+            "requests": self.requests,
+            "errors": self.errors,
+            "images": self.images,
+            "batches": batches,
+            "mean_batch_size": self.images / batches if batches else 0.0,
+            "last_batch_size": self.last_batch_size,
+            "batch_sizes": {str(size): count for size, count in sorted(self.batch_sizes.items())},
+            "max_batch_size": self.max_batch_size,
+            "max_latency_ms": self.max_latency * 1000,
+        }
+
+    async def route(self, method, path, body):
+        if method == "POST" and path == "/score":
+            self.requests += 1
+            try:
+                # anything PIL raises on a malformed body (including DecompressionBombError and SyntaxError)
+                image = await self.decode_image(body)
+            except Exception as e:
+                self.errors += 1
+                return 400, {"error": f"cannot decode image: {e!r}"}
+            try:
+                return 200, await self.score_image(image)
+            except Exception as e:
+                self.errors += 1
+                return 500, {"error": repr(e)}
+        if method == "GET" and path == "/metrics":
+            return 200, self.metrics()
+        return 404, {"error": f"no route {method} {path}"}
+
+    async def read_request(self, reader):
+        '''
+        (method, path, version, headers, body) of the next request, None at the end of the connection. raises
+        HTTPError for a malformed request line or header and for a body larger than max_body_bytes.
+        '''
+        try:
+            request_line = await reader.readline()
+        except ValueError:
+            # longer than the stream limit
+            raise HTTPError(400, "request line too long")
+        if not request_line:
+            return None
+        parts = request_line.decode("latin-1").split()
+        if len(parts) != 3 or not parts[2].startswith("HTTP/"):
+            raise HTTPError(400, f"malformed request line {request_line[:100]!r}")
+        method, path, version = parts
+
+        headers = {}
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise HTTPError(400, "header line too long")
+            if line in (b"\r\n", b"\n"):
+                break
+            if not line:
+                raise asyncio.IncompleteReadError(line, None)
+            name, colon, value = line.decode("latin-1").partition(":")
+            if not colon or not name.strip():
+                raise HTTPError(400, f"malformed header {line[:100]!r}")
+            headers[name.strip().lower()] = value.strip()
+
+        length = headers.get("content-length", "0")
+        if not length.isdigit():
+            raise HTTPError(400, f"invalid Content-Length {length[:100]!r}")
+        if int(length) > self.max_body_bytes:
+            raise HTTPError(413, f"body of {length} bytes, the maximum is {self.max_body_bytes}")
+        body = await reader.readexactly(int(length))
+        return method, path, version, headers, body
+
+    async def respond(self, writer, status, payload, keep_alive):
+        data = json.dumps(payload).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(data)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n".encode("latin-1") + data
+        )
+        await writer.drain()
+
+    async def handle(self, reader, writer):
+        '''
+        HTTP/1.1 with keep-alive, one request at a time per connection. the connection is closed after a request
+        that cannot be read, once it is answered.
+        '''
+        try:
+            while True:
+                try:
+                    request = await self.read_request(reader)
+                except HTTPError as e:
+                    self.errors += 1
+                    await self.respond(writer, e.status, {"error": str(e)}, keep_alive=False)
+                    break
+                if request is None:
+                    break
+                method, path, version, headers, body = request
+
+                status, payload = await self.route(method, path, body)
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionError):
+            # the client went away
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=8000):
+        self.queue = asyncio.Queue()
+        # the first call initializes the kernels, keep it out of the first request
+        start = time.perf_counter()
+        size = self.scorer.input_size
+        self.score_batch([torch.zeros(3, size, size)])
+        print(f"Warmed up in {time.perf_counter() - start:.2f}s")
+
+        batcher = asyncio.ensure_future(self.batch_loop())
+        server = await asyncio.start_server(self.handle, host, port)
+        print(f"Serving on http://{host}:{port} (max. batch size {self.max_batch_size}, "
+              f"max. latency {self.max_latency * 1000:g} ms)", flush=True)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            batcher.cancel()
@@ -1,14 +1,18 @@
 import os
+import time
+import functools
 import torch
 from torchvision import datasets
 import torchvision.transforms as transforms
 import clip_w_local
+from dassl.data.image_shards import ImageShards
+from dassl.utils import read_image
 
 
 def set_model_clip(args):
+    # on the GPU if there is one, otherwise on the CPU
     model, _ = clip_w_local.load(args.CLIP_ckpt)
 
-    model = model.cuda()
     normalize = transforms.Normalize(mean=(0.48145466, 0.4578275, 0.40821073),
                                          std=(0.26862954, 0.26130258, 0.27577711))  # for CLIP
     val_preprocess = transforms.Compose([
@@ -20,6 +24,28 @@ def set_model_clip(args):
     return model, val_preprocess
 
 
+def image_draft_size(args, preprocess=None):
+    '''
+    with args.draft_decode, JPEGs are decoded at a reduced scale that is still as large as the first Resize of preprocess.
+    0 for full resolution.
+    '''
+    draft_size = 0
+    if getattr(args, 'draft_decode', False) and preprocess is not None:
+        resize = [t for t in preprocess.transforms if isinstance(t, transforms.Resize)]
+        if resize:
+            draft_size = max(resize[0].size) if isinstance(resize[0].size, (list, tuple)) else resize[0].size
+    return draft_size
+
+
+def image_loader(args, preprocess=None):
+    '''
+    image loader of the ImageFolder datasets, reading from the image shard store of args.image_shards if given,
+    at the draft size of image_draft_size().
+    '''
+    read = ImageShards(args.image_shards).read_image if getattr(args, 'image_shards', '') else read_image
+    return functools.partial(read, draft_size=image_draft_size(args, preprocess))
+
+
 def set_val_loader(args, preprocess=None):
     if preprocess is None:
         normalize = transforms.Normalize(mean=(0.48145466, 0.4578275, 0.40821073),
@@ -28,31 +54,32 @@ def set_val_loader(args, preprocess=None):
             transforms.ToTensor(),
             normalize
         ])
-    kwargs = {'num_workers': 4, 'pin_memory': True}
+    loader = image_loader(args, preprocess)
+    kwargs = {'num_workers': 4, 'pin_memory': torch.cuda.is_available()}
     if args.in_dataset == "imagenet":
         val_loader = torch.utils.data.DataLoader(
-            datasets.ImageFolder(os.path.join(args.root, 'imagenet/val'), transform=preprocess),
+            datasets.ImageFolder(os.path.join(args.root, 'imagenet/val'), transform=preprocess, loader=loader),
             batch_size=args.batch_size, shuffle=False, **kwargs)
     elif args.in_dataset == "imagenet100":
         val_loader = torch.utils.data.DataLoader(
-            datasets.ImageFolder(os.path.join(args.root, 'ImageNet100/val'), transform=preprocess),
+            datasets.ImageFolder(os.path.join(args.root, 'ImageNet100/val'), transform=preprocess, loader=loader),
             batch_size=args.batch_size, shuffle=False, **kwargs)
     elif args.in_dataset == "imagenet10":
         val_loader = torch.utils.data.DataLoader(
-            datasets.ImageFolder(os.path.join(args.root, 'ImageNet10/val'), transform=preprocess),
+            datasets.ImageFolder(os.path.join(args.root, 'ImageNet10/val'), transform=preprocess, loader=loader),
             batch_size=args.batch_size, shuffle=False, **kwargs)
     elif args.in_dataset == "imagenet20":
         val_loader = torch.utils.data.DataLoader(
-            datasets.ImageFolder(os.path.join(args.root, 'ImageNet20/val'), transform=preprocess),
+            datasets.ImageFolder(os.path.join(args.root, 'ImageNet20/val'), transform=preprocess, loader=loader),
             batch_size=args.batch_size, shuffle=False, **kwargs)
     else:
         raise NotImplementedError
     return val_loader
 
 
-def set_ood_loader_ImageNet(args, out_dataset, preprocess=None):
+def set_ood_dataset_ImageNet(args, out_dataset, preprocess=None):
     '''
-    set OOD loader for ImageNet scale datasets
+    set OOD dataset for ImageNet scale datasets
     '''
     if preprocess is None:
         normalize = transforms.Normalize(mean=(0.48145466, 0.4578275, 0.40821073),
@@ -61,22 +88,83 @@ def set_ood_loader_ImageNet(args, out_dataset, preprocess=None):
             transforms.ToTensor(),
             normalize
         ])
+    loader = image_loader(args, preprocess)
     if out_dataset == 'iNaturalist':
-        testsetout = datasets.ImageFolder(root=os.path.join(args.root, 'iNaturalist'), transform=preprocess)
+        testsetout = datasets.ImageFolder(root=os.path.join(args.root, 'iNaturalist'), transform=preprocess, loader=loader)
     elif out_dataset == 'SUN':
-        testsetout = datasets.ImageFolder(root=os.path.join(args.root, 'SUN'), transform=preprocess)
+        testsetout = datasets.ImageFolder(root=os.path.join(args.root, 'SUN'), transform=preprocess, loader=loader)
     elif out_dataset == 'places365':
-        testsetout = datasets.ImageFolder(root=os.path.join(args.root, 'Places'), transform=preprocess)
+        testsetout = datasets.ImageFolder(root=os.path.join(args.root, 'Places'), transform=preprocess, loader=loader)
     elif out_dataset == 'Texture':
         testsetout = datasets.ImageFolder(root=os.path.join(args.root, 'dtd', 'images'),
-                                          transform=preprocess)
+                                          transform=preprocess, loader=loader)
     elif out_dataset == 'imagenet20':
         testsetout = datasets.ImageFolder(root=os.path.join(args.root, 'ImageNet20', 'val'),
-                                          transform=preprocess)
+                                          transform=preprocess, loader=loader)
     elif out_dataset == 'imagenet10':
         testsetout = datasets.ImageFolder(root=os.path.join(args.root, 'ImageNet10', 'val'),
-                                          transform=preprocess)
-    
+                                          transform=preprocess, loader=loader)
+    return testsetout
+
+
+def set_ood_loader_ImageNet(args, out_dataset, preprocess=None):
+    '''
+    set OOD loader for ImageNet scale datasets
+    '''
+    testsetout = set_ood_dataset_ImageNet(args, out_dataset, preprocess)
     testloaderOut = torch.utils.data.DataLoader(testsetout, batch_size=args.batch_size,
                                                 shuffle=False, num_workers=4)
     return testloaderOut
+
+
+class TaggedDataset(torch.utils.data.Dataset):
+    '''
+    wrap a (image, label) dataset to also return the index of the dataset it comes from.
+    '''
+    def __init__(self, dataset, source):
+        self.dataset = dataset
+        self.source = source
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, idx):
+        image, label = self.dataset[idx]
+        return image, label, self.source
+
+
+def set_multi_loader(args, datasets_list):
+    '''
+    one loader over several datasets in order, each sample tagged with the index of its dataset.
+    batches may span two datasets, so the workers keep decoding across dataset boundaries.
+    '''
+    multi_dataset = torch.utils.data.ConcatDataset(
+        [TaggedDataset(dataset, source) for source, dataset in enumerate(datasets_list)])
+    kwargs = {'num_workers': 4, 'pin_memory': torch.cuda.is_available(), 'persistent_workers': True}
+    return torch.utils.data.DataLoader(multi_dataset, batch_size=args.batch_size, shuffle=False, **kwargs)
+
+
+class FirstBatchTimer:
+    '''
+    wraps a data loader and prints the time from start (a time.perf_counter() value) to its first batch.
+    '''
+
+    def __init__(self, data_loader, start):
+        self.data_loader = data_loader
+        self.start = start
+        self.reported = False
+
+    def __len__(self):
+        return len(self.data_loader)
+
+    def __getattr__(self, name):
+        if name == "data_loader":
+            raise AttributeError(name)
+        return getattr(self.data_loader, name)
+
+    def __iter__(self):
+        for batch in self.data_loader:
+            if not self.reported:
+                self.reported = True
+                print(f"Time to first batch: {time.perf_counter() - self.start:.2f}s")
+            yield batch